@@ -28,11 +28,24 @@ import logging
 import sys
 
 from lib.encryption import Encryption
+from lib.session import SessionCache
+from lib.cache import VerificationCache
+from lib.keypool import KeyPairPool
 from lib.configuration import Configuration
 from lib.shell import Shell
 
 from lib.network import Node
+from lib.aionetwork import AsyncNode, PooledEncryption
+from lib.cryptopool import CryptoPool
 from lib.overlay import OverlayService
+from lib.messaging import MessagingService
+from lib.forward import StoreAndForwardService
+from lib.liveness import HeartbeatService
+from lib.kademlia import Refresher
+from lib.gossip import GossipService
+from lib.connections import ConnectionManager
+from lib.admission import Admission
+from lib.metrics import MetricsServer
 from lib.constants import *
 
 assert sys.version_info.major == 3
@@ -44,7 +57,16 @@ parser = argparse.ArgumentParser(description='Jodawg (%s - %s - %s)' % (JODAWG_V
 parser.add_argument("-d", "--debug", action="store_true", help="Enables debugging messages.")
 parser.add_argument("-j", "--auto-join", action="store_true", help="Automatically joins the network upon start.")
 parser.add_argument("-c", "--configuration-file", type=str, help="Location of configuration file (defaults to ~/.jodawg.cfg)")
-parser.set_defaults(debug=True, configuration_file=None) # TODO: Set "debug=false" later on.
+parser.add_argument("-w", "--workers", type=int, help="Number of worker threads handling requests (0 handles them on the node thread).")
+parser.add_argument("-a", "--asyncio", action="store_true", help="Runs the node on an asyncio event loop, with public key operations on a process pool.")
+parser.add_argument("-k", "--keypool-size", type=int, help="Number of keypairs to pre-generate in the background (0 disables the pool).")
+parser.add_argument("-v", "--verify-cache-size", type=int, help="Number of signature verifications to remember (0 disables the cache).")
+parser.add_argument("-b", "--heartbeat-interval", type=float, help="Seconds between heartbeats to other nodes, when gossip is disabled (0 disables failure detection).")
+parser.add_argument("-g", "--gossip-interval", type=float, help="Seconds between membership probes (0 disables gossip, heartbeats detect failures instead).")
+parser.add_argument("-r", "--admission-capacity", type=float, help="Public key decryptions per second before new peers need a cookie (0 disables admission control).")
+parser.add_argument("-f", "--store-and-forward", action="store_true", help="Holds messages for off-line nodes (run this on stable peers).")
+parser.add_argument("-m", "--metrics-port", type=int, help="Serves the node's metrics on http://127.0.0.1:<port>/metrics (0 disables the endpoint).")
+parser.set_defaults(debug=True, configuration_file=None, workers=0, keypool_size=0, verify_cache_size=0, heartbeat_interval=10.0, admission_capacity=50.0, gossip_interval=1.0, metrics_port=0) # TODO: Set "debug=false" later on.
 args = parser.parse_args() 
 
 # RUNNING
@@ -56,24 +78,77 @@ if args.debug:
 else:
     logging.basicConfig(level=logging.WARNING)
 
+keypool = None
+if args.keypool_size > 0:
+    logger.debug("Starting Keypair Pool")
+    keypool = KeyPairPool(args.keypool_size)
+    keypool.start()
+
 logger.debug("Initializing Configuration")
-configuration = Configuration(args.configuration_file)
+configuration = Configuration(args.configuration_file, keypool=keypool)
 
-logger.debug("Initializing Encryption") # This is actually stateless, but oh well, can re-use the same object throughout
-encryption = Encryption()
+logger.debug("Initializing Encryption") # Holds the session keys, re-use the same object throughout
+encryption = Encryption(SessionCache(), VerificationCache(args.verify_cache_size) if args.verify_cache_size > 0 else None)
 
 # Create the network node, register appropriate handlers for
 # the various network services. The node runs in its own thread.
 
+# Requests pass admission control before they are decrypted
+admission = Admission(encryption.sessions, capacity=args.admission_capacity) if args.admission_capacity > 0 else None
+if admission is not None:
+    encryption.verify_gate = admission.take_public_key # Signature checks in handlers count against the sender
+
 logger.debug("Initializing Node")
-node = Node(configuration)
-node.add_service("overlay", OverlayService(configuration, encryption))
-# node.register_handler(PresenceService())
-# node.register_handler(MessagingService())
+if args.asyncio:
+    pool = CryptoPool()
+    encryption = PooledEncryption(encryption, pool) # The services check signatures on the pool too
+    node = AsyncNode(configuration, encryption, pool, _admission=admission)
+else:
+    node = Node(configuration, encryption, args.workers, admission)
+
+# All outbound requests go through one set of pooled connections
+connection_manager = ConnectionManager()
+connection_manager.start()
+
+overlay = OverlayService(configuration, encryption, connection_manager)
+node.add_service("overlay", overlay)
+# node.add_service("presence", PresenceService())
+node.add_service("messaging", MessagingService(configuration, encryption, overlay.store, connection_manager)) # Serves no logs until users' keys are known
+# Every node sends through relays and drains them, only -f nodes relay for others
+forward = StoreAndForwardService(configuration, encryption, overlay.store, configuration.CONFIG_FILE + ".forward" if args.store_and_forward else None,
+                                 _connections=connection_manager, _router=node)
+node.add_service("forward", forward)
+overlay.forward = forward
 # etc.
 
+# One failure detector writes the statuses in the overlay store: both would
+# fight over nodes that one of them considers alive and the other does not.
+# Gossip (SWIM) is preferred, its membership updates are signed.
+heartbeats = None
+if args.heartbeat_interval > 0 and args.gossip_interval <= 0:
+    heartbeats = HeartbeatService(configuration, overlay.store, args.heartbeat_interval)
+    overlay.heartbeats = heartbeats
+
+gossip = None
+if args.gossip_interval > 0:
+    gossip = GossipService(configuration, encryption, overlay, args.gossip_interval)
+    node.add_service("gossip", gossip)
+    overlay.gossip = gossip
+
+refresher = Refresher(overlay.refresh)
+
+# The metrics are kept in this process, so they are served from here
+metrics_server = MetricsServer(args.metrics_port) if args.metrics_port > 0 else None
+
 logger.debug("Starting Node")
 node.start()
+refresher.start()
+if heartbeats is not None:
+    heartbeats.start()
+if gossip is not None:
+    gossip.start()
+if metrics_server is not None:
+    metrics_server.start()
 
 # START SHELL (also in its own thread)
 logger.debug("Starting Shell")
@@ -84,8 +159,20 @@ shell.join()
 logger.debug("Shell Stopped")
 
 logger.debug("Shutting Down Node")
+if metrics_server is not None:
+    metrics_server.terminate()
+refresher.terminate()
+if gossip is not None:
+    gossip.terminate()
 node.terminate()
 node.join()
+connection_manager.close()
+if heartbeats is not None:
+    heartbeats.terminate()
+    heartbeats.join()
+configuration.close()
+if keypool is not None:
+    keypool.stop()
 
 logger.debug("Terminated")
 
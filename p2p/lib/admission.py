@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# admission.py: admission control in front of the (expensive) decode path.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Decrypting a request with our private key (secp521r1) costs milliseconds,
+# so anyone sending junk can keep a core busy. Every request therefore
+# passes an admission stage before anything is decrypted:
+#
+# 1. Token buckets per source address (the Peer-Address of the frame) and,
+#    behind a ROUTER socket, per routing identity. Sources over their rate
+#    are dropped. Requests of which zmq knows neither (REP sockets on ipc
+#    or inproc) share one bucket.
+# 2. Requests in an established session (a session frame whose session we
+#    know) only cost AES, the others need public key decryption. These have
+#    their own, much lower, per source rate.
+# 3. When the node as a whole does more public key decryptions than it can
+#    afford, it asks new peers for a cookie first, like SYN cookies: the
+#    reply holds an HMAC over the peer's address and a time slot, which the
+#    peer returns in the header of its next request (see network.py). The
+#    node keeps no state for it. Peers in an established session are not
+#    affected, so they keep their latency under attack.
+#
+# Dropped requests get a small, unencrypted reply (REP sockets need one)
+# and are counted per reason.
+#
+# A frame may hold a batch of requests (see network.py), each of which is
+# charged to the source's bucket once it is decrypted. Handlers verify
+# signatures (node_join, gossip updates) while the node tells the Admission
+# which source it handles a request for (handling()): every signature check
+# takes a token of that source's public key bucket (take_public_key()).
+
+import os
+import hmac
+import time
+import struct
+import hashlib
+import threading
+import contextvars
+
+from lib import codec
+from lib import metrics
+from lib import session
+from lib.cache import LRUCache
+
+ADMISSION_DROPS = metrics.REGISTRY.counter("jodawg_admission_drops_total", "Requests dropped before decryption, per reason.", ("reason",))
+ADMISSION_ADMITTED = metrics.REGISTRY.counter("jodawg_admission_admitted_total", "Requests admitted, per cost.", ("cost",))
+
+_RATE_LIMITED = ("rate_limited",)
+_PUBLIC_KEY_LIMITED = ("public_key_limited",)
+_UNKNOWN = ("unknown",)
+_COOKIE_REQUIRED = ("cookie_required",)
+_CHEAP = ("session",)
+_EXPENSIVE = ("public_key",)
+
+_COOKIE = struct.Struct("!I16s")
+
+
+class TokenBucket(object):
+    """Allows @rate events per second on average, and bursts of @burst."""
+
+    __slots__ = [ "rate", "burst", "tokens", "updated" ]
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now, tokens=1.0):
+        """@return True if there were enough tokens (they are taken), False otherwise."""
+        self.refill(now)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def retry_after(self, tokens=1.0):
+        """@return Seconds until @tokens are available."""
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class Admission(object):
+    """Decides whether a request is worth decrypting."""
+
+    __slots__ = [ "rate", "burst", "expensive_rate", "expensive_burst", "sessions", "buckets", "pressure",
+                  "secret", "cookie_lifetime", "handled", "lock" ]
+
+    def __init__(self, sessions=None, rate=50.0, burst=100, expensive_rate=2.0, expensive_burst=10, capacity=50.0,
+                 max_sources=65536, cookie_lifetime=60):
+        """@param sessions The SessionCache of the node's Encryption, to recognise established sessions.
+           @param rate Requests per second per source.
+           @param burst Burst size per source.
+           @param expensive_rate Public key decryptions per second per source.
+           @param expensive_burst Burst size of public key decryptions per source.
+           @param capacity Public key decryptions per second the node is willing to do
+                           before new peers need a cookie.
+           @param max_sources Number of sources to keep buckets for (least recently seen are forgotten).
+           @param cookie_lifetime Length of a cookie time slot in seconds, cookies of the previous slot are accepted as well.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.expensive_rate = expensive_rate
+        self.expensive_burst = expensive_burst
+        self.sessions = sessions
+        self.buckets = LRUCache(max_sources)
+        self.pressure = TokenBucket(capacity, capacity, time.monotonic())
+        self.secret = os.urandom(32)
+        self.cookie_lifetime = cookie_lifetime
+        self.handled = contextvars.ContextVar("handled", default=None) # The sources of the request being handled (per thread or task)
+        self.lock = threading.Lock()
+
+    def _bucket(self, key, rate, burst, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            self.buckets.put(key, bucket)
+        return bucket
+
+    @staticmethod
+    def _sources(address, identity):
+        """@return The bucket keys of the sender of a request, its address first."""
+        sources = [ ("address", address) ] if address is not None else []
+        if identity is not None:
+            sources.append(("identity", bytes(identity)))
+        return sources if sources else [ _UNKNOWN ]
+
+    def _take(self, sources, tokens, now):
+        """@return The bucket of @sources that ran out of tokens, or None if all had enough (they are taken)."""
+        with self.lock:
+            buckets = [ self._bucket(source, self.rate, self.burst, now) for source in sources ]
+            for bucket in buckets:
+                bucket.refill(now)
+                if bucket.tokens < tokens:
+                    return bucket
+            for bucket in buckets:
+                bucket.tokens -= tokens
+        return None
+
+    def _slot(self, now):
+        return int((time.time() if now is None else now) // self.cookie_lifetime) & 0xffffffff
+
+    def _mac(self, slot, address):
+        return hmac.new(self.secret, struct.pack("!I", slot) + address.encode('utf-8'), hashlib.sha256).digest()[:16]
+
+    def cookie(self, address, now=None):
+        """@param now The wall clock time (defaults to time.time()).
+           @return A cookie (bytes) for the peer at @address.
+        """
+        slot = self._slot(now)
+        return _COOKIE.pack(slot, self._mac(slot, address))
+
+    def check_cookie(self, address, cookie, now=None):
+        """@return True if @cookie was handed out to @address in the current or previous time slot."""
+        if cookie is None or len(cookie) != _COOKIE.size:
+            return False
+        (slot, mac) = _COOKIE.unpack(bytes(cookie))
+        current = self._slot(now)
+        if slot != current and slot != (current - 1) & 0xffffffff:
+            return False
+        return hmac.compare_digest(mac, self._mac(slot, address))
+
+    def _cheap(self, payload, private_key):
+        """@return True if @payload is a frame of a session we know (AES only)."""
+        if self.sessions is None or private_key is None or not session.is_session_frame(payload):
+            return False
+        try:
+            identifier = session.parse_frame(payload)[0]
+        except ValueError:
+            return False
+        return self.sessions.inbound_key(identifier, private_key) is not None
+
+    def admit(self, payload, address, identity=None, cookie=None, private_key=None, now=None):
+        """Decides on a request, without decrypting it.
+
+           @param payload The (encrypted) payload frame.
+           @param address The address of the sender (the Peer-Address of the frame), None if unknown.
+           @param identity The routing identity of the sender (ROUTER sockets), if any.
+           @param cookie The cookie from the header of the request, if any.
+           @param private_key Our raw node private key (to look up sessions).
+           @return None if the request is admitted, otherwise the (UNENCRYPTED!) reply to send instead.
+        """
+        now = time.monotonic() if now is None else now
+        sources = self._sources(address, identity)
+        bucket = self._take(sources, 1.0, now)
+        if bucket is not None:
+            return _drop(_RATE_LIMITED, { "response" : "protocol_error", "reason" : "rate_limited", "retry_after" : bucket.retry_after() })
+
+        if self._cheap(payload, private_key):
+            ADMISSION_ADMITTED.inc(_CHEAP)
+            return None
+
+        with self.lock:
+            bucket = self._bucket(("expensive",) + sources[0], self.expensive_rate, self.expensive_burst, now)
+            if not bucket.take(now):
+                return _drop(_RATE_LIMITED, { "response" : "protocol_error", "reason" : "rate_limited", "retry_after" : bucket.retry_after() })
+            under_pressure = not self.pressure.take(now)
+
+        if under_pressure and address is not None and not self.check_cookie(address, cookie):
+            return _drop(_COOKIE_REQUIRED, { "response" : "protocol_error", "reason" : "cookie_required", "cookie" : self.cookie(address).hex() })
+        ADMISSION_ADMITTED.inc(_EXPENSIVE)
+        return None
+
+    def admit_batch(self, count, address, identity=None, now=None):
+        """Charges the requests of a batch beyond the first (which admit() charged for the frame).
+
+           @param count The number of requests in the batch.
+           @return True if the source had enough tokens for them.
+        """
+        if count <= 1:
+            return True
+        if self._take(self._sources(address, identity), float(count - 1), time.monotonic() if now is None else now) is not None:
+            ADMISSION_DROPS.inc(_RATE_LIMITED)
+            return False
+        return True
+
+    def handling(self, address, identity=None):
+        """Tells on whose behalf the calling thread (or asyncio task) handles
+           requests, until finished() is called."""
+        self.handled.set(self._sources(address, identity))
+
+    def finished(self):
+        self.handled.set(None)
+
+    def take_public_key(self, now=None):
+        """Charges a public key operation (e.g. a signature check) to the source of
+           the request the calling thread (or task) is handling. Operations outside
+           of request handling (our own) are free.
+
+           @return True if the source may have it done.
+        """
+        sources = self.handled.get()
+        if sources is None:
+            return True
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self._bucket(("expensive",) + sources[0], self.expensive_rate, self.expensive_burst, now).take(now):
+                return True
+        ADMISSION_DROPS.inc(_PUBLIC_KEY_LIMITED)
+        return False
+
+
+def _drop(reason, message):
+    ADMISSION_DROPS.inc(reason)
+    return codec.JSON.encode(message)
+
+
+def requested_cookie(message):
+    """@param message The (UNENCRYPTED!) reply to a request.
+       @return The cookie to put in the header when retrying the request, None if the reply does not ask for one.
+    """
+    if not isinstance(message, dict) or message.get("reason") != "cookie_required":
+        return None
+    try:
+        return bytes.fromhex(message["cookie"])
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# aionetwork.py: asyncio based peer-to-peer network services.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# The threaded Node in network.py handles one request at a time per thread.
+# The AsyncNode below handles every request in its own task on a single
+# event loop, and hands the public key operations to a CryptoPool, so the
+# loop itself only does I/O, AES and (de)serialization.
+#
+# Plain (not coroutine) handlers run on threads. They should be given a
+# PooledEncryption, so the signatures they check (e.g. of node_join) are
+# verified on the pool as well, instead of on a thread holding the GIL.
+
+import asyncio
+import threading
+import logging
+import time
+
+import zmq
+import zmq.asyncio
+
+from lib import codec
+from lib import cryptopool
+from lib.encryption import Encryption, decode_dictionary
+from lib.network import ServiceRouter, protocol_error, split_envelope, _peer_address, is_batch, batch_requests, batch_reply, BATCH, MESSAGES_RECEIVED, MESSAGES_HANDLED, HANDLER_SECONDS
+
+
+class AsyncEncryption(object):
+    """Asynchronous counterpart of Encryption. Runs the operations of the
+       Encryption object it wraps (so shares its sessions, caches, gate and
+       metrics), but does all public key operations on a CryptoPool. At most
+       max_pending operations of the pool are queued at any time, further
+       callers wait for a free slot."""
+
+    __slots__ = [ "encryption", "pool", "pending" ]
+
+    def __init__(self, _encryption, _pool):
+        self.encryption = _encryption
+        self.pool = _pool
+        self.pending = None # created lazily, it must belong to the running loop
+
+    async def _run(self, job, *args):
+        if self.pending is None:
+            self.pending = asyncio.Semaphore(self.pool.max_pending)
+        async with self.pending:
+            return await asyncio.wrap_future(self.pool.executor.submit(job, *args))
+
+    async def _complete(self, steps):
+        """Runs the steps of an Encryption operation (see Encryption._complete()),
+           awaiting the pool for their public key operations."""
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = await self._run(*request)
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+    async def encrypt(self, message, public_key):
+        return await self._complete(self.encryption._encrypting(message, public_key))
+
+    async def decrypt(self, cipher, private_key):
+        return await self._complete(self.encryption._decrypting(cipher, private_key))
+
+    async def encrypt_compress_json(self, dictionary, public_key):
+        return await self.encrypt_compress(dictionary, public_key)
+
+    async def decrypt_decompress_json(self, cipher, private_key):
+        return (await self.decrypt_decompress(cipher, private_key))[0]
+
+    async def encrypt_compress(self, dictionary, public_key, wire_codec=None):
+        assert type(dictionary) is dict
+        return await self.encrypt(codec.encode_envelope(dictionary, wire_codec), public_key)
+
+    async def decrypt_decompress(self, cipher, private_key):
+        return decode_dictionary(await self.decrypt(cipher, private_key))
+
+    async def sign(self, message, private_key):
+        return await self._complete(self.encryption._signing(message, private_key))
+
+    async def verify(self, message, signature, public_key):
+        return await self._complete(self.encryption._verifying(message, signature, public_key))
+
+
+class PooledEncryption(Encryption):
+    """An Encryption that does its public key operations on a CryptoPool, the
+       calling thread waits for the result. Meant for the services of an AsyncNode,
+       whose plain handlers run on threads (see AsyncNode.dispatch()).
+       Shares the sessions, verification cache and gate of the Encryption it wraps."""
+
+    __slots__ = [ "pool" ]
+
+    def __init__(self, _encryption, _pool):
+        Encryption.__init__(self, _encryption.sessions, _encryption.verify_cache)
+        self.verify_gate = _encryption.verify_gate
+        self.pool = _pool
+
+    def _perform(self, job, *args):
+        return self.pool.executor.submit(job, *args).result()
+
+
+class AsyncNode(threading.Thread, ServiceRouter):
+    """A Node (see network.py) running on an asyncio event loop.
+
+       The node binds a ROUTER socket and handles each request in its own
+       task, so thousands of peer conversations can be in flight at once.
+       Handlers may be coroutines, these are awaited on the loop and can use
+       the node's AsyncEncryption (the 'crypto' attribute). Plain handlers are
+       run on a thread so they don't block the loop.
+
+       The node still runs in its own thread (on its own loop), to stay a
+       drop-in replacement for Node. Its CryptoPool is shut down when it stops.
+    """
+
+    __slots__ = [ "logger", "configuration", "encryption", "crypto", "context", "user",
+                  "handlers", "routes", "keypair", "max_in_flight", "admission", "terminate_event" ]
+
+    def __init__(self, _configuration, _encryption, _pool=None, _max_in_flight=4096, _admission=None):
+        """Creates a new node.
+
+           @param _configuration The global Configuration object to use.
+           @param _encryption The Encryption object to use.
+           @param _pool The CryptoPool to use, a new one is created if None.
+           @param _max_in_flight Maximum number of requests handled concurrently,
+                                 no new requests are read beyond that.
+           @param _admission The Admission that requests pass before they are
+                             decrypted, None admits everything.
+        """
+        threading.Thread.__init__(self)
+        self.terminate_event = threading.Event()
+
+        self.configuration = _configuration
+        self.encryption = _encryption
+        self.crypto = AsyncEncryption(_encryption, _pool if _pool is not None else cryptopool.CryptoPool())
+        self.max_in_flight = _max_in_flight
+        self.admission = _admission
+        self.logger = logging.getLogger("jodawg.node")
+        self.context = zmq.asyncio.Context()
+        self.user = None
+        self.handlers = {}
+        self.routes = {}
+        self.keypair = None
+
+    def terminate(self):
+        self.terminate_event.set()
+
+    async def encode_reply(self, reply, request_codec=None):
+        if reply.public_key is None:
+            return codec.JSON.encode(reply.message)
+        return await self.crypto.encrypt_compress(reply.message, reply.public_key, reply.codec or request_codec)
+
+    async def handle_frames(self, frames, identity=None):
+        """Asynchronous counterpart of Node.handle_frames()."""
+        source = (_peer_address(frames[-1]) if frames else None, identity)
+        if len(frames) == 1:
+            return await self.handle_frame(frames[0].buffer, None, source)
+        if len(frames) != 2:
+            MESSAGES_RECEIVED.inc()
+            return await self.encode_reply(protocol_error("malformed_request"))
+        (service, rejection) = self.check_header(frames[0].buffer)
+        if rejection is not None:
+            MESSAGES_RECEIVED.inc()
+            return await self.encode_reply(rejection)
+        return await self.handle_frame(frames[1].buffer, service, source)
+
+    async def handle_frame(self, frame, service=None, source=None):
+        """Asynchronous counterpart of Node.handle_frame()."""
+
+        if self.keypair is None:
+            self.keypair = self.configuration.get_node_keypair()
+        MESSAGES_RECEIVED.inc()
+
+        try:
+            (message, request_codec) = await self.crypto.decrypt_decompress(frame, self.keypair.raw_private_key)
+        except Exception:
+            self.logger.warning("Error decoding message")
+            return await self.encode_reply(protocol_error("format_or_encryption_error")) # UNENCRYPTED!
+
+        reply = self.admit_requests(message, source)
+        if reply is None and is_batch(message):
+            reply = await self.dispatch_batch(message, source) if service in (None, BATCH) else protocol_error("service_mismatch")
+        elif reply is None:
+            reply = await self.dispatch(message, service, source)
+        return await self.encode_reply(reply, request_codec)
+
+    async def dispatch(self, message, service=None, source=None):
+        """Asynchronous counterpart of Node.dispatch()."""
+        route = self.route(message)
+        if route is None:
+            self.logger.debug("No service handles the request")
+            return protocol_error("unknown_request")
+
+        (handler_name, handler) = route
+        if service is not None and service != handler_name:
+            return protocol_error("service_mismatch")
+        start = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                reply = await self._call_coroutine(handler, message, source)
+            else:
+                reply = await asyncio.get_running_loop().run_in_executor(None, self.call_handler, handler, message, source)
+        except Exception:
+            self.logger.exception("Service '%s' failed to handle '%s'" % (handler_name, message["request"]))
+            return protocol_error("internal_error")
+
+        HANDLER_SECONDS.observe(time.perf_counter() - start, (handler_name,))
+        MESSAGES_HANDLED.inc((handler_name,))
+        self.logger.debug("Message handled by '%s' service" % (handler_name))
+        return reply
+
+    async def _call_coroutine(self, handler, message, source):
+        """Asynchronous counterpart of ServiceRouter.call_handler()."""
+        if self.admission is None or source is None:
+            return await handler(message)
+        self.admission.handling(*source)
+        try:
+            return await handler(message)
+        finally:
+            self.admission.finished()
+
+    async def dispatch_batch(self, message, source=None):
+        """Asynchronous counterpart of Node.dispatch_batch(). The requests are handled in order."""
+        requests = batch_requests(message)
+        if requests is None:
+            return protocol_error("malformed_batch")
+        replies = []
+        for m in requests:
+            replies.append(protocol_error("nested_batch") if is_batch(m) else await self.dispatch(m, None, source))
+        return batch_reply(replies)
+
+    async def _handle(self, socket, envelope, body, in_flight):
+        try:
+            socket.send_multipart(envelope + [ await self.handle_frames(body, envelope[0].bytes) ])
+        finally:
+            in_flight.release()
+
+    async def serve(self):
+        self.logger.debug("Starting node services")
+
+        self.keypair = self.configuration.get_node_keypair()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+
+        socket = self.context.socket(zmq.ROUTER)
+        socket.bind(self.configuration.get_node_address())
+
+        while not self.terminate_event.is_set():
+            if not await socket.poll(1000):
+                continue
+
+            # Envelope: the routing identity and the empty delimiter that a
+            # REQ peer prepends (a pooled DEALER adds a request id, see
+            # connections.py). The body is a header and a payload frame, or
+            # a single (legacy) payload frame; it is not copied.
+            frames = await socket.recv_multipart(copy=False)
+            (envelope, body) = split_envelope(frames)
+            rejection = self.admit(body, envelope[0].bytes)
+            if rejection is not None: # Cheap enough to answer on the loop
+                socket.send_multipart(envelope + [ rejection ])
+                continue
+            await in_flight.acquire()
+            task = asyncio.ensure_future(self._handle(socket, envelope, body, in_flight))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        socket.close(linger=0)
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.crypto.pool.shutdown()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# cache.py: bounded in-memory caches.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import hashlib
+import struct
+import time
+import collections
+
+
+class LRUCache(object):
+    """A bounded least-recently-used cache with optional time based expiry.
+
+       All operations are O(1) and guarded by a lock, so one cache can be
+       shared by the node and shell threads.
+    """
+
+    __slots__ = [ "max_entries", "ttl", "entries", "lock", "hits", "misses" ]
+
+    def __init__(self, max_entries=1024, ttl=None):
+        """Creates a new cache.
+
+           @param max_entries Maximum number of entries, the least recently used
+                              entry is evicted when this is exceeded.
+           @param ttl Default lifetime of an entry in seconds (None: never expires).
+        """
+        assert max_entries > 0
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Retrieves an entry, marking it as recently used.
+
+           @param key The key to look up.
+           @param default Returned when the key is absent or expired.
+           @return The cached value or @default.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                (value, expires) = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        """Stores an entry, evicting the least recently used one if needed.
+
+           @param key The key to store @value under.
+           @param value The value to store.
+           @param ttl Lifetime of this entry in seconds, overrides the default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return 0.0 if total == 0 else float(self.hits) / total
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class VerificationCache(LRUCache):
+    """Remembers the outcome of signature verifications, keyed by a digest of
+       the (message, signature, public key) triple. Positive results are kept
+       for the default ttl, negative results only for @negative_ttl seconds,
+       so a peer can not keep a forged signature cached as rejected for long
+       (nor us from re-checking a signature that failed due to some glitch).
+    """
+
+    __slots__ = [ "negative_ttl" ]
+
+    def __init__(self, max_entries=4096, ttl=3600, negative_ttl=5.0):
+        """Creates a new cache.
+
+           @param max_entries Maximum number of verifications remembered.
+           @param ttl Lifetime of positive results in seconds.
+           @param negative_ttl Lifetime of negative results in seconds, 0 does not cache them.
+        """
+        LRUCache.__init__(self, max_entries, ttl)
+        self.negative_ttl = negative_ttl
+
+    @staticmethod
+    def digest(message, signature, public_key):
+        h = hashlib.sha256()
+        for part in (message, signature, public_key):
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            h.update(struct.pack("!I", len(part)))
+            h.update(part)
+        return h.digest()
+
+    def store(self, key, authentic):
+        """Stores the outcome of a verification under @key (see digest())."""
+        if authentic:
+            self.put(key, True)
+        elif self.negative_ttl > 0:
+            self.put(key, False, self.negative_ttl)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# codec.py: wire formats for protocol messages.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Protocol messages are dictionaries. An envelope holds one of them,
+# serialized with a codec and compressed:
+#
+#   codec version (1 byte) | zlib compressed message
+#
+# Envelopes without a version byte (the first byte of a zlib stream is
+# always 0x78) are json, that is what older nodes send.
+#
+# Keys can be put in a message as they are (any object with a 'raw_key'
+# attribute, such as encryption.Key). The json codec sends them as base64
+# text, the binary codecs as raw bytes; use Key.from_wire() on the receiving
+# end to handle both.
+#
+# The codecs supported by two nodes are negotiated during node_join.
+
+import json
+import zlib
+import base64
+import struct
+
+try:
+    import msgpack # optional, a C implementation is a lot faster than ours
+except ImportError:
+    msgpack = None
+
+_LEGACY = 0x78
+
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024 # Decompressed, envelopes are inflated before anything is authenticated
+MAX_DEPTH = 64                       # Nesting of lists and dictionaries
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JsonCodec(object):
+    """The json codec, understood by every node."""
+
+    name = "json"
+    version = 1
+
+    def _default(self, value):
+        if hasattr(value, "raw_key"):
+            return value.b64_key
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return base64.b64encode(value).decode('utf-8')
+        raise TypeError("Can not encode " + type(value).__name__)
+
+    def encode(self, message):
+        return json.dumps(message, sort_keys=True, default=self._default).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+class BinaryCodec(object):
+    """A compact tagged binary layout. Every value starts with a one byte tag:
+
+       N: None, T: True, F: False, i: int64, I: big integer (length + bytes),
+       d: float64, s: string (length + utf-8), b: bytes (length + raw),
+       l: list (count + values), m: dictionary (count + key/value pairs)
+
+       Lengths and counts are unsigned 32-bit integers in network byte order.
+       Counts come from the peer, so they are checked against the bytes left
+       (every value takes at least one byte) before anything is decoded.
+    """
+
+    name = "binary"
+    version = 2
+
+    _LENGTH = struct.Struct("!I")
+    _INT = struct.Struct("!q")
+    _FLOAT = struct.Struct("!d")
+
+    def encode(self, message):
+        out = []
+        self._encode(message, out)
+        return b"".join(out)
+
+    def _encode(self, value, out):
+        t = type(value)
+        if t is str:
+            data = value.encode('utf-8')
+            out.append(b"s" + self._LENGTH.pack(len(data)) + data)
+        elif t is dict:
+            out.append(b"m" + self._LENGTH.pack(len(value)))
+            encode = self._encode
+            for (k, v) in value.items():
+                encode(k, out)
+                encode(v, out)
+        elif t is int:
+            if -2**63 <= value < 2**63:
+                out.append(b"i" + self._INT.pack(value))
+            else:
+                data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+                out.append(b"I" + self._LENGTH.pack(len(data)) + data)
+        elif t is list or t is tuple:
+            out.append(b"l" + self._LENGTH.pack(len(value)))
+            for v in value:
+                self._encode(v, out)
+        elif value is None:
+            out.append(b"N")
+        elif value is True:
+            out.append(b"T")
+        elif value is False:
+            out.append(b"F")
+        elif t is float:
+            out.append(b"d" + self._FLOAT.pack(value))
+        elif t is bytes or t is bytearray or t is memoryview or hasattr(value, "raw_key"):
+            data = bytes(value.raw_key if hasattr(value, "raw_key") else value)
+            out.append(b"b" + self._LENGTH.pack(len(data)) + data)
+        else:
+            raise TypeError("Can not encode " + t.__name__)
+
+    def decode(self, data):
+        data = bytes(data)
+        try:
+            (value, offset) = self._decode(data, 0, 0)
+        except (IndexError, KeyError, struct.error, UnicodeDecodeError) as e:
+            raise CodecError("Malformed binary message: " + str(e))
+        if offset != len(data):
+            raise CodecError("Trailing data after binary message")
+        return value
+
+    def _decode(self, data, offset, depth):
+        tag = data[offset]
+        if tag == 0x73: # s
+            n = self._LENGTH.unpack_from(data, offset + 1)[0]
+            offset += 5
+            if offset + n > len(data):
+                raise IndexError("string out of range")
+            return (data[offset:offset + n].decode('utf-8'), offset + n)
+        elif tag == 0x6d: # m
+            n = self._LENGTH.unpack_from(data, offset + 1)[0]
+            offset += 5
+            if 2 * n > len(data) - offset:
+                raise IndexError("dictionary out of range")
+            if depth >= MAX_DEPTH:
+                raise CodecError("Binary message nested too deeply")
+            value = {}
+            decode = self._decode
+            for i in range(n):
+                (k, offset) = decode(data, offset, depth + 1)
+                (value[k], offset) = decode(data, offset, depth + 1)
+            return (value, offset)
+        elif tag == 0x69: # i
+            return (self._INT.unpack_from(data, offset + 1)[0], offset + 9)
+        elif tag == 0x6c: # l
+            n = self._LENGTH.unpack_from(data, offset + 1)[0]
+            offset += 5
+            if n > len(data) - offset:
+                raise IndexError("list out of range")
+            if depth >= MAX_DEPTH:
+                raise CodecError("Binary message nested too deeply")
+            value = []
+            decode = self._decode
+            for i in range(n):
+                (v, offset) = decode(data, offset, depth + 1)
+                value.append(v)
+            return (value, offset)
+        elif tag == 0x62: # b
+            n = self._LENGTH.unpack_from(data, offset + 1)[0]
+            offset += 5
+            if offset + n > len(data):
+                raise IndexError("bytes out of range")
+            return (data[offset:offset + n], offset + n)
+        elif tag == 0x4e: # N
+            return (None, offset + 1)
+        elif tag == 0x54: # T
+            return (True, offset + 1)
+        elif tag == 0x46: # F
+            return (False, offset + 1)
+        elif tag == 0x64: # d
+            return (self._FLOAT.unpack_from(data, offset + 1)[0], offset + 9)
+        elif tag == 0x49: # I
+            n = self._LENGTH.unpack_from(data, offset + 1)[0]
+            offset += 5
+            if offset + n > len(data):
+                raise IndexError("integer out of range")
+            return (int.from_bytes(data[offset:offset + n], 'big', signed=True), offset + n)
+        raise CodecError("Unknown tag %d" % (tag))
+
+
+class MsgpackCodec(object):
+    """msgpack, only available when the msgpack module is installed."""
+
+    name = "msgpack"
+    version = 3
+
+    def _default(self, value):
+        if hasattr(value, "raw_key"):
+            return value.raw_key
+        raise TypeError("Can not encode " + type(value).__name__)
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True, default=self._default)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise CodecError("Malformed msgpack message: " + str(e))
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+# Supported codecs, most preferred first. On CPython the json module (in C)
+# beats our pure Python binary codec even with the base64 overhead, so that
+# one is only preferred over json by peers that say so. msgpack beats both.
+CODECS = [ JSON, BINARY ]
+if msgpack is not None:
+    CODECS.insert(0, MsgpackCodec())
+
+_BY_VERSION = dict((codec.version, codec) for codec in CODECS)
+_BY_NAME = dict((codec.name, codec) for codec in CODECS)
+
+
+def as_bytes(value):
+    """Reads a bytes field from a message: binary codecs carry raw bytes,
+       json carries base64 text.
+
+       @param value The field value.
+       @return The bytes.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    return base64.b64decode(value.encode('utf-8'))
+
+
+def supported():
+    """@return The names of the supported codecs, most preferred first."""
+    return [ codec.name for codec in CODECS ]
+
+
+def by_name(name):
+    """@return The codec called @name, or None if it is not supported."""
+    return _BY_NAME.get(name)
+
+
+def by_version(version):
+    """@return The codec with envelope version @version, or None if it is not supported."""
+    return _BY_VERSION.get(version)
+
+
+def negotiate(names):
+    """Picks the codec to use with a peer.
+
+       @param names The codec names the peer supports, most preferred first,
+                    None if the peer did not tell (an older node).
+       @return The first codec in @names we support as well (json if there is none),
+               or None (legacy envelopes) for older nodes.
+    """
+    if not isinstance(names, list):
+        return None
+    for name in names:
+        if name in _BY_NAME:
+            return _BY_NAME[name]
+    return JSON
+
+
+def encode_envelope(message, codec=None, level=9):
+    """Serializes and compresses a message.
+
+       @param message The message (a dictionary).
+       @param codec The codec to use, None produces a (legacy) json envelope without version byte.
+       @param level The zlib compression level.
+       @return The envelope (bytes).
+    """
+    if codec is None:
+        return zlib.compress(JSON.encode(message), level)
+    return bytes((codec.version,)) + zlib.compress(codec.encode(message), level)
+
+
+def decode_envelope(data):
+    """Decompresses and deserializes a message.
+
+       @param data The envelope.
+       @return A tuple (message, codec). For legacy envelopes codec is None.
+       @raise CodecError If the envelope can not be decoded.
+    """
+    if len(data) == 0:
+        raise CodecError("Empty envelope")
+    if data[0] == _LEGACY:
+        (codec, payload) = (None, data)
+    else:
+        codec = _BY_VERSION.get(data[0])
+        if codec is None:
+            raise CodecError("Unsupported codec version %d" % (data[0]))
+        payload = data[1:]
+    try:
+        inflater = zlib.decompressobj()
+        raw = inflater.decompress(payload, MAX_MESSAGE_BYTES)
+    except zlib.error as e:
+        raise CodecError("Can not decompress envelope: " + str(e))
+    if inflater.unconsumed_tail:
+        raise CodecError("Envelope exceeds %d bytes" % (MAX_MESSAGE_BYTES))
+    try:
+        return ((JSON if codec is None else codec).decode(raw), codec)
+    except CodecError:
+        raise
+    except (ValueError, RecursionError) as e: # Malformed json, or nested too deeply
+        raise CodecError("Can not decode envelope: " + str(e))
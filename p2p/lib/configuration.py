@@ -27,6 +27,8 @@ import logging
 import configparser
 import getpass
 import random
+import threading
+import json
 
 from lib.encryption import Key, KeyPair
 
@@ -41,24 +43,40 @@ class Configuration(object):
     
        NOTE: public/private keys are stored as base64 encoded strings. This is to prevent parsing
        problems with Python's configparser module.
+
+       Changes are written behind: every change is appended to a journal file
+       next to the configuration file right away, while rewriting the
+       configuration file itself is deferred by flush_delay seconds, so a burst
+       of changes (e.g. a join storm adding known nodes) results in a single
+       rewrite. The rewrite goes through a temporary file and an atomic rename,
+       after which the journal is cleared. A journal that is left behind (the
+       process crashed) is replayed on start-up. Call close() on shutdown to
+       write out pending changes.
     """
 
-    __slots__ = [ "CONFIG_FILE", "config", "logger" ]
+    __slots__ = [ "CONFIG_FILE", "JOURNAL_FILE", "config", "logger", "lock", "journal", "flush_delay", "flush_timer", "keypool" ]
 
-    def __init__(self, location=None):
+    def __init__(self, location=None, flush_delay=1.0, keypool=None):
         """Initializes this configuration.
         
            @param location The configuration file location. If None is provided, this
                            is derived from the user's home directory, and defaults to
                            ~/.jodawg.cfg
+           @param flush_delay Seconds to collect changes before rewriting the configuration file.
+           @param keypool A KeyPairPool to take new keypairs from (None: generate them inline).
         """
 
         self.logger = logging.getLogger("jodawg.config")
+        self.lock = threading.RLock() # Node workers may update the configuration concurrently
+        self.flush_delay = flush_delay
+        self.flush_timer = None
+        self.keypool = keypool
 
         if location is None:
             self.CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".jodawg.cfg")
         else:
             self.CONFIG_FILE = location
+        self.JOURNAL_FILE = self.CONFIG_FILE + ".journal"
 
         self.config = configparser.ConfigParser(delimiters=('='))
         if os.path.isfile(self.CONFIG_FILE):
@@ -69,14 +87,89 @@ class Configuration(object):
             # Initialize configuration groups
             self.config["user"] = {}
             self.config["node"] = {}
-            self._flush()
+
+        if self._replay_journal() or not os.path.isfile(self.CONFIG_FILE):
+            self.commit()
             # os.chmod(self.CONFIG_FILE, stat.S_IRUSR | stat.S_IWUSR) # TODO: Correctly, set file permissions
+        self.journal = open(self.JOURNAL_FILE, "a")
+
+    def _replay_journal(self):
+        """Applies the changes in a journal left behind by a previous run.
+
+           @return True if there were any changes.
+        """
+        if not os.path.isfile(self.JOURNAL_FILE):
+            return False
+
+        changes = 0
+        with open(self.JOURNAL_FILE) as f:
+            for line in f:
+                try:
+                    (operation, section, option, value) = json.loads(line)
+                except ValueError:
+                    break # Torn write at the end of the journal
+                self._apply(operation, section, option, value)
+                changes += 1
+        self.logger.debug("Replayed %d changes from journal %s" % (changes, self.JOURNAL_FILE))
+        return changes > 0
+
+    def _apply(self, operation, section, option, value):
+        if operation == "set":
+            if not self.config.has_section(section):
+                self.config.add_section(section)
+            self.config[section][option] = value
+        elif self.config.has_section(section):
+            self.config.remove_option(section, option)
+
+    def _set(self, section, option, value):
+        """Changes a setting, the change is journaled and written behind."""
+        with self.lock:
+            self._apply("set", section, option, value)
+            self._journal("set", section, option, value)
+
+    def _remove(self, section, option):
+        with self.lock:
+            self._apply("remove", section, option, None)
+            self._journal("remove", section, option, None)
+
+    def _journal(self, operation, section, option, value):
+        self.journal.write(json.dumps([ operation, section, option, value ]) + "\n")
+        self.journal.flush()
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(self.flush_delay, self.commit)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
 
-    def _flush(self):
-        """Writes the configuration to the disk."""
+    def commit(self):
+        """Writes the configuration to the disk (atomically), and clears the journal."""
 
-        self.logger.debug("Flushing configuration file to disk")
-        self.config.write(open(self.CONFIG_FILE, "w"))
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            self.logger.debug("Flushing configuration file to disk")
+            temporary_file = self.CONFIG_FILE + ".tmp"
+            with open(temporary_file, "w") as f:
+                self.config.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_file, self.CONFIG_FILE)
+
+            # Everything in the journal is in the configuration file now
+            with open(self.JOURNAL_FILE, "w"):
+                pass
+
+    def close(self):
+        """Writes out pending changes."""
+        with self.lock:
+            self.commit()
+            self.journal.close()
+
+    def _new_keypair(self):
+        if self.keypool is not None:
+            return self.keypool.take()
+        return KeyPair() # generate new
 
     def get_user_name(self):
         return getpass.getuser() # NOTE: could be made more configurable (e.g. firstname.lastname would be better)
@@ -92,8 +185,8 @@ class Configuration(object):
         value = self.config.get("user", "identifier", fallback=None)
         if value is None:
             value = str(random.randint(1000, 9999)) + "-" + str(random.randint(100, 999)) + "-" + str(random.randint(10, 99))
-            self.config["user"]["identifier"] = value
-            self._flush()
+            self._set("user", "identifier", value)
+            self.commit()
             self.logger.info("No user identifier stored, generated new identifier: " + value)
         return value
 
@@ -106,10 +199,10 @@ class Configuration(object):
 
         value = self.config.get("user", "private_key", fallback=None)
         if value is None:
-            keypair = KeyPair() # generate new
-            self.config["user"]["private_key"] = keypair.b64_private_key
-            self.config["user"]["public_key"] = keypair.b64_public_key
-            self._flush()
+            keypair = self._new_keypair()
+            self._set("user", "private_key", keypair.b64_private_key)
+            self._set("user", "public_key", keypair.b64_public_key)
+            self.commit() # Don't want to lose keys
             self.logger.info("No user keypair stored, generated new pair")
         else:
             keypair = KeyPair(self.config.get("user", "private_key"), self.config.get("user", "public_key"))
@@ -118,10 +211,10 @@ class Configuration(object):
     def get_node_keypair(self):
         value = self.config.get("node", "private_key", fallback=None)
         if value is None:
-            keypair = KeyPair() # generate new
-            self.config["node"]["private_key"] = keypair.b64_private_key
-            self.config["node"]["public_key"] = keypair.b64_public_key
-            self._flush()
+            keypair = self._new_keypair()
+            self._set("node", "private_key", keypair.b64_private_key)
+            self._set("node", "public_key", keypair.b64_public_key)
+            self.commit() # Don't want to lose keys
             self.logger.info("No node keypair stored, generated new pair")
         else:
             keypair = KeyPair(self.config.get("node", "private_key"), self.config.get("node", "public_key"))
@@ -137,13 +230,54 @@ class Configuration(object):
             return []
 
     def has_known_node(self, node_address):
-        return self.config.has_section("known_nodes", node_address)
+        return self.config.has_option("known_nodes", node_address)
 
     def add_known_node(self, node_address, node_public_key):
-        self.config["known_nodes"][node_address] = node_public_key.b64_key
-        self._flush()
+        b64_key = node_public_key.b64_key
+        if self.config.get("known_nodes", node_address, fallback=None) != b64_key: # Rejoins are common, skip those
+            self._set("known_nodes", node_address, b64_key)
 
     def remove_known_node(self, node_address):
-        self.config.remove_option("known_nodes", node_address)
-        self._flush()
+        self._remove("known_nodes", node_address)
+        if self.config.has_option("bootstrap_stats", node_address):
+            self._remove("bootstrap_stats", node_address)
+
+    def get_bootstrap_ranking(self):
+        """Ranks the bootstrap nodes we have statistics for, best first.
+           Nodes are ranked on their (smoothed) join success rate, and on
+           their average latency when these are equal. The statistics of
+           nodes that are no longer known are dropped.
 
+           @return A list of node addresses.
+        """
+        stats = {}
+        stale = []
+        for (node_address, value) in self.config.items("bootstrap_stats") if self.config.has_section("bootstrap_stats") else []:
+            if not self.has_known_node(node_address):
+                stale.append(node_address)
+                continue
+            (successes, failures, latency) = value.split()
+            stats[node_address] = ((int(successes) + 1.0) / (int(successes) + int(failures) + 2.0), float(latency))
+        for node_address in stale:
+            self._remove("bootstrap_stats", node_address)
+        return sorted(stats, key=lambda node_address: (-stats[node_address][0], stats[node_address][1]))
+
+    def update_bootstrap_stats(self, node_address, success, latency):
+        """Records the outcome of a join attempt via a bootstrap node.
+
+           @param node_address The address of the bootstrap node.
+           @param success Whether the join was approved.
+           @param latency Seconds it took to get a reply (or to time out).
+        """
+        with self.lock:
+            (successes, failures, average) = self.config.get("bootstrap_stats", node_address, fallback="0 0 0").split()
+            (successes, failures, average) = (int(successes), int(failures), float(average))
+            if successes + failures == 0:
+                average = latency
+            else:
+                average = 0.8 * average + 0.2 * latency # moving average, favours recent behaviour
+            if success:
+                successes += 1
+            else:
+                failures += 1
+            self._set("bootstrap_stats", node_address, "%d %d %.4f" % (successes, failures, average))
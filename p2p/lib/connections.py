@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# connections.py: pooled outbound connections to other nodes.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# All outbound requests of a process go through one ConnectionManager. It
+# keeps a DEALER socket per peer address, so the TCP connection (and zmq
+# handshake) is reused, and many requests can be in flight to the same peer.
+#
+# A request is sent as [ request id, "", frame ]. The peer's REP socket (or
+# ROUTER in front of its workers) treats everything before the empty frame
+# as the envelope and sends it back with the reply, so replies are matched
+# to their request by id, whatever order they arrive in.
+#
+# zmq sockets must not be shared between threads, so all sockets belong to
+# an I/O thread. Other threads hand it their requests through a queue and
+# wake it up by writing to a pipe; they get a Future for the reply.
+#
+# The I/O thread only resolves those Futures with the raw reply. Whatever
+# needs the reply decrypted (a Coalescer, see below) does that on one of
+# the manager's worker threads (see defer()), so the I/O thread keeps up
+# with the sockets.
+#
+# Connections that have been idle for a while are closed, the number of
+# open connections is capped, and every socket has a send high-water mark
+# so a slow peer can't make us buffer without bound.
+
+import os
+import zmq
+import time
+import queue
+import struct
+import logging
+import threading
+import itertools
+import concurrent.futures
+
+from lib import codec
+from lib import metrics
+from lib import network
+from lib import admission
+from lib.cache import LRUCache
+
+CONNECTION_REQUESTS = metrics.REGISTRY.counter("jodawg_connection_requests_total", "Outbound requests, per outcome.", ("outcome",))
+BATCH_SIZES = metrics.REGISTRY.histogram("jodawg_batch_requests", "Requests per outbound batch.", (), (1, 2, 4, 8, 16, 32, 64))
+CONNECTION_EVICTIONS = metrics.REGISTRY.counter("jodawg_connection_evictions_total", "Outbound connections closed, per reason.", ("reason",))
+
+_REPLIED = ("replied",)
+_TIMEOUT = ("timeout",)
+_REFUSED = ("refused",)
+_IDLE = ("idle",)
+
+_REQUEST_ID = struct.Struct("!Q")
+
+
+class RequestError(IOError):
+    """A request could not be sent, or got no reply in time."""
+    pass
+
+
+class _Peer(object):
+
+    __slots__ = [ "address", "socket", "pending", "last_used" ]
+
+    def __init__(self, _address, _socket):
+        self.address = _address
+        self.socket = _socket
+        self.pending = {} # request id -> (future, deadline)
+        self.last_used = time.monotonic()
+
+
+class ConnectionManager(threading.Thread):
+    """Sends requests to other nodes over pooled DEALER sockets."""
+
+    def __init__(self, context=None, max_connections=256, idle_timeout=60.0, send_hwm=100, workers=2):
+        """@param context The zmq.Context to create sockets on (a new one by default).
+           @param max_connections The maximum number of open connections.
+           @param idle_timeout Seconds after which a connection without requests is closed.
+           @param send_hwm Maximum number of messages queued for a single peer.
+           @param workers Number of threads that decrypt replies (see defer()).
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger("jodawg.connections")
+        self.context = zmq.Context() if context is None else context
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.send_hwm = send_hwm
+        self.peers = {} # address -> _Peer, only touched by the I/O thread
+        self.sockets = {} # socket -> _Peer
+        self.requests = queue.Queue()
+        self.coalescers = LRUCache(max_connections) # address -> Coalescer
+        self.ids = itertools.count(1)
+        self.workers = concurrent.futures.ThreadPoolExecutor(workers, "connections-worker")
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.running = True
+        self.lock = threading.Lock() # Guards running and the wakeup pipe
+        metrics.REGISTRY.gauge("jodawg_connections_open", "Outbound peer connections.", (), lambda: { () : len(self.peers) })
+
+    def request(self, address, frame, timeout=5.0):
+        """Sends a request.
+
+           @param address The address of the node.
+           @param frame The (encrypted) request, or a list of frames (a header and the payload, see network.py).
+           @param timeout Seconds to wait for the reply.
+           @return A concurrent.futures.Future, resolving to the reply (bytes) or
+                   failing with a RequestError.
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            if not self.running:
+                future.set_exception(RequestError("connection manager is closed"))
+                return future
+            self.requests.put((address, frame, time.monotonic() + timeout, future))
+            self._wakeup()
+        return future
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_write, b"\0")
+        except BlockingIOError:
+            pass # The pipe is full, the I/O thread wakes up anyway
+
+    def defer(self, function, *args):
+        """Runs @function(*args) on a worker thread. Meant for the done callbacks
+           of request(), which run on the I/O thread and must not decrypt there."""
+        try:
+            self.workers.submit(function, *args)
+        except RuntimeError:
+            function(*args) # Closed, the I/O thread is gone anyway
+
+    def call(self, address, frame, timeout=5.0):
+        """Sends a request and waits for the reply.
+
+           @return The reply (bytes).
+           @raise RequestError If no reply arrived in time.
+        """
+        return self.request(address, frame, timeout).result()
+
+    def coalescer(self, encryption, address, public_key, private_key, wire_codec=None, headers=False):
+        """Looks up the Coalescer for the node at @address, so concurrent requests
+           to a node share batches whoever sends them. See Coalescer for the parameters.
+
+           @return The Coalescer (created on first use, or when the node's key or codec changed).
+        """
+        coalescer = self.coalescers.get(address)
+        if coalescer is None or coalescer.public_key != public_key or coalescer.private_key != private_key or coalescer.wire_codec is not wire_codec:
+            coalescer = Coalescer(self, encryption, address, public_key, private_key, wire_codec, headers)
+            self.coalescers.put(address, coalescer)
+        coalescer.headers = headers
+        return coalescer
+
+    def close(self):
+        """Stops the I/O thread (if started), failing the pending requests. Closing twice is harmless."""
+        with self.lock:
+            if self.running:
+                self.running = False
+                self._wakeup()
+        if self.is_alive():
+            self.join()
+        self.workers.shutdown(wait=False)
+        with self.lock:
+            if self.wakeup_write is None:
+                return
+            while not self.requests.empty(): # Only left when the thread never ran
+                self.requests.get_nowait()[3].set_exception(RequestError("connection manager is closed"))
+            # No request() can write to the pipe anymore, and the I/O thread is gone
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
+            (self.wakeup_read, self.wakeup_write) = (None, None)
+
+    def _connect(self, address):
+        peer = self.peers.get(address)
+        if peer is not None:
+            return peer
+        if len(self.peers) >= self.max_connections:
+            # Evict the connection that was idle longest (if any)
+            idle = [ p for p in self.peers.values() if not p.pending ]
+            if not idle:
+                return None
+            self._disconnect(min(idle, key=lambda p: p.last_used), _IDLE)
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.SNDHWM, self.send_hwm)
+        socket.connect(address)
+        peer = _Peer(address, socket)
+        self.peers[address] = peer
+        self.sockets[socket] = peer
+        self.poller.register(socket, zmq.POLLIN)
+        return peer
+
+    def _disconnect(self, peer, reason):
+        for (future, deadline) in peer.pending.values():
+            future.set_exception(RequestError("connection to %s closed" % (peer.address)))
+        self.poller.unregister(peer.socket)
+        peer.socket.close()
+        del self.sockets[peer.socket]
+        del self.peers[peer.address]
+        CONNECTION_EVICTIONS.inc(reason)
+
+    def _send(self, address, frame, deadline, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        peer = self._connect(address)
+        if peer is None:
+            CONNECTION_REQUESTS.inc(_REFUSED)
+            future.set_exception(RequestError("too many open connections"))
+            return
+        request_id = _REQUEST_ID.pack(next(self.ids))
+        try:
+            frames = list(frame) if isinstance(frame, (list, tuple)) else [ frame ]
+            peer.socket.send_multipart([ request_id, b"" ] + frames, zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            CONNECTION_REQUESTS.inc(_REFUSED)
+            future.set_exception(RequestError("send queue to %s is full" % (address)))
+            return
+        peer.pending[request_id] = (future, deadline)
+        peer.last_used = time.monotonic()
+
+    def _receive(self, peer):
+        while True:
+            try:
+                frames = peer.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            peer.last_used = time.monotonic()
+            if len(frames) != 3 or frames[1] != b"":
+                self.logger.debug("Malformed reply from %s" % (peer.address))
+                continue
+            entry = peer.pending.pop(frames[0], None)
+            if entry is None:
+                continue # Timed out already
+            CONNECTION_REQUESTS.inc(_REPLIED)
+            entry[0].set_result(frames[2])
+
+    def _expire(self, now):
+        """Fails timed out requests, closes idle connections.
+
+           @return The first deadline still pending (or None).
+        """
+        first = None
+        for peer in list(self.peers.values()):
+            timed_out = False
+            for (request_id, (future, deadline)) in list(peer.pending.items()):
+                if deadline <= now:
+                    timed_out = True
+                    del peer.pending[request_id]
+                    CONNECTION_REQUESTS.inc(_TIMEOUT)
+                    future.set_exception(RequestError("request to %s timed out" % (peer.address)))
+                elif first is None or deadline < first:
+                    first = deadline
+            if timed_out and not peer.pending:
+                self._disconnect(peer, _TIMEOUT) # Don't deliver the queued requests once it is back
+            elif not peer.pending and now - peer.last_used >= self.idle_timeout:
+                self._disconnect(peer, _IDLE)
+        return first
+
+    def run(self):
+        self.poller = zmq.Poller()
+        self.poller.register(self.wakeup_read, zmq.POLLIN)
+        next_check = 0
+
+        while self.running:
+            now = time.monotonic()
+            if now >= next_check:
+                first = self._expire(now)
+                next_check = now + min(1.0, self.idle_timeout)
+                if first is not None:
+                    next_check = min(next_check, first)
+
+            for (socket, event) in self.poller.poll(max(0, next_check - time.monotonic()) * 1000):
+                if socket == self.wakeup_read:
+                    try:
+                        os.read(self.wakeup_read, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._receive(self.sockets[socket])
+
+            while True:
+                try:
+                    (address, frame, deadline, future) = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                self._send(address, frame, deadline, future)
+                next_check = min(next_check, deadline)
+
+        for peer in list(self.peers.values()):
+            self._disconnect(peer, ("closed",))
+        while not self.requests.empty():
+            self.requests.get_nowait()[3].set_exception(RequestError("connection manager is closed"))
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default():
+    """@return The connection manager of this process (started on first use)."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ConnectionManager()
+            _default.start()
+        return _default
+
+
+def requester(manager, encryption, address, public_key, private_key, wire_codec=None, timeout=5.0, service=None):
+    """Builds a callable that sends a request (dictionary) to a node and
+       returns its decrypted reply, as expected by MessagingService.synchronize()
+       and StoreAndForwardService.drain(). Unlike a Coalescer (see
+       ConnectionManager.coalescer()), it sends every request on its own.
+
+       @param public_key The node's raw public key.
+       @param private_key Our raw node private key, to decrypt the replies with.
+       @param service The service name to put in a header frame, None sends single (legacy) frames.
+                      Only requests with a header can pass the node's admission control
+                      under load (see admission.py).
+    """
+    cookies = [] # The last cookie the node handed out
+
+    def request(m, retry=True):
+        frame = encryption.encrypt_compress(m, public_key, wire_codec)
+        if service is not None:
+            frame = [ network.encode_header(service, wire_codec, cookies[-1] if cookies else None), frame ]
+        reply = manager.call(address, frame, timeout)
+        try:
+            return encryption.decrypt_decompress(reply, private_key)[0]
+        except Exception:
+            r = codec.JSON.decode(reply) # UNENCRYPTED! (an error)
+        cookie = admission.requested_cookie(r)
+        if cookie is not None and service is not None and retry:
+            cookies[:] = [ cookie ]
+            return request(m, False)
+        return r
+    return request
+
+
+def _estimate(m):
+    """@return A rough (encoded) size of request @m, from its top-level fields only."""
+    size = 0
+    for (key, value) in m.items():
+        size += len(key) + (len(value) if isinstance(value, (str, bytes, bytearray)) else 16 * len(value) if isinstance(value, (list, dict)) else 8)
+    return size
+
+
+class Coalescer(object):
+    """Coalesces the requests to one node into batch requests (see network.py).
+
+       Requests are collected for at most @window seconds, or until there
+       are @max_requests of them or their (estimated) size reaches @max_bytes,
+       and then sent as one batch: one encryption and one round-trip. A lone
+       request is sent as it is. Nodes that don't understand batches get
+       their requests one by one.
+
+       When the node asks for an admission cookie (see admission.py), the
+       requests are sent again as a batch with the cookie in its header.
+       Replies are decrypted (and retries encrypted) on the workers of the
+       ConnectionManager, not on its I/O thread.
+    """
+
+    def __init__(self, _manager, _encryption, _address, _public_key, _private_key, wire_codec=None, headers=False,
+                 window=0.005, max_requests=32, max_bytes=65536, timeout=5.0):
+        """@param _public_key The node's raw public key.
+           @param _private_key Our raw node private key, to decrypt the replies with.
+           @param headers Whether the node understands header frames (see network.py).
+        """
+        self.logger = logging.getLogger("jodawg.connections")
+        self.manager = _manager
+        self.encryption = _encryption
+        self.address = _address
+        self.public_key = _public_key
+        self.private_key = _private_key
+        self.wire_codec = wire_codec
+        self.headers = headers
+        self.window = window
+        self.max_requests = min(max_requests, network.MAX_BATCH_REQUESTS)
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.batching = True
+        self.cookie = None
+        self.lock = threading.Lock()
+        self.pending = [] # (request, future, timeout)
+        self.size = 0
+        self.timer = None
+
+    def submit(self, m, timeout=None):
+        """Queues a request (dictionary).
+
+           @param timeout Seconds to wait for the response (the Coalescer's timeout by default),
+                          a batch waits as long as its most patient request.
+           @return A concurrent.futures.Future, resolving to the decoded response.
+        """
+        future = concurrent.futures.Future()
+        item = (m, future, self.timeout if timeout is None else timeout)
+        batch = None
+        with self.lock:
+            if not self.batching:
+                batch = [ item ]
+            else:
+                self.pending.append(item)
+                self.size += _estimate(m)
+                if len(self.pending) >= self.max_requests or self.size >= self.max_bytes:
+                    batch = self._take()
+                elif self.timer is None:
+                    self.timer = threading.Timer(self.window, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        if batch:
+            self._send(batch)
+        return future
+
+    def request(self, m, timeout=None):
+        """Sends a request and waits for the response, a drop-in for requester()."""
+        return self.submit(m, timeout).result()
+
+    def flush(self):
+        """Sends the queued requests right away."""
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _take(self):
+        batch = self.pending
+        self.pending = []
+        self.size = 0
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def _send(self, batch, retry=True):
+        # A cookie can only go in a header, and a lone request has no service to put there
+        wrapped = len(batch) > 1 or (self.batching and self.headers and self.cookie is not None)
+        if not wrapped:
+            m = batch[0][0]
+        else:
+            m = { "request" : network.BATCH, "requests" : [ item[0] for item in batch ] }
+        BATCH_SIZES.observe(len(batch))
+        try:
+            frame = self.encryption.encrypt_compress(m, self.public_key, self.wire_codec)
+        except Exception as e:
+            for item in batch:
+                item[1].set_exception(e)
+            return
+        if self.headers and wrapped:
+            frame = [ network.encode_header(network.BATCH, self.wire_codec, self.cookie), frame ]
+        timeout = max(item[2] for item in batch)
+        self.manager.request(self.address, frame, timeout).add_done_callback(lambda reply: self.manager.defer(self._complete, batch, reply, wrapped, retry))
+
+    def _decode(self, reply):
+        try:
+            return self.encryption.decrypt_decompress(reply, self.private_key)[0]
+        except Exception:
+            return codec.JSON.decode(reply) # UNENCRYPTED! (an error)
+
+    def _complete(self, batch, reply, wrapped, retry):
+        """Decodes the reply to a batch and resolves its Futures. Runs on a worker of the manager."""
+        try:
+            r = self._decode(reply.result())
+        except Exception as e:
+            for item in batch:
+                item[1].set_exception(e)
+            return
+
+        cookie = admission.requested_cookie(r)
+        if cookie is not None and self.headers and retry:
+            self.logger.debug("%s asks for an admission cookie" % (self.address))
+            self.cookie = cookie
+            self._send(batch, False)
+            return
+        if not wrapped:
+            batch[0][1].set_result(r)
+            return
+        if r.get("response") == "protocol_error" and r.get("reason") == "unknown_request":
+            self.logger.debug("%s does not understand batches" % (self.address))
+            self.batching = False
+            for item in batch:
+                self._send([ item ])
+            return
+        responses = r.get("responses")
+        if not isinstance(responses, list) or len(responses) != len(batch):
+            for item in batch:
+                item[1].set_exception(RequestError("malformed batch reply from %s" % (self.address)))
+            return
+        for (item, response) in zip(batch, responses):
+            item[1].set_result(response)
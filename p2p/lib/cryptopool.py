@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# cryptopool.py: public key operations on a process pool.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# py-seccure is pure Python (on top of gmpy2), so its operations hold the GIL.
+# The only way to run them in parallel is in separate processes. The jobs
+# below are module level functions, so they can be pickled to the workers.
+
+import os
+import logging
+import concurrent.futures
+
+import seccure # py-seccure
+
+
+def _encrypt(message, public_key, mac):
+    return seccure.encrypt(message, public_key, mac_bytes=mac)
+
+def _decrypt(cipher, private_key):
+    return seccure.decrypt(cipher, private_key)
+
+def _sign(message, private_key):
+    return seccure.sign(message, private_key).decode('utf-8')
+
+def _verify(message, signature, public_key):
+    return seccure.verify(message, signature, public_key)
+
+def _run_chunk(job, chunk):
+    """Runs @job on every argument tuple in @chunk, in a worker.
+
+       @return A list of (True, result) or (False, exception) tuples.
+    """
+    results = []
+    for args in chunk:
+        try:
+            results.append((True, job(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class CryptoPool(object):
+    """A pool of worker processes for the expensive public key operations."""
+
+    __slots__ = [ "logger", "executor", "workers", "max_pending" ]
+
+    def __init__(self, workers=None, max_pending=1024):
+        """Creates a new pool.
+
+           @param workers Number of worker processes (None: one per CPU).
+           @param max_pending Maximum number of jobs queued or running at any
+                              time, callers wait for a free slot beyond that.
+        """
+        self.logger = logging.getLogger("jodawg.cryptopool")
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.max_pending = max_pending
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def map(self, job, items, chunk_size=None):
+        """Runs @job on every argument tuple in @items, spread over the workers.
+
+           Items are sent to the workers in chunks, which amortizes the cost
+           of pickling and scheduling over many (cheap to send) jobs.
+
+           @param job A module level function (it must pickle).
+           @param items A list of argument tuples.
+           @param chunk_size Items per chunk, by default the items are split
+                             in four chunks per worker (for load balancing).
+           @return A list of (True, result) or (False, exception) tuples, in
+                   the order of @items.
+        """
+        if not items:
+            return []
+        if chunk_size is None:
+            chunk_size = max(1, -(-len(items) // (4 * self.workers)))
+
+        chunks = [ items[i:i + chunk_size] for i in range(0, len(items), chunk_size) ]
+        futures = [ self.executor.submit(_run_chunk, job, chunk) for chunk in chunks ]
+
+        results = []
+        for (chunk, future) in zip(chunks, futures):
+            try:
+                results.extend(future.result())
+            except Exception as e:
+                # The chunk as a whole failed (a worker died, a result did not pickle)
+                self.logger.warning("Crypto job chunk failed: %s" % (e))
+                results.extend((False, e) for args in chunk)
+        return results
+
+    def encrypt_many(self, jobs, mac=10, chunk_size=None):
+        """Encrypts many messages in parallel.
+
+           @param jobs A list of (message, public key) tuples.
+           @param mac The MAC length (see Encryption).
+           @return A list of (True, cipher) or (False, exception) tuples, in order.
+        """
+        return self.map(_encrypt, [ (message, public_key, mac) for (message, public_key) in jobs ], chunk_size)
+
+    def decrypt_many(self, jobs, chunk_size=None):
+        """@param jobs A list of (cipher, private key) tuples. See encrypt_many()."""
+        return self.map(_decrypt, list(jobs), chunk_size)
+
+    def sign_many(self, jobs, chunk_size=None):
+        """@param jobs A list of (message, private key) tuples. See encrypt_many()."""
+        return self.map(_sign, list(jobs), chunk_size)
+
+    def verify_many(self, jobs, chunk_size=None):
+        """Verifies many signatures in parallel.
+
+           @param jobs A list of (message, signature, public key) tuples.
+           @return A list of (True, authentic) or (False, exception) tuples, in order.
+        """
+        return self.map(_verify, list(jobs), chunk_size)
@@ -20,15 +20,54 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
 import logging
 import random
+import time
 import string
-import zlib
 import json
 import base64
 
 import seccure # py-seccure
 
+from lib import codec
+from lib import session
+from lib import metrics
+from lib import cryptopool
+
+CRYPTO_OPERATIONS = metrics.REGISTRY.counter("jodawg_crypto_operations_total", "Cryptographic operations performed.", ("operation",))
+CRYPTO_BYTES = metrics.REGISTRY.counter("jodawg_crypto_bytes_total", "Bytes processed by cryptographic operations.", ("operation",))
+CRYPTO_SECONDS = metrics.REGISTRY.histogram("jodawg_crypto_duration_seconds", "Duration of cryptographic operations.", ("operation",))
+VERIFY_CACHE_LOOKUPS = metrics.REGISTRY.counter("jodawg_crypto_verify_cache_lookups_total", "Signature verification cache lookups.", ("outcome",))
+
+_ENCRYPT = ("encrypt",)
+_DECRYPT = ("decrypt",)
+_SIGN = ("sign",)
+_VERIFY = ("verify",)
+_HIT = ("hit",)
+_MISS = ("miss",)
+
+def _record(operation, size, start):
+    CRYPTO_OPERATIONS.inc(operation)
+    CRYPTO_BYTES.inc(operation, size)
+    CRYPTO_SECONDS.observe(time.perf_counter() - start, operation)
+
+def decode_dictionary(plaintext):
+    """@return A tuple (dictionary, codec) decoded from a decrypted envelope (see codec.py).
+       @raise CodecError If it does not hold a dictionary.
+    """
+    (dictionary, wire_codec) = codec.decode_envelope(plaintext)
+    if type(dictionary) is not dict:
+        raise codec.CodecError("Message is not a dictionary")
+    return (dictionary, wire_codec)
+
+def _attempt(function, *args):
+    """@return (True, result of @function) or (False, the exception it raised)."""
+    try:
+        return (True, function(*args))
+    except Exception as e:
+        return (False, e)
+
 
 class Key:
     __slots__ = ["_key"]
@@ -61,6 +100,18 @@ class Key:
     def raw_key(self, key):
         self._key = key
 
+    @staticmethod
+    def from_wire(value):
+        """Builds a Key from a message field. Binary codecs carry keys as raw
+           bytes, json carries them as base64 text (see codec.py).
+
+           @param value The field value.
+           @return A Key.
+        """
+        if isinstance(value, bytes):
+            return Key(value, True)
+        return Key(value)
+
 
 class KeyPair:
     """KeyPair holds a public/private keypair as byte strings, and can also generate new keypairs easily.
@@ -109,6 +160,10 @@ class KeyPair:
     def raw_public_key(self):
         return self._public_key.raw_key
 
+    @property
+    def public_key(self):
+        return self._public_key
+
     @property
     def raw_private_key(self):
         return self._private_key.raw_key
@@ -118,12 +173,19 @@ class Encryption:
     """Provides secure elliptic curve encryption.
 
        This is a convenience wrapper around py-seccure, which plays nice with our
-       internal infra-structure. Though this object can be instantiated and passed
-       around. Apart from logging, it is essentially stateless and could be regarded
-       as a singleton. Though, For future compatibility it is recommended to instantiate 
-       and pass around Encryption objects like any other object.
+       internal infra-structure. When a SessionCache is provided, public key
+       encryption is only used to set up a symmetric session key per peer,
+       subsequent messages to that peer are encrypted with AES-GCM (see session.py).
+       Hence, it is recommended to instantiate one Encryption object and pass it
+       around like any other object.
 
        NOTE: Keys (where needed) are expected to be passed as byte strings.
+
+       The operations are written as steps (generators, see _encrypting()):
+       they yield the public key operations they need done and get their
+       results back. Encryption does those right away (see _perform()), the
+       AsyncEncryption of aionetwork.py awaits a CryptoPool for them, so both
+       share the sessions, caches and metrics.
     """
 
     # WB: Why use slots? AT: They are useful in cases where you want the class to
@@ -133,10 +195,16 @@ class Encryption:
     # crystallized in terms of their interface.
     #
 
-    __slots__ = ["logger", "curve", "mac", "public_key"]
+    __slots__ = ["logger", "curve", "mac", "public_key", "sessions", "verify_cache", "verify_gate"]
 
-    def __init__(self):
-        """Initializes a new Encryption object."""
+    def __init__(self, sessions=None, verify_cache=None):
+        """Initializes a new Encryption object.
+
+           @param sessions A SessionCache to enable symmetric sessions, or None
+                           to use public key encryption for every message.
+           @param verify_cache A VerificationCache to remember the outcome of
+                               verify(), or None to verify every signature.
+        """
 
         self.logger = logging.getLogger("jodawg.encryption")
         self.curve = "secp521r1/nistp521"
@@ -145,6 +213,49 @@ class Encryption:
         # (at all), find out why, and find out if we need to do something
         # about this - AT.
         self.mac = 10
+        self.sessions = sessions
+        self.verify_cache = verify_cache
+        # Called before a signature is actually checked, returns False if it
+        # should not be (e.g. Admission.take_public_key()), or None.
+        self.verify_gate = None
+
+    def _perform(self, job, *args):
+        """Does a public key operation (a job of cryptopool.py) for the steps of an operation."""
+        return job(*args)
+
+    def _complete(self, steps):
+        """Runs the @steps of an operation (a generator, see _encrypting()) on this thread.
+
+           @return What the steps return.
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = self._perform(*request)
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+    def _encrypting(self, message, public_key):
+        """The steps of encrypt(). Yields the public key operations it needs, as
+           (job, arguments...) tuples, and is sent their results."""
+        assert type(message) is bytes
+        start = time.perf_counter()
+        if self.sessions is not None:
+            outbound = self.sessions.cached_outbound_session(public_key)
+            if outbound is None:
+                key = os.urandom(session.SESSION_KEY_BYTES)
+                outbound = self.sessions.add_outbound_session(public_key, key, (yield (cryptopool._encrypt, key, public_key, self.mac)))
+            cipher = session.seal(self.sessions.use(outbound), message)
+        else:
+            cipher = yield (cryptopool._encrypt, message, public_key, self.mac)
+            self.logger.debug("Encrypted " + str(len(message)) + " bytes to '" + public_key.decode("utf-8") + "'")
+        _record(_ENCRYPT, len(message), start)
+        return cipher
 
     def encrypt(self, message, public_key):
         """Encrypts the given message with the provided public key.
@@ -153,36 +264,126 @@ class Encryption:
            @param public_key The public key to use.
            @return An encrypted version of @message.
         """
-        assert type(message) is bytes
-        cipher = seccure.encrypt(message, public_key, mac_bytes=self.mac)
-        self.logger.debug("Encrypted " + str(len(message)) + " bytes to '" + public_key.decode("utf-8") + "'")
-        return cipher
+        return self._complete(self._encrypting(message, public_key))
 
-    def encrypt_compress_json(self, dictionary, public_key):
+    def encrypt_compress_json(self, dictionary, public_key, level=9):
         """Encrypts and compresses the given dictionary.
            This is a convenience function which automatically builds a json representation of
            the dictionary provided, compresses it, and then encrypts the compressed representation.
 
            @param dictionary The Python dictionary to encrypt/compress.
            @param public_key The public key to use.
+           @param level The zlib compression level.
+        """
+        return self.encrypt_compress(dictionary, public_key, None, level)
+
+    def encrypt_compress(self, dictionary, public_key, wire_codec=None, level=9):
+        """Encrypts and compresses the given dictionary using a codec (see codec.py).
+
+           @param dictionary The Python dictionary to encrypt/compress.
+           @param public_key The public key to use.
+           @param wire_codec The codec to serialize with, None produces a legacy json envelope
+                             that every node understands.
+           @param level The zlib compression level.
         """
         assert type(dictionary) is dict
-        msg = json.dumps(dictionary, sort_keys=True).encode('utf-8')
-        return self.encrypt(zlib.compress(msg, 9), public_key)
+        return self.encrypt(codec.encode_envelope(dictionary, wire_codec, level), public_key)
+
+    def encrypt_many(self, jobs, pool=None):
+        """Encrypts a batch of messages, e.g. one message for many recipients.
+
+           With sessions, only the recipients without an outbound session yet
+           need public key encryption (of a new session key). Those operations
+           are spread over @pool, the AES part is cheap and done inline.
+
+           @param jobs A list of (message, public key) tuples.
+           @param pool A CryptoPool, or None to do everything on this thread.
+           @return A list of (True, cipher) or (False, exception) tuples, in
+                   the order of @jobs.
+        """
+        if self.sessions is None:
+            if pool is None:
+                return [ _attempt(self.encrypt, message, public_key) for (message, public_key) in jobs ]
+            return pool.encrypt_many(jobs, self.mac)
+
+        # Set up the missing sessions first, wrapping their keys in one batch
+        keys = {}
+        for (message, public_key) in jobs:
+            if public_key not in keys and self.sessions.cached_outbound_session(public_key) is None:
+                keys[public_key] = os.urandom(session.SESSION_KEY_BYTES)
+        wrap_jobs = [ (key, public_key) for (public_key, key) in keys.items() ]
+        if pool is None:
+            wrapped = [ _attempt(self._perform, cryptopool._encrypt, key, public_key, self.mac) for (key, public_key) in wrap_jobs ]
+        else:
+            wrapped = pool.encrypt_many(wrap_jobs, self.mac)
+
+        failures = {}
+        for ((key, public_key), (ok, result)) in zip(wrap_jobs, wrapped):
+            if ok:
+                self.sessions.add_outbound_session(public_key, key, result)
+            else:
+                failures[public_key] = result
+
+        results = []
+        for (message, public_key) in jobs:
+            if public_key in failures:
+                results.append((False, failures[public_key]))
+            else:
+                results.append(_attempt(self.encrypt, message, public_key))
+        return results
 
     def decrypt(self, cipher, private_key):
         """Decrypts a message with the provide private key.
         
-           @param cipher The encrypted message.
+           @param cipher The encrypted message (bytes, or a memoryview of a received frame).
            @param private_key The key to use for decryption.
            @return The decrypted message.
         """
-        assert type(cipher) is bytes
-        # TODO: This should probably raise some type of exception when decryption fails ...
-        message = seccure.decrypt(cipher, private_key)
-        self.logger.debug("Decrypted " + str(len(message)) + " bytes")
+        return self._complete(self._decrypting(cipher, private_key))
+
+    def _decrypting(self, cipher, private_key):
+        """The steps of decrypt() (see _encrypting())."""
+        assert isinstance(cipher, (bytes, memoryview))
+        start = time.perf_counter()
+        message = None
+        if session.is_session_frame(cipher):
+            try:
+                message = yield from self._decrypting_session(cipher, private_key)
+            except ValueError:
+                # Could (in theory) be a plain ciphertext starting with the magic bytes.
+                self.logger.debug("Failed to decrypt session frame, trying public key decryption")
+        if message is None:
+            # TODO: This should probably raise some type of exception when decryption fails ...
+            message = yield (cryptopool._decrypt, bytes(cipher), private_key) # bytes: it may cross a process boundary
+            self.logger.debug("Decrypted " + str(len(message)) + " bytes")
+        _record(_DECRYPT, len(cipher), start)
         return message
 
+    def _decrypting_session(self, cipher, private_key):
+        """The steps that decrypt a session frame, only unwrapping the session key
+           (public key decryption) if we have not seen the session before.
+
+           @raise ValueError If the frame is invalid or fails authentication.
+        """
+        (identifier, wrapped_key, header, body) = session.parse_frame(cipher)
+
+        key = None
+        if self.sessions is not None:
+            key = self.sessions.inbound_key(identifier, private_key)
+        if key is None:
+            try:
+                key = yield (cryptopool._decrypt, wrapped_key, private_key)
+            except Exception as e:
+                raise ValueError("can not unwrap session key: " + str(e))
+            if session.session_identifier(key) != identifier:
+                raise ValueError("session identifier does not match key")
+            message = session.open_body(key, header, body)
+            if self.sessions is not None:
+                self.sessions.add_inbound_key(identifier, private_key, key)
+            self.logger.debug("Established inbound session")
+            return message
+        return session.open_body(key, header, body)
+
     def decrypt_decompress_json(self, cipher, private_key):
         """Decrypts and decompresses a message.
            See encrypt_compress_json() for details.
@@ -192,8 +393,18 @@ class Encryption:
            @return A Python dictionary.
         """
         # Convenience method
-        raw_txt = zlib.decompress(self.decrypt(cipher, private_key))
-        return json.loads(raw_txt.decode('utf-8'))
+        return self.decrypt_decompress(cipher, private_key)[0]
+
+    def decrypt_decompress(self, cipher, private_key):
+        """Decrypts and decompresses a message in any supported codec.
+           See encrypt_compress() for details.
+
+           @param cipher The message to decrypt.
+           @param private_key The private key to use for decryption.
+           @return A tuple (dictionary, codec), codec is None for legacy json envelopes.
+           @raise CodecError If the message can not be decoded.
+        """
+        return decode_dictionary(self.decrypt(cipher, private_key))
 
     def sign(self, message, private_key):
         """Signs a message with a private_key.
@@ -203,9 +414,14 @@ class Encryption:
            @return A signature which can be verified with the public key
                    that pairs with @private_key.
         """
-        # sign:
-        signature = seccure.sign(message, private_key).decode('utf-8')
+        return self._complete(self._signing(message, private_key))
+
+    def _signing(self, message, private_key):
+        """The steps of sign() (see _encrypting())."""
+        start = time.perf_counter()
+        signature = yield (cryptopool._sign, message, private_key)
         self.logger.debug("Signed " + str(len(message)) + " bytes with private key")
+        _record(_SIGN, len(message), start)
         return signature
 
     def verify(self, message, signature, public_key):
@@ -215,11 +431,61 @@ class Encryption:
            @param signature The signature.
            @param public_key The key to use to verify the signature.
         """
+        return self._complete(self._verifying(message, signature, public_key))
+
+    def _verifying(self, message, signature, public_key):
+        """The steps of verify() (see _encrypting())."""
+
+        # Rejoining nodes present the same signature over and over again
+        if self.verify_cache is not None:
+            key = self.verify_cache.digest(message, signature, public_key)
+            authentic = self.verify_cache.get(key)
+            if authentic is not None:
+                VERIFY_CACHE_LOOKUPS.inc(_HIT)
+                return authentic
+            VERIFY_CACHE_LOOKUPS.inc(_MISS)
 
-        authentic = seccure.verify(message, signature, public_key)
+        if self.verify_gate is not None and not self.verify_gate():
+            return False # Not cached, the signature may well be authentic
+
+        start = time.perf_counter()
+        authentic = yield (cryptopool._verify, message, signature, public_key)
         self.logger.debug("Verified " + str(len(message)) + " bytes against key '" + public_key.decode("utf-8") + "', authentic = " + str(authentic))
+        _record(_VERIFY, len(message), start)
+
+        if self.verify_cache is not None:
+            self.verify_cache.store(key, authentic)
         return authentic
 
+    def verify_many(self, jobs, pool=None):
+        """Verifies a batch of signatures, e.g. a backlog of signed joins.
+
+           @param jobs A list of (message, signature, public key) tuples.
+           @param pool A CryptoPool to spread the verifications over, or None
+                       to verify them on this thread.
+           @return A list of (True, authentic) or (False, exception) tuples, in
+                   the order of @jobs.
+        """
+        if pool is None:
+            return [ _attempt(self.verify, *job) for job in jobs ]
+
+        results = [ None ] * len(jobs)
+        pending = [] # indices of the jobs that must be verified
+        for (i, job) in enumerate(jobs):
+            authentic = None if self.verify_cache is None else self.verify_cache.get(self.verify_cache.digest(*job))
+            if authentic is None and self.verify_gate is not None and not self.verify_gate():
+                results[i] = (True, False)
+            elif authentic is None:
+                pending.append(i)
+            else:
+                results[i] = (True, authentic)
+
+        for (i, result) in zip(pending, pool.verify_many([ jobs[i] for i in pending ])):
+            results[i] = result
+            if result[0] and self.verify_cache is not None:
+                self.verify_cache.store(self.verify_cache.digest(*jobs[i]), result[1])
+        return results
+
 # TODO: Add some decent unit tests here ...
 # WB: Check testencryption.py
 # AT: Cool :) Let's extend that with some tests and perhaps build a UnitTest suite around this.
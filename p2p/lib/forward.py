@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# forward.py: store-and-forward of messages for off-line nodes.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Stable peers hold messages for recipients that are off-line (IDEAS.md,
+# point 2). Messages are opaque to the relay: they are encrypted for the
+# recipient already (e.g. a multirecipient envelope).
+#
+# Every recipient has a queue file, named after the fingerprint of its
+# public key, with records:
+#
+#   sequence number (8 bytes) | expiry time (8, float) | length (4) | crc32 (4) | payload
+#
+# The state of all queues (next sequence number, cumulative ack, offset of
+# the first unacknowledged record, file size, unacknowledged count and
+# bytes, earliest expiry) is kept in a memory-mapped HashIndex (see
+# logstore.py), so tens of thousands of queues cost no memory and no open
+# files while idle. A full queue is only rewritten (to drop expired
+# messages) once its earliest expiry has passed.
+#
+# Every node runs the client side: send() delivers a request directly, or
+# leaves it (encrypted for the recipient) with one of the stable peers we
+# bootstrap through when the recipient can't be reached. After a join the
+# node drains those relays, and handles the requests that were left for it
+# as if they had just arrived (their replies are lost).
+#
+# Protocol (the recipient pulls its messages once it is back on-line):
+#
+# request: forward-store <recipient public key> <payload> <ttl>
+#          Denied with reason "queue_full" and a retry_after (seconds) when
+#          the recipient's queue is full: the sender must back off.
+# request: forward-fetch [<ack> <ack token>] <max messages>
+#          Acknowledges everything up to and including sequence number <ack>
+#          and returns the next batch, encrypted for the requesting node,
+#          with a fresh ack token. An ack is only accepted with the token of
+#          the previous reply: only the holder of the recipient's private key
+#          can read it, so no one else can acknowledge (delete) its messages.
+#          A token is replaced only once it was used for an ack.
+
+import os
+import hmac
+import time
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+
+from lib import codec
+from lib import metrics
+from lib import connections
+from lib.cache import LRUCache
+from lib.encryption import Key
+from lib.logstore import HashIndex
+from lib.network import Reply
+
+FORWARD_STORED = metrics.REGISTRY.counter("jodawg_forward_stored_total", "Messages stored for off-line recipients.")
+FORWARD_REJECTED = metrics.REGISTRY.counter("jodawg_forward_rejected_total", "Messages refused by the store-and-forward service.", ("reason",))
+FORWARD_DELIVERED = metrics.REGISTRY.counter("jodawg_forward_delivered_total", "Stored messages acknowledged by their recipients.")
+FORWARD_EVICTED = metrics.REGISTRY.counter("jodawg_forward_evicted_total", "Stored messages dropped before delivery.", ("reason",))
+
+_RECORD = struct.Struct("!QdII")
+_EXPIRED = ("expired",)
+_OVERFLOW = ("overflow",)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class ForwardStore(object):
+    """Durable per-recipient message queues."""
+
+    __slots__ = [ "logger", "directory", "max_queue_bytes", "max_queue_messages", "max_ttl", "drop_oldest", "sync",
+                  "queues", "lock" ]
+
+    def __init__(self, directory, max_queue_bytes=4 * 1024 * 1024, max_queue_messages=10000, max_ttl=14 * 24 * 3600,
+                 drop_oldest=False, sync=False):
+        """Opens (or creates) a store.
+
+           @param directory The directory to keep the queues in.
+           @param max_queue_bytes Maximum size of the unacknowledged messages of one recipient.
+           @param max_queue_messages Maximum number of unacknowledged messages of one recipient.
+           @param max_ttl Upper bound on the time to live of a message (seconds).
+           @param drop_oldest When a queue is full, evict its oldest messages
+                              instead of refusing new ones.
+           @param sync If True every stored message is fsync'ed.
+        """
+        self.logger = logging.getLogger("jodawg.forward")
+        self.directory = directory
+        self.max_queue_bytes = max_queue_bytes
+        self.max_queue_messages = max_queue_messages
+        self.max_ttl = max_ttl
+        self.drop_oldest = drop_oldest
+        self.sync = sync
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # fingerprint -> (next sequence, acked, head offset, file size, unacked count, unacked bytes, earliest expiry)
+        self.queues = HashIndex(os.path.join(directory, "queues.idx"), 16, "QQQQQQd")
+
+    @staticmethod
+    def fingerprint(public_key):
+        return hashlib.sha256(public_key).digest()[:16]
+
+    def _path(self, fingerprint):
+        name = fingerprint.hex()
+        return os.path.join(self.directory, name[:2], name + ".queue")
+
+    def _state(self, fingerprint):
+        state = self.queues.get(fingerprint)
+        return list(state) if state is not None else [ 1, 0, 0, 0, 0, 0, 0.0 ]
+
+    def _records(self, fingerprint, state):
+        """Iterates over the unacknowledged records as (offset, sequence, expires, payload)."""
+        path = self._path(fingerprint)
+        if state[3] == 0 or not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            offset = state[2]
+            f.seek(offset)
+            while offset + _RECORD.size <= state[3]:
+                (sequence, expires, length, crc) = _RECORD.unpack(f.read(_RECORD.size))
+                payload = f.read(length)
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    self.logger.warning("Corrupt record in %s at %d" % (path, offset))
+                    return
+                yield (offset, sequence, expires, payload)
+                offset += _RECORD.size + length
+
+    def _rewrite(self, fingerprint, state, keep):
+        """Rewrites a queue file with only the records for which @keep(sequence, expires) holds."""
+        path = self._path(fingerprint)
+        kept = [ r for r in self._records(fingerprint, state) if keep(r[1], r[2]) ]
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            for (offset, sequence, expires, payload) in kept:
+                f.write(_RECORD.pack(sequence, expires, len(payload), zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        state[2] = 0
+        state[3] = sum(_RECORD.size + len(r[3]) for r in kept)
+        dropped = state[4] - len(kept)
+        state[4] = len(kept)
+        state[5] = sum(len(r[3]) for r in kept)
+        state[6] = min(r[2] for r in kept) if kept else 0.0
+        return dropped
+
+    def _full(self, state, size):
+        return state[4] + 1 > self.max_queue_messages or state[5] + size > self.max_queue_bytes
+
+    def store(self, public_key, payload, ttl):
+        """Queues a message for a recipient.
+
+           @param public_key The recipient's public key.
+           @param payload The (encrypted) message.
+           @param ttl Seconds to keep the message at most.
+           @return The sequence number of the message.
+           @raise QueueFull If the recipient's queue is full (back off and retry later).
+        """
+        if len(payload) > self.max_queue_bytes:
+            raise QueueFull("message too large")
+        fingerprint = self.fingerprint(public_key)
+        now = time.time()
+        expires = now + max(0, min(ttl, self.max_ttl))
+
+        with self.lock:
+            state = self._state(fingerprint)
+            if self._full(state, len(payload)) and state[4] > 0 and state[6] <= now:
+                dropped = self._rewrite(fingerprint, state, lambda sequence, e: e > now)
+                FORWARD_EVICTED.inc(_EXPIRED, dropped)
+            if self._full(state, len(payload)):
+                if not self.drop_oldest:
+                    self.queues.put(fingerprint, *state)
+                    raise QueueFull("queue full")
+                # Size based eviction of the oldest messages
+                records = [ (r[1], len(r[3])) for r in self._records(fingerprint, state) ]
+                (count, size) = (state[4], state[5])
+                cutoff = 0
+                for (sequence, length) in records:
+                    if count + 1 <= self.max_queue_messages and size + len(payload) <= self.max_queue_bytes:
+                        break
+                    (count, size, cutoff) = (count - 1, size - length, sequence)
+                FORWARD_EVICTED.inc(_OVERFLOW, self._rewrite(fingerprint, state, lambda sequence, e: sequence > cutoff))
+
+            path = self._path(fingerprint)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            sequence = state[0]
+            with open(path, "ab") as f:
+                if f.tell() != state[3]:
+                    f.truncate(state[3]) # Left-overs of a crash before the state was updated
+                    f.seek(state[3])
+                f.write(_RECORD.pack(sequence, expires, len(payload), zlib.crc32(payload)) + payload)
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            state[0] += 1
+            state[3] += _RECORD.size + len(payload)
+            state[4] += 1
+            state[5] += len(payload)
+            state[6] = expires if state[4] == 1 else min(state[6], expires)
+            self.queues.put(fingerprint, *state)
+        FORWARD_STORED.inc()
+        return sequence
+
+    def fetch(self, public_key, max_messages=64, max_bytes=1024 * 1024):
+        """Retrieves the next batch of unacknowledged, unexpired messages.
+
+           @param public_key The recipient's public key.
+           @return A tuple (list of (sequence, payload), True if there are more).
+        """
+        fingerprint = self.fingerprint(public_key)
+        now = time.time()
+        batch = []
+        size = 0
+        with self.lock:
+            state = self.queues.get(fingerprint)
+            if state is None:
+                return ([], False)
+            for (offset, sequence, expires, payload) in self._records(fingerprint, list(state)):
+                if expires <= now:
+                    continue
+                if len(batch) >= max_messages or (batch and size + len(payload) > max_bytes):
+                    return (batch, True)
+                batch.append((sequence, payload))
+                size += len(payload)
+        return (batch, False)
+
+    def ack(self, public_key, sequence):
+        """Acknowledges all messages up to and including @sequence (cumulative)."""
+        fingerprint = self.fingerprint(public_key)
+        with self.lock:
+            state = self.queues.get(fingerprint)
+            if state is None or sequence <= state[1]:
+                return
+            state = list(state)
+            delivered = 0
+            for (offset, s, expires, payload) in self._records(fingerprint, state):
+                if s > sequence:
+                    break
+                state[2] = offset + _RECORD.size + len(payload)
+                state[4] -= 1
+                state[5] -= len(payload)
+                delivered += 1
+            state[1] = max(state[1], min(sequence, state[0] - 1))
+
+            if state[4] == 0:
+                # Everything delivered, start afresh
+                path = self._path(fingerprint)
+                if os.path.exists(path):
+                    os.remove(path)
+                (state[2], state[3], state[6]) = (0, 0, 0.0)
+            elif state[2] > 65536 and state[2] > state[3] // 2:
+                self._rewrite(fingerprint, state, lambda s, e: True)
+            self.queues.put(fingerprint, *state)
+        FORWARD_DELIVERED.inc((), delivered)
+
+    def pending(self, public_key):
+        """@return The number of unacknowledged messages for a recipient."""
+        with self.lock:
+            state = self.queues.get(self.fingerprint(public_key))
+        return 0 if state is None else state[4]
+
+    def close(self):
+        with self.lock:
+            self.queues.flush()
+            self.queues.close()
+
+
+class StoreAndForwardService(object):
+    """Relays messages for recipients that are off-line (on stable peers), and
+       sends requests through relays and drains them (on every node)."""
+
+    def __init__(self, _configuration, _encryption, _store, _directory=None, retry_after=60, _connections=None, max_tokens=65536,
+                 _router=None, max_relays=2):
+        """@param _store The OverlayStore to look up nodes in.
+           @param _directory The directory for the ForwardStore, None relays nothing for others.
+           @param retry_after Seconds a sender is asked to back off when a queue is full.
+           @param _connections The ConnectionManager to send requests through (the one of the process by default).
+           @param max_tokens Number of recipients to remember the last ack token of.
+           @param _router The ServiceRouter (e.g. the Node) that handles the requests relays held for us.
+           @param max_relays Number of (best ranked bootstrap) nodes used as relays.
+        """
+        self.logger = logging.getLogger("jodawg.forward")
+        self.configuration = _configuration
+        self.encryption = _encryption
+        self.store = _store
+        self.forward_store = ForwardStore(_directory) if _directory is not None else None
+        self.retry_after = retry_after
+        self.connections = _connections
+        self.ack_tokens = LRUCache(max_tokens) # fingerprint -> token of the last fetch reply
+        self.router = _router
+        self.max_relays = max_relays
+
+    def request_handlers(self):
+        if self.forward_store is None:
+            return {}
+        return { "forward-store" : self._handle_store, "forward-fetch" : self._handle_fetch }
+
+    def _node(self, message, fields):
+        if any(field not in message for field in [ "node_address" ] + fields):
+            return None
+        return self.store.get_node(message["node_address"])
+
+    def _handle_store(self, message):
+        node = self._node(message, [ "recipient", "payload" ])
+        if node is None:
+            FORWARD_REJECTED.inc(("unknown_node",))
+            return Reply({ "response" : "forward-store_denied", "reason" : "missing fields or unknown node" }) # UNENCRYPTED!
+        ttl = message.get("ttl", self.forward_store.max_ttl)
+        if not _is_int(ttl):
+            FORWARD_REJECTED.inc(("invalid_fields",))
+            return Reply({ "response" : "forward-store_denied", "reason" : "invalid ttl" }, node.public_key.raw_key)
+
+        try:
+            sequence = self.forward_store.store(Key.from_wire(message["recipient"]).raw_key, codec.as_bytes(message["payload"]), ttl)
+        except QueueFull:
+            FORWARD_REJECTED.inc(("queue_full",))
+            m = { "response" : "forward-store_denied", "reason" : "queue_full", "retry_after" : self.retry_after }
+            return Reply(m, node.public_key.raw_key)
+        return Reply({ "response" : "forward-store_approved", "sequence" : sequence }, node.public_key.raw_key)
+
+    def _handle_fetch(self, message):
+        node = self._node(message, [])
+        if node is None:
+            return Reply({ "response" : "forward-fetch_denied", "reason" : "missing fields or unknown node" }) # UNENCRYPTED!
+
+        # Only the recipient can read the reply, it is encrypted with its key. The
+        # node_address is not authenticated though, so an ack has to come with
+        # the token of our previous reply to prove the sender could read it.
+        # The token only changes when it was used: anyone can fetch in the
+        # recipient's name (and gets the same token, unreadable), but only
+        # the recipient can ack.
+        public_key = node.public_key.raw_key
+        fingerprint = ForwardStore.fingerprint(public_key)
+        max_messages = message.get("max", 64)
+        if not _is_int(max_messages) or ("ack" in message and not _is_int(message["ack"])):
+            FORWARD_REJECTED.inc(("invalid_fields",))
+            return Reply({ "response" : "forward-fetch_denied", "reason" : "invalid max or ack" }, public_key)
+        token = self.ack_tokens.get(fingerprint)
+        if "ack" in message:
+            try:
+                valid = token is not None and hmac.compare_digest(token, codec.as_bytes(message.get("ack_token", "")))
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                FORWARD_REJECTED.inc(("invalid_ack",))
+                return Reply({ "response" : "forward-fetch_denied", "reason" : "invalid ack token" }, public_key)
+            self.forward_store.ack(public_key, message["ack"])
+            token = None
+        (batch, more) = self.forward_store.fetch(public_key, max(0, min(max_messages, 256)))
+        if token is None:
+            token = os.urandom(16)
+            self.ack_tokens.put(fingerprint, token)
+        m = { "response" : "forward-fetch_approved", "messages" : [ [ sequence, payload ] for (sequence, payload) in batch ], "more" : more,
+              "ack_token" : token }
+        return Reply(m, public_key)
+
+    def drain(self, request, deliver):
+        """Pulls all messages a relay holds for us (client side).
+
+           @param request A callable that sends a request (dictionary) to the relay and returns its response.
+           @param deliver A callable invoked with every payload (bytes), in order.
+           @return The number of messages delivered.
+        """
+        node_address = self.configuration.get_node_address()
+        m = { "request" : "forward-fetch", "node_address" : node_address }
+        delivered = 0
+        while True:
+            r = request(m)
+            if r.get("response") != "forward-fetch_approved":
+                raise ValueError("fetch denied: %s" % (r.get("reason")))
+            m = { "request" : "forward-fetch", "node_address" : node_address, "ack_token" : codec.as_bytes(r["ack_token"]) }
+            for (sequence, payload) in r["messages"]:
+                deliver(codec.as_bytes(payload))
+                m["ack"] = sequence
+                delivered += 1
+            if not r["messages"]:
+                break
+            if not r["more"]:
+                # Acknowledge the last batch
+                m["max"] = 0
+                request(m)
+                break
+        return delivered
+
+    def _coalescer(self, address, public_key):
+        manager = connections.default() if self.connections is None else self.connections
+        return manager.coalescer(self.encryption, address, public_key, self.configuration.get_node_keypair().raw_private_key)
+
+    def relays(self):
+        """@return The (address, Key) tuples of the nodes to leave requests with, best ranked first."""
+        rank = { address : i for (i, address) in enumerate(self.configuration.get_bootstrap_ranking()) }
+        node_address = self.configuration.get_node_address()
+        known = [ node for node in self.configuration.get_known_nodes() if node[0] != node_address ]
+        return sorted(known, key=lambda node: rank.get(node[0], len(rank)))[:self.max_relays]
+
+    def send(self, address, public_key, m, timeout=5.0, ttl=24 * 3600):
+        """Sends a request to a node, or leaves it with a relay if the node can't be reached.
+
+           @param public_key The raw public key of the node.
+           @param ttl Seconds a relay holds the request at most.
+           @return The response, or None if the request was left with a relay (its reply is lost).
+           @raise RequestError If neither the node nor any relay took the request.
+        """
+        try:
+            return self._coalescer(address, public_key).request(m, timeout)
+        except connections.RequestError as e:
+            self.logger.debug("Relaying a request for %s: %s" % (address, e))
+
+        payload = self.encryption.encrypt_compress(m, public_key)
+        store = { "request" : "forward-store", "node_address" : self.configuration.get_node_address(), "recipient" : Key(public_key, True),
+                  "payload" : payload, "ttl" : ttl }
+        for (relay_address, relay_public_key) in self.relays():
+            try:
+                r = self._coalescer(relay_address, relay_public_key.raw_key).request(store, timeout)
+            except connections.RequestError as e:
+                self.logger.debug("Relay %s is unreachable: %s" % (relay_address, e))
+                continue
+            if r.get("response") == "forward-store_approved":
+                return None
+            self.logger.debug("Relay %s refused a request for %s: %s" % (relay_address, address, r.get("reason")))
+        raise connections.RequestError("%s is unreachable and no relay took the request" % (address))
+
+    def deliver(self, payload):
+        """Handles a request a relay held for us, as if it had just arrived."""
+        try:
+            message = self.encryption.decrypt_decompress(payload, self.configuration.get_node_keypair().raw_private_key)[0]
+        except Exception:
+            self.logger.warning("Dropped an undecryptable relayed request")
+            return
+        route = None if self.router is None else self.router.route(message)
+        if route is None:
+            self.logger.debug("No service handles the relayed request")
+            return
+        try:
+            route[1](message)
+        except Exception:
+            self.logger.exception("Service '%s' failed to handle relayed '%s'" % (route[0], message["request"]))
+
+    def drain_from(self, relay_address, relay_public_key, deliver=None, timeout=5.0):
+        """Pulls all messages the relay at @relay_address holds for us (see drain()).
+
+           @param relay_public_key The raw public key of the relay.
+           @param deliver A callable invoked with every payload, deliver() by default.
+           @raise RequestError If the relay does not answer.
+        """
+        coalescer = self._coalescer(relay_address, relay_public_key)
+        return self.drain(lambda m: coalescer.request(m, timeout), self.deliver if deliver is None else deliver)
+
+    def drain_relays(self, timeout=5.0):
+        """Pulls the requests all relays hold for us, e.g. after a join.
+
+           @return The number of requests delivered.
+        """
+        delivered = 0
+        for (relay_address, relay_public_key) in self.relays():
+            try:
+                delivered += self.drain_from(relay_address, relay_public_key.raw_key, timeout=timeout)
+            except (connections.RequestError, ValueError) as e:
+                self.logger.debug("Could not drain relay %s: %s" % (relay_address, e))
+        if delivered:
+            self.logger.debug("Relays held %d requests for us" % (delivered))
+        return delivered
@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# gossip.py: SWIM style membership (failure detection and dissemination).
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SWIM (Das, Gupta & Motivala, 2002). Once per interval a node probes one
+# member, in a shuffled round-robin order so every member is probed within
+# n rounds:
+#
+#   gossip_ping     --> target, which answers with a gossip_ack
+#   gossip_ping_req --> INDIRECT random members when there is no ack in time,
+#                       they ping the target on our behalf (this routes around
+#                       a bad link between us and the target). They answer
+#                       right away, and pass an ack of the target on to us
+#                       with a gossip_indirect_ack when it comes in, so the
+#                       request handlers of a node never wait for a probe.
+#
+# A target that does not answer either way becomes SUSPECT, and DEAD when
+# nobody refutes that within the suspicion timeout (which grows with log n).
+# A node that hears it is suspected refutes it by raising its incarnation
+# number and gossiping that it is ALIVE.
+#
+# Membership changes (join, suspect, dead) are not sent separately, but
+# piggybacked on the pings and acks: every message carries up to
+# MAX_UPDATES of the least gossiped ones, and an update is dropped after
+# RETRANSMIT * log n transmissions. The bandwidth per node is constant and
+# an update reaches every node in O(log n) rounds (like an epidemic).
+#
+# An update is [address, public key, status, incarnation, signature]. For
+# one node, a higher incarnation wins; at the same incarnation DEAD beats
+# SUSPECT beats ALIVE. The statuses are mirrored in the OverlayStore: ALIVE
+# is ON-LINE, SUSPECT is DANGLING and DEAD is OFF-LINE.
+#
+# Only a node itself can say it is ALIVE: those updates carry its signature
+# over its address and incarnation (see alive_statement()), and new members
+# are only accepted that way or through a (signed) node_join. Anyone can
+# suspect a member or declare it dead, but only at the incarnation it last
+# signed, so the member refutes it by signing the next one.
+
+import math
+import time
+import random
+import logging
+import threading
+import concurrent.futures
+
+from lib import metrics
+from lib import connections
+from lib.encryption import Key
+from lib.network import Reply
+from lib.overlay import OverlayNode
+
+GOSSIP_PROBES = metrics.REGISTRY.counter("jodawg_gossip_probes_total", "Members probed, per outcome.", ("outcome",))
+GOSSIP_UPDATES = metrics.REGISTRY.counter("jodawg_gossip_updates_total", "Membership updates applied, per status.", ("status",))
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+MAX_UPDATES = 8 # Updates piggybacked per message
+RETRANSMIT = 3  # Times log n an update is gossiped
+
+_RANK = { ALIVE : 0, SUSPECT : 1, DEAD : 2 }
+_STATUS = { ALIVE : OverlayNode.OVERLAY_NODE_STATUS_ONLINE, SUSPECT : OverlayNode.OVERLAY_NODE_STATUS_DANGLING,
+            DEAD : OverlayNode.OVERLAY_NODE_STATUS_OFFLINE }
+_MEMBER = { OverlayNode.OVERLAY_NODE_STATUS_UNKNOWN : ALIVE, OverlayNode.OVERLAY_NODE_STATUS_ONLINE : ALIVE,
+            OverlayNode.OVERLAY_NODE_STATUS_DANGLING : SUSPECT }
+
+_ACK = ("ack",)
+_INDIRECT_ACK = ("indirect_ack",)
+_FAILED = ("failed",)
+
+
+class Member(object):
+
+    __slots__ = [ "status", "incarnation", "suspected" ]
+
+    def __init__(self, _status, _incarnation):
+        self.status = _status
+        self.incarnation = _incarnation
+        self.suspected = None # When it became SUSPECT
+
+
+def alive_statement(address, incarnation):
+    """@return What the node at @address signs to say it is ALIVE at @incarnation (bytes)."""
+    return ("%s alive %d" % (address, incarnation)).encode('utf-8')
+
+
+class Membership(object):
+    """The membership view of a node: the state of every member, the updates
+       still to be gossiped, and the probe order."""
+
+    __slots__ = [ "store", "address", "keypair", "encryption", "incarnation", "signature", "suspicion", "retransmit",
+                  "members", "updates", "order", "lock" ]
+
+    def __init__(self, _store, _address, _keypair, _encryption, suspicion=5.0, retransmit=RETRANSMIT, incarnation=None):
+        """@param _store The OverlayStore of the overlay service.
+           @param _address The address of this node.
+           @param _keypair The KeyPair of this node, it signs our ALIVE updates.
+           @param _encryption The Encryption to sign and verify ALIVE updates with.
+           @param suspicion Seconds a member stays SUSPECT before it is DEAD, times log n.
+           @param retransmit An update is gossiped @retransmit times log n times.
+           @param incarnation Our incarnation, by default the time, so it goes up when the node restarts.
+        """
+        self.store = _store
+        self.address = _address
+        self.keypair = _keypair
+        self.encryption = _encryption
+        self.suspicion = suspicion
+        self.retransmit = retransmit
+        self.members = {} # address -> Member
+        self.updates = {} # address -> [ transmissions, update ]
+        self.order = []   # Addresses still to probe this round
+        self.lock = threading.Lock()
+        self._incarnate(int(time.time()) if incarnation is None else incarnation)
+
+    def _incarnate(self, incarnation):
+        """Moves on to @incarnation, and gossips that we are ALIVE in it."""
+        self.incarnation = incarnation
+        self.signature = self.encryption.sign(alive_statement(self.address, incarnation), self.keypair.raw_private_key)
+        self._enqueue([ self.address, self.keypair.public_key, ALIVE, incarnation, self.signature ])
+
+    def _log(self):
+        return math.log2(len(self.members) + 2)
+
+    def _enqueue(self, update):
+        self.updates[update[0]] = [ 0, update ]
+
+    def _member(self, address):
+        """@return The Member at @address, picking up nodes that entered the store some other way."""
+        member = self.members.get(address)
+        if member is None:
+            node = self.store.get_node(address)
+            if node is not None and node.status in _MEMBER:
+                member = self.members[address] = Member(_MEMBER[node.status], -1) # Any incarnation is news
+        return member
+
+    def _news(self, address, status, incarnation):
+        """@return Whether an update about the member at @address would change our view of it."""
+        member = self._member(address)
+        if member is None:
+            return status == ALIVE # Suspicions are about an incarnation we know of
+        if status != ALIVE and incarnation != member.incarnation:
+            return False # Nor can anyone but the member itself move it on
+        return (incarnation, _RANK[status]) > (member.incarnation, _RANK[member.status])
+
+    def _authentic(self, address, public_key, incarnation, signature):
+        """@return Whether @signature says the member at @address (with @public_key) is ALIVE at @incarnation."""
+        if not isinstance(signature, (str, bytes)):
+            return False
+        try:
+            return self.encryption.verify(alive_statement(address, incarnation), signature, public_key.raw_key)
+        except Exception:
+            return False # Malformed signature
+
+    def apply(self, address, public_key, status, incarnation, signature=None, now=None):
+        """Applies a membership update (ours, or one gossiped to us).
+
+           @param public_key The public key of the member (a Key or its wire form),
+                             None if the member should be known already.
+           @param signature The member's signature of alive_statement(), ALIVE updates are ignored without it.
+           @return True if the update was news, it is then gossiped on.
+        """
+        if status not in _RANK or not isinstance(incarnation, int) or not isinstance(address, str):
+            return False
+        if address == self.address:
+            with self.lock:
+                if status != ALIVE and incarnation >= self.incarnation:
+                    self._incarnate(incarnation + 1) # Refute
+            return False
+
+        with self.lock:
+            if not self._news(address, status, incarnation):
+                return False # Most updates are old news, those are not verified
+        node = self.store.get_node(address)
+        key = None
+        if public_key is not None:
+            key = public_key if hasattr(public_key, "raw_key") else Key.from_wire(public_key)
+            if node is not None and node.public_key.raw_key != key.raw_key:
+                return False # Not the node we know at this address
+        elif node is None:
+            return False
+        if status == ALIVE and not self._authentic(address, key or node.public_key, incarnation, signature):
+            return False
+
+        with self.lock:
+            if not self._news(address, status, incarnation):
+                return False # Someone beat us to it
+            self._update(address, key, status, incarnation, signature if status == ALIVE else None, now)
+        GOSSIP_UPDATES.inc((status,))
+        return True
+
+    def _update(self, address, key, status, incarnation, signature, now):
+        """Records the state of the member at @address, and gossips it. Call with the lock held."""
+        node = self.store.get_node(address)
+        if node is None:
+            node = OverlayNode(address, key)
+            node.status = _STATUS[status]
+            self.store.update_node(node)
+        elif node.status != _STATUS[status]:
+            self.store.set_status(node, _STATUS[status])
+
+        member = self.members.get(address)
+        if member is None:
+            member = self.members[address] = Member(status, incarnation)
+            self.order.insert(random.randint(0, len(self.order)), address)
+        (member.status, member.incarnation) = (status, incarnation)
+        member.suspected = ((time.monotonic() if now is None else now) if status == SUSPECT else None)
+        self._enqueue([ address, node.public_key, status, incarnation, signature ])
+
+    def merge(self, updates, now=None):
+        """Applies the updates piggybacked on a message."""
+        if not isinstance(updates, list):
+            return
+        for update in updates:
+            if isinstance(update, list) and len(update) == 5:
+                try:
+                    self.apply(update[0], update[1], update[2], update[3], update[4], now)
+                except (TypeError, ValueError):
+                    pass # Malformed public key
+
+    def joined(self, address, public_key, incarnation=0, signature=None):
+        """Records that a node joined through us (see OverlayService), whatever we heard of it before.
+
+           The join itself is signed, so the node is a member either way. It
+           is only gossiped to the others with a @signature of its incarnation.
+        """
+        with self.lock:
+            self.members.pop(address, None)
+        if not self.apply(address, public_key, ALIVE, incarnation, signature):
+            with self.lock:
+                self._member(address) # Picked up from the store, at any incarnation
+
+    def alive(self, address, incarnation, signature, now=None):
+        """Records a direct or indirect ack of the member at @address.
+
+           @param signature The member's signature of its incarnation, which comes with the ack.
+        """
+        with self.lock:
+            member = self._member(address)
+            if member is not None and member.status == SUSPECT and incarnation == member.incarnation:
+                # It has not seen the suspicion yet. Only it can refute it, but
+                # we won't declare it dead while it answers.
+                member.suspected = time.monotonic() if now is None else now
+                return
+        self.apply(address, None, ALIVE, incarnation, signature, now)
+
+    def suspect(self, address, now=None):
+        """Records that the member at @address did not answer a probe."""
+        with self.lock:
+            member = self._member(address)
+            if member is None or member.status != ALIVE:
+                return
+            incarnation = member.incarnation
+        self.apply(address, None, SUSPECT, incarnation, None, now)
+
+    def dead(self, address):
+        """Records that the member at @address left."""
+        with self.lock:
+            member = self._member(address)
+            if member is None or member.status == DEAD:
+                return
+            incarnation = member.incarnation
+        self.apply(address, None, DEAD, incarnation)
+
+    def expire(self, now=None):
+        """Declares the members that were SUSPECT for too long DEAD.
+
+           @return The addresses of those members.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            timeout = self.suspicion * self._log()
+            expired = [ (address, member.incarnation) for (address, member) in self.members.items()
+                        if member.suspected is not None and now - member.suspected >= timeout ]
+        for (address, incarnation) in expired:
+            self.apply(address, None, DEAD, incarnation, None, now)
+        return [ address for (address, incarnation) in expired ]
+
+    def piggyback(self, count=MAX_UPDATES):
+        """@return Up to @count updates to send along with a message, least gossiped first."""
+        with self.lock:
+            limit = int(math.ceil(self.retransmit * self._log()))
+            selected = sorted(self.updates.values(), key=lambda entry: entry[0])[:count]
+            for entry in selected:
+                entry[0] += 1
+                if entry[0] >= limit:
+                    del self.updates[entry[1][0]]
+            return [ entry[1] for entry in selected ]
+
+    def next_target(self):
+        """@return The address of the next member to probe, or None if there is none.
+
+           Members are probed in a random order, which is reshuffled after
+           every full round, so each member is probed at least once per round.
+        """
+        with self.lock:
+            while True:
+                if not self.order:
+                    for node in self.store.get_nodes(len(self.store.nodes)):
+                        self._member(node.address)
+                    self.order = [ address for (address, member) in self.members.items() if member.status != DEAD ]
+                    random.shuffle(self.order)
+                    if not self.order:
+                        return None
+                address = self.order.pop()
+                member = self.members.get(address)
+                if member is not None and member.status != DEAD:
+                    return address
+
+    def random_members(self, count, exclude=()):
+        """@return Up to @count random addresses of members that are not DEAD."""
+        with self.lock:
+            candidates = [ address for (address, member) in self.members.items()
+                           if member.status != DEAD and address not in exclude ]
+        return random.sample(candidates, min(count, len(candidates)))
+
+
+class GossipService(threading.Thread):
+    """Runs the SWIM protocol periods, and handles the probes of other nodes."""
+
+    def __init__(self, _configuration, _encryption, _overlay, interval=1.0, indirect=3, suspicion=5):
+        """@param _overlay The OverlayService, whose store holds the members (requests go through its connections).
+           @param interval Seconds per protocol period (one probe).
+           @param indirect Number of members asked to ping a target that does not answer.
+           @param suspicion Protocol periods (times log n) before a SUSPECT member is DEAD.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger("jodawg.gossip")
+        self.configuration = _configuration
+        self.encryption = _encryption
+        self.overlay = _overlay
+        self.interval = interval
+        self.indirect = indirect
+        self.timeout = interval / 3
+        self.membership = Membership(_overlay.store, _configuration.get_node_address(), _configuration.get_node_keypair(),
+                                     _encryption, suspicion * interval)
+        self.probes = {} # target -> (addresses of the members asked to ping it, Event set on an indirect ack, (incarnation, signature) acked)
+        # Replies that come in on the thread of the ConnectionManager are
+        # decrypted, verified and passed on here, that thread only hands them over
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, "gossip-replies")
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def terminate(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+
+    def _later(self, function, *args):
+        """Runs @function(*args) on the executor. Called on the thread of the ConnectionManager."""
+        try:
+            self.executor.submit(function, *args)
+        except RuntimeError:
+            pass # Terminated
+
+    def request_handlers(self):
+        return { "gossip_ping" : self._handle_ping, "gossip_ping_req" : self._handle_ping_req, "gossip_indirect_ack" : self._handle_indirect_ack }
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.round()
+            except Exception:
+                self.logger.exception("Gossip round failed")
+
+    def round(self):
+        """Runs one protocol period: probes a single member."""
+        for address in self.membership.expire():
+            self.logger.debug("%s is dead" % (address))
+        target = self.membership.next_target()
+        if target is not None:
+            self.probe(target)
+
+    def probe(self, target):
+        """Pings the member at @target, directly and then through others.
+
+           @return True if the member answered.
+        """
+        ack = self._ping(target, self.timeout)
+        if ack is not None:
+            GOSSIP_PROBES.inc(_ACK)
+            return True
+
+        helpers = self.membership.random_members(self.indirect, (target,))
+        acked = threading.Event()
+        acks = []
+        with self.lock:
+            self.probes[target] = (set(helpers), acked, acks)
+        try:
+            futures = []
+            for address in helpers:
+                future = self._send(address, self._message("gossip_ping_req", target=target), 2 * self.timeout)
+                if future is not None:
+                    futures.append((address, future))
+            if futures:
+                acked.wait(2 * self.timeout)
+        finally:
+            with self.lock:
+                del self.probes[target]
+        for (address, future) in futures:
+            if future.done():
+                self._receive(address, future) # Only for the updates
+        if acks:
+            self.membership.alive(target, *acks[0])
+            GOSSIP_PROBES.inc(_INDIRECT_ACK)
+            return True
+
+        self.logger.debug("%s did not answer, suspecting it" % (target))
+        self.membership.suspect(target)
+        GOSSIP_PROBES.inc(_FAILED)
+        return False
+
+    def _message(self, request, **fields):
+        node_keypair = self.configuration.get_node_keypair()
+        m = { "request" : request, "node_address" : self.membership.address, "node_public_key" : node_keypair.public_key,
+              "incarnation" : self.membership.incarnation, "signature" : self.membership.signature, "updates" : self.membership.piggyback() }
+        m.update(fields)
+        return m
+
+    def _send(self, address, m, timeout):
+        """@return A Future for the reply of the member at @address, None if we don't know its key."""
+        node = self.overlay.store.get_node(address)
+        if node is None:
+            return None
+        return self.overlay.send(address, node.public_key.raw_key, m, "gossip", timeout)
+
+    def _receive(self, address, future):
+        """@return The decoded reply (its updates merged), None if there was none."""
+        try:
+            r = self.encryption.decrypt_decompress_json(future.result(), self.configuration.get_node_keypair().raw_private_key)
+        except connections.RequestError:
+            return None
+        except Exception:
+            self.logger.debug("Invalid gossip reply from %s" % (address))
+            return None
+        self.membership.merge(r.get("updates"))
+        return r
+
+    def _ping(self, target, timeout):
+        """@return The ack of the member at @target, None if it did not answer in time."""
+        future = self._send(target, self._message("gossip_ping"), timeout)
+        r = None if future is None else self._receive(target, future)
+        if r is None or r.get("response") != "gossip_ack" or not isinstance(r.get("incarnation"), int):
+            return None
+        self.membership.alive(target, r["incarnation"], r.get("signature"))
+        return r
+
+    def _sender(self, message):
+        """Merges the updates of a request, and the sender itself.
+
+           @return The raw public key of the sender, or None if the request is malformed.
+        """
+        if (not "node_address" in message) or (not "node_public_key" in message) or (not isinstance(message.get("incarnation"), int)):
+            return None
+        node_public_key = Key.from_wire(message["node_public_key"])
+        self.membership.merge(message.get("updates"))
+        self.membership.apply(message["node_address"], node_public_key, ALIVE, message["incarnation"], message.get("signature"))
+        return node_public_key.raw_key
+
+    def _handle_ping(self, message):
+        public_key = self._sender(message)
+        if public_key is None:
+            m = { "response" : "gossip_denied", "reason" : "missing mandatory fields!" }
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey yet!)
+
+        m = { "response" : "gossip_ack", "incarnation" : self.membership.incarnation, "signature" : self.membership.signature,
+              "updates" : self.membership.piggyback() }
+        return Reply(m, public_key, self.overlay.codec_for(message["node_address"]))
+
+    def _handle_ping_req(self, message):
+        public_key = self._sender(message)
+        if public_key is None or not isinstance(message.get("target"), str):
+            m = { "response" : "gossip_denied", "reason" : "missing mandatory fields!" }
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey yet!)
+
+        # Answered right away, an ack of the target is passed on when it comes in
+        future = self._send(message["target"], self._message("gossip_ping"), self.timeout)
+        if future is None:
+            m = { "response" : "gossip_nack", "updates" : self.membership.piggyback() }
+        else:
+            future.add_done_callback(lambda f: self._later(self._relay, message["node_address"], message["target"], f))
+            m = { "response" : "gossip_ping_req_accepted", "updates" : self.membership.piggyback() }
+        return Reply(m, public_key, self.overlay.codec_for(message["node_address"]))
+
+    def _relay(self, requester, target, future):
+        """Passes the ack of the member at @target on to the member at @requester,
+           that asked us to ping it. Runs on the executor."""
+        r = self._receive(target, future)
+        if r is None or r.get("response") != "gossip_ack" or not isinstance(r.get("incarnation"), int):
+            return
+        self.membership.alive(target, r["incarnation"], r.get("signature"))
+        m = self._message("gossip_indirect_ack", target=target, target_incarnation=r["incarnation"], target_signature=r.get("signature"))
+        future = self._send(requester, m, self.timeout)
+        if future is not None:
+            future.add_done_callback(lambda f: self._later(self._receive, requester, f))
+
+    def _handle_indirect_ack(self, message):
+        public_key = self._sender(message)
+        if public_key is None or not isinstance(message.get("target"), str) or not isinstance(message.get("target_incarnation"), int):
+            m = { "response" : "gossip_denied", "reason" : "missing mandatory fields!" }
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey yet!)
+
+        with self.lock: # Only acks for a probe in progress, from the members we asked
+            probe = self.probes.get(message["target"])
+            if probe is not None and message["node_address"] in probe[0]:
+                probe[2].append((message["target_incarnation"], message.get("target_signature")))
+                probe[1].set()
+
+        m = { "response" : "gossip_ack", "incarnation" : self.membership.incarnation, "signature" : self.membership.signature,
+              "updates" : self.membership.piggyback() }
+        return Reply(m, public_key, self.overlay.codec_for(message["node_address"]))
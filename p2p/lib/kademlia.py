@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# kademlia.py: structured overlay routing (k-buckets, iterative lookups).
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Kademlia (Maymounkov & Mazieres, 2002). Every node has a 160 bit ID, the
+# SHA-1 of its public key, and the distance between two IDs is their XOR.
+#
+# The routing table has a bucket per distance bit: bucket i holds up to K
+# contacts at a distance in [2^i, 2^(i+1)), least recently seen first. A
+# node hence knows many nodes close to it and few far away, O(log n) in
+# total. A full bucket prefers its old contacts (they are likely to stay
+# on-line), new ones wait in a replacement cache until an old one fails.
+#
+# A lookup asks the ALPHA closest known nodes for the K nodes closest to the
+# target they know of, and repeats with the closest nodes learned, until
+# the K closest nodes have all answered. Every round halves the distance,
+# so a lookup takes O(log n) hops.
+#
+# Buckets that saw no lookups for a while are refreshed by looking up a
+# random ID in their range.
+
+import time
+import heapq
+import random
+import hashlib
+import threading
+
+ID_BITS = 160
+K = 20          # Bucket size and number of results of a lookup
+ALPHA = 3       # Concurrent requests per lookup
+REFRESH = 3600  # Seconds after which an idle bucket is refreshed
+
+
+def node_id(public_key):
+    """@param public_key The raw public key of a node.
+       @return The ID of the node (an integer).
+    """
+    return int.from_bytes(hashlib.sha1(public_key).digest(), 'big')
+
+
+def to_wire(identifier):
+    return "%040x" % (identifier)
+
+
+def from_wire(value):
+    return int(value, 16)
+
+
+class Contact(object):
+    """A node in the routing table."""
+
+    __slots__ = [ "id", "address", "public_key" ]
+
+    def __init__(self, _address, _public_key, _id=None):
+        """@param _public_key The public key of the node (a Key).
+           @param _id The ID, derived from the key if omitted.
+        """
+        self.address = _address
+        self.public_key = _public_key
+        self.id = node_id(_public_key.raw_key) if _id is None else _id
+
+    def __repr__(self):
+        return "Contact(%s, %s)" % (self.address, to_wire(self.id)[:8])
+
+
+class Bucket(object):
+
+    __slots__ = [ "contacts", "replacements", "refreshed" ]
+
+    def __init__(self):
+        self.contacts = [] # Least recently seen first
+        self.replacements = []
+        self.refreshed = time.monotonic()
+
+
+class RoutingTable(object):
+    """The k-buckets of a node."""
+
+    __slots__ = [ "id", "k", "buckets", "lock" ]
+
+    def __init__(self, _id, k=K):
+        """@param _id The ID of this node.
+           @param k The bucket size.
+        """
+        self.id = _id
+        self.k = k
+        self.buckets = [ Bucket() for i in range(ID_BITS) ]
+        self.lock = threading.Lock()
+
+    def _bucket(self, identifier):
+        return self.buckets[(self.id ^ identifier).bit_length() - 1]
+
+    def __len__(self):
+        return sum(len(bucket.contacts) for bucket in self.buckets)
+
+    def __contains__(self, identifier):
+        return self.get(identifier) is not None
+
+    def get(self, identifier):
+        """@return The Contact with the given ID, or None."""
+        if identifier == self.id:
+            return None
+        with self.lock:
+            for contact in self._bucket(identifier).contacts:
+                if contact.id == identifier:
+                    return contact
+        return None
+
+    def update(self, contact):
+        """Records that we have heard from a node.
+
+           @return None, or the least recently seen contact of the (full)
+                   bucket. Ping it and remove() it if it does not answer,
+                   the new contact is then taken from the replacement cache.
+        """
+        if contact.id == self.id:
+            return None
+        with self.lock:
+            bucket = self._bucket(contact.id)
+            for (i, c) in enumerate(bucket.contacts):
+                if c.id == contact.id:
+                    del bucket.contacts[i]
+                    bucket.contacts.append(contact)
+                    return None
+            if len(bucket.contacts) < self.k:
+                bucket.contacts.append(contact)
+                return None
+            bucket.replacements = [ c for c in bucket.replacements if c.id != contact.id ][-(self.k - 1):] + [ contact ]
+            return bucket.contacts[0]
+
+    def remove(self, identifier):
+        """Removes a contact that failed to answer."""
+        with self.lock:
+            bucket = self._bucket(identifier)
+            contacts = [ c for c in bucket.contacts if c.id != identifier ]
+            if len(contacts) == len(bucket.contacts):
+                bucket.replacements = [ c for c in bucket.replacements if c.id != identifier ]
+                return
+            bucket.contacts = contacts
+            if bucket.replacements:
+                bucket.contacts.append(bucket.replacements.pop())
+
+    def closest(self, target, count=None):
+        """@return Up to @count (default: k) contacts closest to @target, closest first."""
+        with self.lock:
+            contacts = [ c for bucket in self.buckets for c in bucket.contacts ]
+        return heapq.nsmallest(self.k if count is None else count, contacts, key=lambda c: c.id ^ target)
+
+    def touch(self, target):
+        """Marks the bucket of @target as refreshed (a lookup went there)."""
+        if target != self.id:
+            self._bucket(target).refreshed = time.monotonic()
+
+    def refresh_targets(self, max_age=REFRESH):
+        """@return A random ID in the range of every bucket that needs a refresh."""
+        now = time.monotonic()
+        with self.lock:
+            used = [ i for (i, bucket) in enumerate(self.buckets) if bucket.contacts ]
+            if not used:
+                return []
+            # Buckets beyond the farthest contact cover nothing known yet
+            return [ self.id ^ ((1 << i) | random.getrandbits(i)) for i in range(used[-1] + 1)
+                     if now - self.buckets[i].refreshed >= max_age ]
+
+
+def lookup(table, target, query, alpha=ALPHA):
+    """Iteratively looks up the nodes closest to @target.
+
+       @param table The RoutingTable to start from (and to keep up to date).
+       @param target The ID to look up.
+       @param query A callable, invoked with a list of (at most @alpha)
+                    contacts and the target. It asks them concurrently and
+                    returns a list of (contact, contacts it knows of), where
+                    the latter is None if the contact did not answer.
+       @param alpha The number of concurrent queries.
+       @return The (up to k) closest contacts that answered, closest first.
+               If the target itself answered it comes first.
+    """
+    table.touch(target)
+    distance = lambda c: c.id ^ target
+    shortlist = { c.id : c for c in table.closest(target) }
+    queried = set()
+    answered = {}
+
+    while True:
+        closest = heapq.nsmallest(table.k, shortlist.values(), key=distance)
+        candidates = [ c for c in closest if c.id not in queried ][:alpha]
+        if not candidates:
+            break
+        for (contact, contacts) in query(candidates, target):
+            queried.add(contact.id)
+            if contacts is None:
+                table.remove(contact.id)
+                del shortlist[contact.id]
+                continue
+            table.update(contact)
+            answered[contact.id] = contact
+            for c in contacts:
+                if c.id != table.id and c.id not in shortlist:
+                    shortlist[c.id] = c
+        if target in answered:
+            break
+
+    return heapq.nsmallest(table.k, answered.values(), key=distance)
+
+
+class Refresher(threading.Thread):
+    """Calls a function (e.g. OverlayService.refresh) every @interval seconds."""
+
+    def __init__(self, _function, interval=REFRESH / 4):
+        threading.Thread.__init__(self, daemon=True)
+        self.function = _function
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def terminate(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.function()
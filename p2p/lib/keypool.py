@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# keypool.py: pre-generated keypairs.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from lib.encryption import KeyPair
+
+
+def _generate():
+    """Generates a keypair, returned in base64 so it pickles cheaply across processes."""
+    keypair = KeyPair()
+    return (keypair.b64_private_key, keypair.b64_public_key)
+
+
+class KeyPairPool(object):
+    """Keeps a pool of ready keypairs, topped up in the background.
+
+       Generating a keypair takes a public key computation, which is slow.
+       Consumers (key rotation, new sessions, tests) can take() a keypair from
+       the pool without waiting for that. Whenever the pool drops below its
+       low watermark, a background thread refills it up to its size. A take()
+       on an empty pool (a miss) generates a keypair inline.
+    """
+
+    __slots__ = [ "logger", "size", "low_watermark", "pool", "lock", "refill_event", "terminate_event",
+                  "thread", "executor", "hits", "misses", "generated" ]
+
+    def __init__(self, size=4, low_watermark=None, processes=0):
+        """Creates a new (not yet started) pool.
+
+           @param size Number of keypairs to keep ready.
+           @param low_watermark Refill once fewer keypairs are left (defaults to half of @size).
+           @param processes Number of processes generating keypairs, 0 generates
+                            them on the background thread itself.
+        """
+        assert size > 0
+
+        self.logger = logging.getLogger("jodawg.keypool")
+        self.size = size
+        self.low_watermark = max(1, size // 2) if low_watermark is None else low_watermark
+        self.pool = collections.deque()
+        self.lock = threading.Lock()
+        self.refill_event = threading.Event()
+        self.terminate_event = threading.Event()
+        self.thread = None
+        self.executor = concurrent.futures.ProcessPoolExecutor(processes) if processes > 0 else None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._refill, name="keypool")
+        self.thread.daemon = True
+        self.thread.start()
+        self.refill_event.set()
+
+    def stop(self):
+        self.terminate_event.set()
+        self.refill_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def take(self):
+        """Takes a keypair from the pool, generating one if the pool is empty.
+
+           @return A new KeyPair.
+        """
+        with self.lock:
+            if self.pool:
+                self.hits += 1
+                keypair = self.pool.popleft()
+            else:
+                self.misses += 1
+                keypair = None
+            if len(self.pool) < self.low_watermark:
+                self.refill_event.set()
+
+        if keypair is None:
+            self.logger.debug("Keypair pool is empty, generating keypair inline")
+            keypair = KeyPair()
+        return keypair
+
+    def stats(self):
+        """Retrieves the pool statistics.
+
+           @return A dictionary with the number of hits, misses, keypairs generated and ready.
+        """
+        return { "hits" : self.hits, "misses" : self.misses, "generated" : self.generated, "ready" : len(self.pool) }
+
+    def _add(self, keypair):
+        with self.lock:
+            self.pool.append(keypair)
+            self.generated += 1
+
+    def _refill(self):
+        while True:
+            self.refill_event.wait()
+            self.refill_event.clear()
+            if self.terminate_event.is_set():
+                break
+
+            missing = self.size - len(self.pool)
+            if self.executor is not None:
+                # Generate the missing keypairs in parallel
+                futures = [ self.executor.submit(_generate) for i in range(missing) ]
+                for future in concurrent.futures.as_completed(futures):
+                    self._add(KeyPair(*future.result()))
+            else:
+                for i in range(missing):
+                    if self.terminate_event.is_set():
+                        break
+                    self._add(KeyPair())
+
+            self.logger.debug("Keypair pool refilled to %d keypairs" % (len(self.pool)))
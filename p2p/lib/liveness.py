@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# liveness.py: heartbeat based failure detection for overlay nodes.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Every node binds a SUB socket (on the port after its node port) and
+# connects its PUB socket to those of its best bootstrap nodes, the node it
+# joined through and the nodes that are on-line the longest, so a node hears
+# from the nodes that joined through it on a single socket. The selection is redone every few beats,
+# nodes that dropped out of it are disconnected. A heartbeat carries the addresses the publisher speaks
+# for, so a host running several nodes sends one message per interval, and
+# everything received during an interval is handled as a single batch.
+#
+# A heartbeat only records the time a node was last heard of (O(1)). Every
+# node stored as on-line (however we learned of it) is tracked, and has one timer in a hierarchical timing wheel; when it fires
+# the node is checked and either rescheduled or demoted:
+#
+#   ONLINE --(dangling_after silent)--> DANGLING --(offline_after silent)--> OFFLINE
+#
+# Advancing the wheel costs O(expired timers), not O(nodes).
+#
+# NOTE: Heartbeats are not signed, so a node can keep a crashed node on-line
+# by sending heartbeats for it. It can't take a node off-line. Run gossip
+# (see gossip.py) where that matters, its membership updates are signed.
+
+import time
+import zmq
+import logging
+import threading
+
+from lib import codec
+from lib import metrics
+from lib.overlay import OverlayNode
+
+LIVENESS_HEARTBEATS = metrics.REGISTRY.counter("jodawg_liveness_heartbeats_total", "Heartbeats received for known nodes.")
+LIVENESS_TRANSITIONS = metrics.REGISTRY.counter("jodawg_liveness_transitions_total", "Node status changes caused by (missing) heartbeats.", ("status",))
+
+_ONLINE = ("online",)
+_DANGLING = ("dangling",)
+_OFFLINE = ("offline",)
+
+
+class TimingWheel(object):
+    """A hierarchical timing wheel.
+
+       Level 0 has a slot per tick, every slot of level n spans a whole
+       revolution of level n - 1. A timer is placed in the lowest level that
+       covers its expiry, and is moved one level down (cascaded) when the
+       wheel below it comes round, so every timer is touched at most once
+       per level.
+    """
+
+    __slots__ = [ "resolution", "slots", "levels", "wheels", "tick", "count" ]
+
+    def __init__(self, resolution=1.0, slots=64, levels=4, now=None):
+        """@param resolution Seconds per tick.
+           @param slots Slots per level.
+           @param levels Number of levels, with the defaults timers up to 194 days can be scheduled exactly.
+           @param now The current time (defaults to time.monotonic()).
+        """
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [ [ [] for i in range(slots) ] for level in range(levels) ]
+        self.tick = int((time.monotonic() if now is None else now) / resolution)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _insert(self, timer):
+        expiry = timer[0]
+        span = self.slots
+        for level in range(self.levels):
+            if expiry - self.tick < span or level == self.levels - 1:
+                # Beyond the top level the timer waits in the last slot it can reach, and is re-inserted from there
+                expiry = min(expiry, self.tick + span - 1)
+                self.wheels[level][(expiry * self.slots // span) % self.slots].append(timer)
+                return
+            span *= self.slots
+
+    def schedule(self, delay, item):
+        """Schedules @item to expire after @delay seconds (at least one tick).
+
+           @return A timer, to pass to cancel().
+        """
+        timer = [ max(self.tick + 1, self.tick + int(-(-delay // self.resolution))), item, True ]
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer[2]:
+            timer[2] = False
+            self.count -= 1
+
+    def _cascade(self, level):
+        span = self.slots ** level
+        slot = self.wheels[level][(self.tick // span) % self.slots]
+        if level + 1 < self.levels and (self.tick // span) % self.slots == 0:
+            self._cascade(level + 1)
+        timers = slot[:]
+        del slot[:]
+        for timer in timers:
+            if timer[2]:
+                self._insert(timer)
+
+    def advance(self, now=None):
+        """Moves the wheel forward to @now.
+
+           @return The items of the timers that expired, in order of expiry.
+        """
+        target = int((time.monotonic() if now is None else now) / self.resolution)
+        expired = []
+        while self.tick < target:
+            if self.count == 0:
+                self.tick = target
+                break
+            self.tick += 1
+            if self.tick % self.slots == 0:
+                self._cascade(1)
+            slot = self.wheels[0][self.tick % self.slots]
+            for timer in slot:
+                if timer[2]:
+                    timer[2] = False
+                    self.count -= 1
+                    expired.append(timer[1])
+            del slot[:]
+        return expired
+
+
+class LivenessMonitor(object):
+    """Tracks the nodes of an OverlayStore and demotes the ones that go silent."""
+
+    __slots__ = [ "logger", "store", "dangling_after", "offline_after", "wheel", "last_seen", "timers", "demoted", "lock" ]
+
+    def __init__(self, _store, dangling_after=30.0, offline_after=120.0, wheel=None):
+        """@param _store The OverlayStore whose nodes are tracked, from now on every node it stores as ON-LINE.
+           @param dangling_after Seconds of silence after which a node is DANGLING.
+           @param offline_after Seconds of silence after which a node is OFFLINE.
+           @param wheel The TimingWheel to use (a new one with 1 second ticks by default).
+        """
+        self.logger = logging.getLogger("jodawg.liveness")
+        self.store = _store
+        self.dangling_after = dangling_after
+        self.offline_after = offline_after
+        self.wheel = TimingWheel() if wheel is None else wheel
+        self.last_seen = {} # address -> time
+        self.timers = {} # address -> timer
+        self.demoted = set() # addresses we changed the status of
+        self.lock = threading.RLock() # Setting a node ON-LINE tracks it (again)
+        _store.online = self.track
+
+    def track(self, address, now=None):
+        """Starts tracking a (just joined or learned of) node, as if it sent a heartbeat.
+           Nodes that are tracked already are left alone."""
+        with self.lock:
+            if address not in self.timers:
+                self.heartbeat([ address ], now)
+
+    def heartbeat(self, addresses, now=None):
+        """Records a batch of heartbeats. Unknown nodes (that never joined) are ignored.
+
+           @param addresses The addresses of the nodes heard of.
+           @param now The current time (defaults to time.monotonic()).
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for address in addresses:
+                node = self.store.get_node(address)
+                if node is None:
+                    continue
+                LIVENESS_HEARTBEATS.inc()
+                self.last_seen[address] = now
+                if address not in self.timers:
+                    self.timers[address] = self.wheel.schedule(self.dangling_after, address)
+                if address in self.demoted:
+                    self.demoted.discard(address)
+                    self.store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_ONLINE)
+                    LIVENESS_TRANSITIONS.inc(_ONLINE)
+
+    def _forget(self, address):
+        self.last_seen.pop(address, None)
+        self.timers.pop(address, None)
+
+    def tick(self, now=None):
+        """Advances the timing wheel and demotes the nodes that went silent.
+
+           @return The number of nodes whose status changed.
+        """
+        now = time.monotonic() if now is None else now
+        changed = 0
+        with self.lock:
+            for address in self.wheel.advance(now):
+                node = self.store.get_node(address)
+                if node is None or (node.status == OverlayNode.OVERLAY_NODE_STATUS_OFFLINE and address not in self.demoted):
+                    self._forget(address) # Left the network
+                    continue
+
+                silence = now - self.last_seen[address]
+                if silence >= self.offline_after:
+                    self.logger.debug("%s went off-line (silent for %.0f seconds)" % (address, silence))
+                    self.store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_OFFLINE)
+                    self.demoted.add(address)
+                    self._forget(address)
+                    LIVENESS_TRANSITIONS.inc(_OFFLINE)
+                    changed += 1
+                    continue
+                if silence >= self.dangling_after:
+                    if node.status != OverlayNode.OVERLAY_NODE_STATUS_DANGLING:
+                        self.store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_DANGLING)
+                        self.demoted.add(address)
+                        LIVENESS_TRANSITIONS.inc(_DANGLING)
+                        changed += 1
+                    delay = self.offline_after - silence
+                else:
+                    delay = self.dangling_after - silence
+                self.timers[address] = self.wheel.schedule(delay, address)
+        return changed
+
+
+def heartbeat_address(node_address):
+    """@return The address of the heartbeat socket of the node at @node_address (the next port)."""
+    (host, port) = node_address.rsplit(":", 1)
+    return "%s:%d" % (host, int(port) + 1)
+
+
+class HeartbeatService(threading.Thread):
+    """Publishes our heartbeats and feeds the ones we receive to a LivenessMonitor."""
+
+    def __init__(self, _configuration, _store, interval=10.0, fanout=32, bootstrap=3, reselect=6):
+        """@param _store The OverlayStore of the overlay service.
+           @param interval Seconds between heartbeats.
+           @param fanout Number of (longest on-line) nodes to send heartbeats to, besides the bootstrap nodes.
+           @param bootstrap Number of (best ranked) bootstrap nodes to send heartbeats to.
+           @param reselect Number of heartbeats between selections of the nodes to send to.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger("jodawg.liveness")
+        self.configuration = _configuration
+        self.store = _store
+        self.interval = interval
+        self.fanout = fanout
+        self.bootstrap = bootstrap
+        self.reselect = reselect
+        self.monitor = LivenessMonitor(_store, 3 * interval, 12 * interval)
+        self.addresses = [ _configuration.get_node_address() ]
+        self.through = None # The node we joined through
+        self.reconnect = False
+        self.running = True
+
+    def terminate(self):
+        self.running = False
+
+    def joined_through(self, address):
+        """Records the node we joined through. It tracks us, so it always gets our heartbeats, starting right away."""
+        self.through = address
+        self.reconnect = True
+
+    def _targets(self):
+        """@return The addresses of the nodes to send heartbeats to, O(fanout + bootstrap nodes)."""
+        targets = set(self.configuration.get_bootstrap_ranking()[:self.bootstrap])
+        targets.update(node.address for node in self.store.get_nodes(self.fanout))
+        if self.through is not None:
+            targets.add(self.through)
+        targets.difference_update(self.addresses)
+        return targets
+
+    def _connect(self, socket, connected):
+        """Connects @socket to the current targets and disconnects it from the ones
+           that are no longer selected.
+
+           @param connected The set of addresses @socket is connected to, updated in place.
+        """
+        targets = self._targets()
+        for address in connected - targets:
+            try:
+                socket.disconnect(heartbeat_address(address))
+            except zmq.ZMQError:
+                pass # Never got through
+        for address in targets - connected:
+            socket.connect(heartbeat_address(address))
+        connected.clear()
+        connected.update(targets)
+
+    def run(self):
+        context = zmq.Context()
+        publisher = context.socket(zmq.PUB)
+        publisher.setsockopt(zmq.LINGER, 0)
+        subscriber = context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        subscriber.bind(heartbeat_address(self.addresses[0]))
+        connected = set()
+        heartbeat = codec.encode_envelope({ "heartbeat" : self.addresses }, codec.CODECS[0], 1)
+
+        beats = 0
+        next_beat = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if now >= next_beat:
+                if beats % self.reselect == 0 or self.reconnect:
+                    self.reconnect = False
+                    self._connect(publisher, connected)
+                publisher.send(heartbeat)
+                beats += 1
+                next_beat = now + self.interval
+
+            # One batch per wake-up
+            batch = set()
+            if subscriber.poll(max(0, min(next_beat - now, 1.0)) * 1000):
+                while True:
+                    try:
+                        (message, wire_codec) = codec.decode_envelope(subscriber.recv(zmq.NOBLOCK))
+                        batch.update(message.get("heartbeat", ()))
+                    except zmq.Again:
+                        break
+                    except Exception:
+                        self.logger.debug("Invalid heartbeat received")
+            if batch:
+                self.monitor.heartbeat(batch)
+            self.monitor.tick()
+
+        publisher.close()
+        subscriber.close()
@@ -0,0 +1,790 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# logstore.py: persistent storage of message logs.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# A SegmentedLog keeps the messages of a log on disk, so neither a restart
+# loses them nor does the heap grow with the log. The directory holds:
+#
+#   00000001.log    Segments: append-only records, the last one is active.
+#                   Record: payload length (4 bytes) | crc32 (4 bytes) | payload
+#                   The payload is a message dictionary (Message.to_dict()) in json.
+#   00000001.time   Time index of a segment, one entry per record:
+#                   max timestamp so far (8) | timestamp (8) | offset (8)
+#   00000001.meta   Summary of a sealed segment (record count, first/last timestamp).
+#   locations.idx   Memory-mapped hash table (identifier, revision) -> (segment, offset, timestamp)
+#   latest.idx      Memory-mapped hash table identifier -> latest revision
+#   sync.idx        The sync keys, sorted (see StoredSyncIndex):
+#                   timestamp (8) | identifier (16) | revision (8) | key hash (8)
+#
+# Only a bounded window of recently used messages is kept in memory, and of
+# the sync index only a digest per block of keys.
+#
+# A segment is sealed once it reaches the rollover size. compact() rewrites
+# sealed segments without the revisions that were superseded by a later one.
+#
+# Recovery: the active segment is rescanned on open (a torn record at its
+# end is cut off) and re-indexed. If a compaction was interrupted, the
+# indexes are rebuilt from all segments. The sync index is rebuilt when it
+# does not hold as many keys as the locations index.
+
+import os
+import json
+import mmap
+import uuid
+import zlib
+import heapq
+import bisect
+import struct
+import hashlib
+import logging
+import threading
+
+from lib import codec
+from lib import logsync
+from lib.cache import LRUCache
+
+_RECORD = struct.Struct("!II")
+_TIME_ENTRY = struct.Struct("!ddQ")
+_REVISION = struct.Struct("!Q")
+_SYNC_ENTRY = struct.Struct("!d16sQQ")
+
+
+class HashIndex(object):
+    """A fixed-width hash table (open addressing, linear probing) in a
+       memory-mapped file. It doubles (and is rewritten) when it gets 70% full.
+
+       File layout: magic (4 bytes) | capacity (8) | used slots (8) | deleted slots (8) | slots
+       Slot layout: state (1 byte: 0 empty, 1 used, 2 deleted) | key | value
+    """
+
+    MAGIC = b"JDX\x01"
+    EMPTY = 0
+    USED = 1
+    DELETED = 2
+
+    _HEADER = struct.Struct("!4sQQQ")
+
+    __slots__ = [ "path", "key_size", "value", "slot", "file", "map", "capacity", "used", "deleted" ]
+
+    def __init__(self, path, key_size, value_format, capacity=4096):
+        """Opens (or creates) an index.
+
+           @param path The file to keep the index in.
+           @param key_size The key length in bytes.
+           @param value_format The struct format of the values (network byte order).
+           @param capacity The initial number of slots of a new index.
+        """
+        self.path = path
+        self.key_size = key_size
+        self.value = struct.Struct("!" + value_format)
+        self.slot = struct.Struct("!B%ds%s" % (key_size, value_format))
+        if not os.path.exists(path):
+            self._create(path, capacity)
+        self._open()
+
+    def _create(self, path, capacity):
+        with open(path, "wb") as f:
+            f.write(self._HEADER.pack(self.MAGIC, capacity, 0, 0))
+            f.truncate(self._HEADER.size + capacity * self.slot.size)
+
+    def _open(self):
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        (magic, self.capacity, self.used, self.deleted) = self._HEADER.unpack_from(self.map)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not an index file" % (self.path))
+
+    def _write_header(self):
+        self._HEADER.pack_into(self.map, 0, self.MAGIC, self.capacity, self.used, self.deleted)
+
+    def _probe(self, key):
+        """@return A tuple (offset of the slot holding @key or None, offset of the first free slot)."""
+        start = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') % self.capacity
+        free = None
+        for i in range(self.capacity):
+            offset = self._HEADER.size + ((start + i) % self.capacity) * self.slot.size
+            state = self.map[offset]
+            if state == self.EMPTY:
+                return (None, offset if free is None else free)
+            if state == self.USED and self.map[offset + 1:offset + 1 + self.key_size] == key:
+                return (offset, free)
+            if state == self.DELETED and free is None:
+                free = offset
+        return (None, free)
+
+    def get(self, key):
+        (offset, free) = self._probe(key)
+        if offset is None:
+            return None
+        return self.value.unpack_from(self.map, offset + 1 + self.key_size)
+
+    def put(self, key, *value):
+        assert len(key) == self.key_size
+        (offset, free) = self._probe(key)
+        if offset is None:
+            if free is None or (self.used + self.deleted + 1) * 10 > self.capacity * 7:
+                self._grow()
+                (offset, free) = self._probe(key)
+            offset = free
+            if self.map[offset] == self.DELETED:
+                self.deleted -= 1
+            self.used += 1
+            self._write_header()
+        self.slot.pack_into(self.map, offset, self.USED, key, *value)
+
+    def delete(self, key):
+        (offset, free) = self._probe(key)
+        if offset is not None:
+            self.map[offset] = self.DELETED
+            self.used -= 1
+            self.deleted += 1
+            self._write_header()
+
+    def items(self):
+        """Iterates over all (key, value) pairs, without loading them all in memory."""
+        for i in range(self.capacity):
+            offset = self._HEADER.size + i * self.slot.size
+            if self.map[offset] == self.USED:
+                fields = self.slot.unpack_from(self.map, offset)
+                yield (fields[1], fields[2:])
+
+    def __len__(self):
+        return self.used
+
+    def _grow(self):
+        """Rewrites the index with twice the capacity (dropping deleted slots)."""
+        tmp = self.path + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        grown = HashIndex(tmp, self.key_size, self.value.format[1:], max(self.capacity * 2, (self.used + 1) * 2))
+        for (key, value) in self.items():
+            grown.put(key, *value)
+        grown.flush()
+        grown.close()
+        self.close()
+        os.replace(tmp, self.path)
+        self._open()
+
+    def clear(self):
+        capacity = self.capacity
+        self.close()
+        os.remove(self.path)
+        self._create(self.path, capacity)
+        self._open()
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Segment(object):
+    """One segment file of a SegmentedLog, with its time index."""
+
+    __slots__ = [ "number", "path", "time_path", "meta_path", "size", "count", "first", "last", "max_timestamp",
+                  "fd", "appender", "time_appender" ]
+
+    def __init__(self, directory, number, suffix=""):
+        self.number = number
+        base = os.path.join(directory, "%08d%s" % (number, suffix))
+        (self.path, self.time_path, self.meta_path) = (base + ".log", base + ".time", base + ".meta")
+        self.size = 0
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.max_timestamp = float("-inf")
+        self.fd = None
+        self.appender = None
+        self.time_appender = None
+
+    def open(self):
+        """Opens the segment for reading."""
+        if not os.path.exists(self.path):
+            open(self.path, "ab").close()
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def open_for_append(self):
+        self.appender = open(self.path, "ab")
+        self.time_appender = open(self.time_path, "ab")
+
+    def load_meta(self):
+        """@return True if the segment summary was loaded from its .meta file."""
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return False
+        (self.count, self.first, self.last, self.max_timestamp) = (meta["count"], meta["first"], meta["last"], meta["max_timestamp"])
+        return True
+
+    def seal(self):
+        """Closes the segment for appending, and writes its summary."""
+        for f in (self.appender, self.time_appender):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        (self.appender, self.time_appender) = (None, None)
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({ "count" : self.count, "first" : self.first, "last" : self.last, "max_timestamp" : self.max_timestamp }, f)
+        os.replace(tmp, self.meta_path)
+
+    def append(self, payload, timestamp):
+        """Appends a record.
+
+           @return The offset of the record.
+        """
+        offset = self.size
+        self.appender.write(_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.max_timestamp = max(self.max_timestamp, timestamp)
+        self.time_appender.write(_TIME_ENTRY.pack(self.max_timestamp, timestamp, offset))
+        self.size += _RECORD.size + len(payload)
+        self.count += 1
+        self.first = timestamp if self.first is None else min(self.first, timestamp)
+        self.last = timestamp if self.last is None else max(self.last, timestamp)
+        return offset
+
+    def flush(self, sync=False):
+        for f in (self.appender, self.time_appender):
+            if f is not None:
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+
+    def read(self, offset):
+        """@return The payload of the record at @offset."""
+        header = os.pread(self.fd, _RECORD.size, offset)
+        (length, crc) = _RECORD.unpack(header)
+        payload = os.pread(self.fd, length, offset + _RECORD.size)
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise IOError("corrupt record at %s:%d" % (self.path, offset))
+        return payload
+
+    def scan(self):
+        """Iterates over the valid records as (offset, payload), stopping at the first torn or corrupt one."""
+        offset = 0
+        size = os.fstat(self.fd).st_size
+        while offset + _RECORD.size <= size:
+            (length, crc) = _RECORD.unpack(os.pread(self.fd, _RECORD.size, offset))
+            payload = os.pread(self.fd, length, offset + _RECORD.size)
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            yield (offset, payload)
+            offset += _RECORD.size + length
+
+    def time_entries(self, start):
+        """Iterates over the time index entries (timestamp, offset) that may
+           hold a timestamp >= @start (binary search on max timestamp so far)."""
+        if not os.path.exists(self.time_path) or os.path.getsize(self.time_path) == 0:
+            return
+        with open(self.time_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                n = len(m) // _TIME_ENTRY.size
+                (lo, hi) = (0, n)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if _TIME_ENTRY.unpack_from(m, mid * _TIME_ENTRY.size)[0] < start:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                for i in range(lo, n):
+                    (max_so_far, timestamp, offset) = _TIME_ENTRY.unpack_from(m, i * _TIME_ENTRY.size)
+                    yield (timestamp, offset)
+
+    def close(self):
+        for f in (self.appender, self.time_appender):
+            if f is not None:
+                f.close()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.time_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class StoredSyncIndex(object):
+    """The sorted sync keys of a SegmentedLog in a file, with the interface of
+       logsync.SyncIndex. Kept in memory are the XOR of the key hashes before
+       every BLOCK-th entry, and the keys that did not arrive in order. Those
+       are merged into the file once there are MAX_PENDING of them, and on
+       flush(). A fingerprint reads at most 2 * BLOCK entries.
+    """
+
+    BLOCK = 256
+    MAX_PENDING = 4096
+    _CHUNK = 4096 # Entries per read when streaming the file
+
+    __slots__ = [ "path", "fd", "count", "blocks", "total", "last", "pending", "lock" ]
+
+    def __init__(self, path):
+        """Opens (or creates) a sync index.
+
+           @param path The file to keep the sorted keys in.
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.pending = logsync.SyncIndex()
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.count = os.fstat(self.fd).st_size // _SYNC_ENTRY.size # A torn entry is overwritten
+        self.blocks = [ 0 ]
+        self.total = 0
+        self.last = None
+        for (i, (key, h)) in enumerate(self._entries(0, self.count)):
+            if self.last is not None and key <= self.last:
+                self.count = i # Not written in order (a crash), the log rebuilds the rest
+                break
+            self.total ^= h
+            if (i + 1) % self.BLOCK == 0:
+                self.blocks.append(self.total)
+            self.last = key
+
+    def _entries(self, lo, hi):
+        """Iterates over the (key, hash) entries in [@lo, @hi) of the file."""
+        for start in range(lo, hi, self._CHUNK):
+            data = os.pread(self.fd, (min(hi, start + self._CHUNK) - start) * _SYNC_ENTRY.size, start * _SYNC_ENTRY.size)
+            for (timestamp, identifier, revision, h) in _SYNC_ENTRY.iter_unpack(data):
+                yield ((timestamp, str(uuid.UUID(bytes=identifier)), revision), h)
+
+    def _key_at(self, i):
+        (timestamp, identifier, revision, h) = _SYNC_ENTRY.unpack(os.pread(self.fd, _SYNC_ENTRY.size, i * _SYNC_ENTRY.size))
+        return (timestamp, str(uuid.UUID(bytes=identifier)), revision)
+
+    def _position(self, key):
+        """@return The number of entries in the file that are smaller than @key."""
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _xor(self, position):
+        """@return The XOR of the hashes of the first @position entries."""
+        block = position // self.BLOCK
+        x = self.blocks[block]
+        for (key, h) in self._entries(block * self.BLOCK, position):
+            x ^= h
+        return x
+
+    def _bounds(self, lower, upper):
+        lo = 0 if lower is None else self._position(lower)
+        hi = self.count if upper is None else self._position(upper)
+        return (lo, max(lo, hi))
+
+    def _append(self, key, h):
+        os.pwrite(self.fd, _SYNC_ENTRY.pack(key[0], uuid.UUID(key[1]).bytes, key[2], h), self.count * _SYNC_ENTRY.size)
+        self.total ^= h
+        self.count += 1
+        if self.count % self.BLOCK == 0:
+            self.blocks.append(self.total)
+        self.last = key
+
+    def _in_file(self, key):
+        i = self._position(key)
+        return i < self.count and self._key_at(i) == key
+
+    def add(self, key):
+        """Adds a sync key, appending (the common case) writes one entry."""
+        with self.lock:
+            if self.last is None or key > self.last:
+                self._append(key, logsync.key_hash(key))
+            elif key not in self:
+                self.pending.add(key)
+                if len(self.pending) >= self.MAX_PENDING:
+                    self._rewrite(self._merged())
+
+    def update(self, keys):
+        """Adds a number of sync keys, those that don't arrive in order are merged into the file at most once."""
+        with self.lock:
+            late = []
+            for key in sorted(set(keys)):
+                if self.last is None or key > self.last:
+                    self._append(key, logsync.key_hash(key))
+                elif key not in self:
+                    late.append(key)
+            self.pending.update(late)
+            if len(self.pending) >= self.MAX_PENDING:
+                self._rewrite(self._merged())
+
+    def remove(self, keys):
+        """Removes a number of sync keys (rewriting the file once)."""
+        with self.lock:
+            keys = set(keys)
+            self.pending.remove(keys)
+            if any(self._in_file(key) for key in keys):
+                self._rewrite((key, h) for (key, h) in self._merged() if key not in keys)
+
+    def _merged(self):
+        """@return The (key, hash) entries of the file and the pending keys, in order."""
+        pending = [ (key, logsync.key_hash(key)) for key in self.pending.keys ]
+        return heapq.merge(self._entries(0, self.count), pending, key=lambda entry: entry[0])
+
+    def _rewrite(self, entries):
+        """Replaces the file by the sorted (key, hash) @entries, and clears the pending keys."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for (key, h) in entries:
+                f.write(_SYNC_ENTRY.pack(key[0], uuid.UUID(key[1]).bytes, key[2], h))
+            f.flush()
+            os.fsync(f.fileno())
+        os.close(self.fd)
+        os.replace(tmp, self.path)
+        self.pending = logsync.SyncIndex()
+        self._open()
+
+    def rebuild(self, keys):
+        """Replaces the index by @keys (sorted in memory, used on recovery only)."""
+        with self.lock:
+            self._rewrite((key, logsync.key_hash(key)) for key in sorted(set(keys)))
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.pending or self._in_file(key)
+
+    def fingerprint(self, lower, upper):
+        """@return A tuple (count, hex digest) of the keys in [@lower, @upper)."""
+        with self.lock:
+            (lo, hi) = self._bounds(lower, upper)
+            (count, digest) = self.pending.fingerprint(lower, upper)
+            return (hi - lo + count, "%016x" % (self._xor(hi) ^ self._xor(lo) ^ int(digest, 16)))
+
+    def keys_in(self, lower, upper):
+        with self.lock:
+            (lo, hi) = self._bounds(lower, upper)
+            return list(heapq.merge([ key for (key, h) in self._entries(lo, hi) ], self.pending.keys_in(lower, upper)))
+
+    def split(self, lower, upper, parts=logsync.FANOUT):
+        """Splits [@lower, @upper) in up to @parts subranges, at keys in the file
+           (or at pending keys, if the range holds more of those).
+
+           @return A list of (lower, upper) tuples, together covering the range.
+        """
+        with self.lock:
+            (lo, hi) = self._bounds(lower, upper)
+            if self.pending.fingerprint(lower, upper)[0] > hi - lo:
+                return self.pending.split(lower, upper, parts)
+            step = max(1, -(-(hi - lo) // parts))
+            bounds = [ lower ] + [ self._key_at(i) for i in range(lo + step, hi, step) ] + [ upper ]
+            return list(zip(bounds[:-1], bounds[1:]))
+
+    def ranges(self, bounds):
+        """@return The wire ranges for a list of (lower, upper) tuples."""
+        return [ [ lower, upper ] + list(self.fingerprint(lower, upper)) for (lower, upper) in bounds ]
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) > 0:
+                self._rewrite(self._merged())
+            os.fsync(self.fd)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            os.close(self.fd)
+
+
+def _key(identifier, revision):
+    return uuid.UUID(identifier).bytes + _REVISION.pack(revision)
+
+
+class SegmentedLog(object):
+    """Disk-backed storage for the messages of one message log."""
+
+    __slots__ = [ "logger", "directory", "segment_bytes", "sync", "segments", "locations", "latest", "sync_index", "hot", "lock" ]
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, hot_window=1024, sync=False):
+        """Opens (or creates) a log.
+
+           @param directory The directory to keep the log in.
+           @param segment_bytes Segments are sealed and a new one is started beyond this size.
+           @param hot_window Number of recently used messages kept in memory.
+           @param sync If True every append is fsync'ed, otherwise only flush() is.
+        """
+        self.logger = logging.getLogger("jodawg.logstore")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self.hot = LRUCache(hot_window)
+        self.lock = threading.RLock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.locations = HashIndex(os.path.join(directory, "locations.idx"), 24, "IQd")
+        self.latest = HashIndex(os.path.join(directory, "latest.idx"), 16, "Q")
+        self.sync_index = StoredSyncIndex(os.path.join(directory, "sync.idx"))
+        self.segments = []
+        self._recover()
+
+    def _recover(self):
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log") and name[:-4].isdigit())
+        for number in numbers:
+            segment = Segment(self.directory, number)
+            segment.open()
+            self.segments.append(segment)
+
+        marker = os.path.join(self.directory, "compacting")
+        rebuild = os.path.exists(marker)
+        if rebuild:
+            # An interrupted compaction, the indexes can't be trusted
+            self.logger.warning("Rebuilding the indexes of %s" % (self.directory))
+            self.locations.clear()
+            self.latest.clear()
+            rescan = self.segments
+        else:
+            rescan = self.segments[-1:]
+
+        for segment in self.segments[:-1]:
+            if segment not in rescan and not segment.load_meta():
+                rescan.append(segment)
+        for segment in rescan:
+            self._rescan(segment, segment is self.segments[-1])
+
+        if not self.segments:
+            self._new_segment()
+        self.segments[-1].open_for_append()
+        if rebuild or len(self.sync_index) != len(self.locations):
+            self.logger.warning("Rebuilding the sync index of %s" % (self.directory))
+            self.sync_index.rebuild(self.keys())
+        self._flush_indexes()
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    def _rescan(self, segment, active):
+        """Re-indexes a segment, cutting off a torn record at the end of the active one."""
+        (segment.count, segment.first, segment.last, segment.max_timestamp) = (0, None, None, float("-inf"))
+        entries = []
+        end = 0
+        for (offset, payload) in segment.scan():
+            d = codec.JSON.decode(payload)
+            self._index(segment, offset, d)
+            segment.count += 1
+            segment.max_timestamp = max(segment.max_timestamp, d["timestamp"])
+            segment.first = d["timestamp"] if segment.first is None else min(segment.first, d["timestamp"])
+            segment.last = d["timestamp"] if segment.last is None else max(segment.last, d["timestamp"])
+            entries.append(_TIME_ENTRY.pack(segment.max_timestamp, d["timestamp"], offset))
+            end = offset + _RECORD.size + len(payload)
+
+        if end < segment.size:
+            self.logger.warning("Cutting off %d bytes of torn records from %s" % (segment.size - end, segment.path))
+            os.truncate(segment.path, end)
+            segment.size = end
+        with open(segment.time_path, "wb") as f:
+            f.write(b"".join(entries))
+        if not active:
+            segment.seal()
+
+    def _index(self, segment, offset, d):
+        key = _key(d["identifier"], d["revision"])
+        self.locations.put(key, segment.number, offset, d["timestamp"])
+        latest = self.latest.get(key[:16])
+        if latest is None or latest[0] < d["revision"]:
+            self.latest.put(key[:16], d["revision"])
+
+    def _new_segment(self):
+        segment = Segment(self.directory, self.segments[-1].number + 1 if self.segments else 1)
+        segment.open()
+        self.segments.append(segment)
+        return segment
+
+    def _segment(self, number):
+        i = bisect.bisect_left([ s.number for s in self.segments ], number)
+        if i < len(self.segments) and self.segments[i].number == number:
+            return self.segments[i]
+        return None
+
+    def _flush_indexes(self):
+        self.locations.flush()
+        self.latest.flush()
+        self.sync_index.flush()
+
+    def append(self, message):
+        """Appends a message.
+
+           @param message The message dictionary (see Message.to_dict()).
+           @return The sync key of the message.
+        """
+        return self.extend([ message ])[0]
+
+    def extend(self, messages):
+        """Appends a number of messages (e.g. fetched from a peer), flushing and
+           updating the sync index once.
+
+           @param messages A list of message dictionaries (see Message.to_dict()).
+           @return The sync keys of the messages.
+        """
+        payloads = [ codec.JSON.encode(message) for message in messages ]
+        sync_keys = []
+        with self.lock:
+            active = self.segments[-1]
+            for (message, payload) in zip(messages, payloads):
+                if active.count > 0 and active.size + _RECORD.size + len(payload) > self.segment_bytes:
+                    # Rollover
+                    active.seal()
+                    active = self._new_segment()
+                    active.open_for_append()
+                    self.logger.debug("Started segment %d" % (active.number))
+
+                offset = active.append(payload, message["timestamp"])
+                self._index(active, offset, message)
+                sync_keys.append((message["timestamp"], message["identifier"], message["revision"]))
+                self.hot.put(_key(message["identifier"], message["revision"]), message)
+            active.flush(self.sync)
+            if len(sync_keys) == 1:
+                self.sync_index.add(sync_keys[0])
+            else:
+                self.sync_index.update(sync_keys)
+        return sync_keys
+
+    def get(self, identifier, revision):
+        """@return The message dictionary with the given identifier and revision, or None."""
+        key = _key(identifier, revision)
+        message = self.hot.get(key)
+        if message is not None:
+            return message
+        with self.lock:
+            location = self.locations.get(key)
+            if location is None:
+                return None
+            message = codec.JSON.decode(self._segment(location[0]).read(location[1]))
+        self.hot.put(key, message)
+        return message
+
+    def contains(self, identifier, revision):
+        with self.lock:
+            return self.locations.get(_key(identifier, revision)) is not None
+
+    def latest_revision(self, identifier):
+        """@return The highest revision stored of a message, or None."""
+        with self.lock:
+            latest = self.latest.get(uuid.UUID(identifier).bytes)
+        return None if latest is None else latest[0]
+
+    def keys(self):
+        """Iterates over the sync keys (timestamp, identifier, revision) of all stored messages."""
+        with self.lock:
+            items = list(self.locations.items())
+        for (key, (number, offset, timestamp)) in items:
+            yield (timestamp, str(uuid.UUID(bytes=key[:16])), _REVISION.unpack(key[16:])[0])
+
+    def read_range(self, start, end):
+        """Reads the messages with a timestamp in [@start, @end), in storage order.
+
+           @return A generator of message dictionaries.
+        """
+        with self.lock:
+            segments = [ s for s in self.segments if s.count > 0 and s.max_timestamp >= start and s.first < end ]
+            self.segments[-1].flush()
+        for segment in segments:
+            with self.lock:
+                if segment.fd is None:
+                    continue # compacted away
+                payloads = [ segment.read(offset) for (timestamp, offset) in segment.time_entries(start) if start <= timestamp < end ]
+            for payload in payloads:
+                yield codec.JSON.decode(payload)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def compact(self):
+        """Rewrites the sealed segments without superseded revisions.
+
+           @return The sync keys of the messages that were removed.
+        """
+        removed = []
+        with self.lock:
+            marker = os.path.join(self.directory, "compacting")
+            open(marker, "w").close()
+            for segment in list(self.segments[:-1]):
+                removed.extend(self._compact(segment))
+            self.sync_index.remove(removed)
+            self._flush_indexes()
+            os.remove(marker)
+        if removed:
+            self.logger.debug("Compaction removed %d superseded revisions" % (len(removed)))
+        return removed
+
+    def _compact(self, segment):
+        kept = []
+        dropped = []
+        for (offset, payload) in segment.scan():
+            d = codec.JSON.decode(payload)
+            if self.latest.get(uuid.UUID(d["identifier"]).bytes)[0] > d["revision"]:
+                dropped.append(d)
+            else:
+                kept.append((payload, d))
+        if not dropped:
+            return []
+
+        for d in dropped:
+            key = _key(d["identifier"], d["revision"])
+            self.locations.delete(key)
+            self.hot.pop(key)
+
+        if not kept:
+            segment.remove()
+            self.segments.remove(segment)
+        else:
+            compacted = Segment(self.directory, segment.number, ".compact")
+            compacted.remove()
+            compacted.open_for_append()
+            offsets = [ compacted.append(payload, d["timestamp"]) for (payload, d) in kept ]
+            compacted.seal()
+            segment.close()
+            os.replace(compacted.path, segment.path)
+            os.replace(compacted.time_path, segment.time_path)
+            os.replace(compacted.meta_path, segment.meta_path)
+            segment.load_meta()
+            segment.open()
+            for (offset, (payload, d)) in zip(offsets, kept):
+                self.locations.put(_key(d["identifier"], d["revision"]), segment.number, offset, d["timestamp"])
+
+        return [ (d["timestamp"], d["identifier"], d["revision"]) for d in dropped ]
+
+    def flush(self):
+        """Makes everything appended so far durable."""
+        with self.lock:
+            self.segments[-1].flush(True)
+            self._flush_indexes()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            for segment in self.segments:
+                segment.close()
+            self.locations.close()
+            self.latest.close()
+            self.sync_index.close()
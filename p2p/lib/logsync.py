@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# logsync.py: incremental synchronization of message logs.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Two copies of a message log are synchronized by range-based set
+# reconciliation. Every message is identified by a sync key:
+#
+#   (timestamp, identifier, revision)
+#
+# Keys are kept sorted, so messages that arrived while a device was offline
+# sit together at the end. The fingerprint of a range of keys is their count
+# and the XOR of their hashes, which a prefix XOR array answers in O(log n).
+#
+# The initiator sends the fingerprints of some ranges (at first: everything).
+# The responder skips the ranges whose fingerprint matches its own. Of the
+# others it either lists its keys (small ranges) or sends the fingerprints of
+# FANOUT subranges, which the initiator compares in the next round. Only the
+# differing part of the logs is ever descended into, and the missing
+# messages are then fetched in bounded batches.
+#
+# On the wire a range is [ lower, upper, count, digest ]: the keys k with
+# lower <= k < upper, where None is unbounded, and the digest is in hex.
+
+import heapq
+import bisect
+import hashlib
+
+LEAF_SIZE = 32      # Ranges with at most this many keys are listed, not split
+FANOUT = 16         # Subranges per split range
+MAX_RANGES = 64     # Ranges per synchronize request
+FETCH_BATCH = 128   # Messages per fetch request
+
+
+def key_hash(key):
+    """@return The 64-bit hash of a sync key that fingerprints combine."""
+    data = ("%r:%s:%d" % key).encode('utf-8')
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], 'big')
+
+
+def _key(value):
+    return None if value is None else (value[0], value[1], value[2])
+
+
+class SyncIndex(object):
+    """The sorted sync keys of a message log, with range fingerprints."""
+
+    __slots__ = [ "keys", "prefix" ]
+
+    def __init__(self, keys=()):
+        self.keys = sorted(set(keys))
+        self.prefix = [ 0 ]
+        self._rebuild(0)
+
+    def _rebuild(self, start):
+        del self.prefix[start + 1:]
+        for key in self.keys[start:]:
+            self.prefix.append(self.prefix[-1] ^ key_hash(key))
+
+    def add(self, key):
+        """Adds a sync key, appending (the common case) is O(1)."""
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return
+        self.keys.insert(i, key)
+        if i == len(self.keys) - 1:
+            self.prefix.append(self.prefix[-1] ^ key_hash(key))
+        else:
+            self._rebuild(i)
+
+    def update(self, keys):
+        """Adds a number of sync keys (e.g. fetched from a peer), rebuilding the fingerprints once."""
+        keys = [ key for key in sorted(set(keys)) if key not in self ]
+        if not keys:
+            return
+        start = bisect.bisect_left(self.keys, keys[0])
+        self.keys[start:] = list(heapq.merge(self.keys[start:], keys))
+        self._rebuild(start)
+
+    def remove(self, keys):
+        """Removes a number of sync keys (rebuilding the fingerprints once)."""
+        keys = set(keys)
+        remaining = [ key for key in self.keys if key not in keys ]
+        if len(remaining) != len(self.keys):
+            self.keys = remaining
+            self._rebuild(0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def _bounds(self, lower, upper):
+        lo = 0 if lower is None else bisect.bisect_left(self.keys, lower)
+        hi = len(self.keys) if upper is None else bisect.bisect_left(self.keys, upper)
+        return (lo, max(lo, hi))
+
+    def fingerprint(self, lower, upper):
+        """@return A tuple (count, hex digest) of the keys in [@lower, @upper)."""
+        (lo, hi) = self._bounds(lower, upper)
+        return (hi - lo, "%016x" % (self.prefix[hi] ^ self.prefix[lo]))
+
+    def keys_in(self, lower, upper):
+        (lo, hi) = self._bounds(lower, upper)
+        return self.keys[lo:hi]
+
+    def split(self, lower, upper, parts=FANOUT):
+        """Splits [@lower, @upper) in up to @parts subranges with about as many keys each.
+
+           @return A list of (lower, upper) tuples, together covering the range.
+        """
+        (lo, hi) = self._bounds(lower, upper)
+        step = max(1, -(-(hi - lo) // parts))
+        bounds = [ lower ] + [ self.keys[i] for i in range(lo + step, hi, step) ] + [ upper ]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def ranges(self, bounds):
+        """@return The wire ranges for a list of (lower, upper) tuples."""
+        return [ [ lower, upper ] + list(self.fingerprint(lower, upper)) for (lower, upper) in bounds ]
+
+
+def respond(index, ranges):
+    """Handles a synchronize request on the responder side.
+
+       @param index Our SyncIndex.
+       @param ranges The wire ranges sent by the initiator.
+       @return A dictionary with "ranges" (subranges to compare next) and
+               "keys" (a list of [ lower, upper, our keys ] for small ranges).
+    """
+    reply_ranges = []
+    reply_keys = []
+    for (lower, upper, count, digest) in ranges[:MAX_RANGES]:
+        (lower, upper) = (_key(lower), _key(upper))
+        (own_count, own_digest) = index.fingerprint(lower, upper)
+        if own_count == count and own_digest == digest:
+            continue
+        if own_count <= LEAF_SIZE:
+            reply_keys.append([ lower, upper, index.keys_in(lower, upper) ])
+        else:
+            reply_ranges.extend(index.ranges(index.split(lower, upper)))
+    return { "ranges" : reply_ranges, "keys" : reply_keys }
+
+
+def reconcile(index, exchange):
+    """Finds the differences with a remote copy of a log (initiator side).
+
+       @param index Our SyncIndex.
+       @param exchange A callable that sends a list of wire ranges to the
+                       responder and returns its respond() dictionary.
+       @return A tuple (missing, surplus): the keys only the responder has,
+               and the keys only we have.
+    """
+    queue = [ (None, None) ]
+    missing = []
+    surplus = []
+    while queue:
+        batch = queue[:MAX_RANGES]
+        del queue[:MAX_RANGES]
+        response = exchange(index.ranges(batch))
+
+        for (lower, upper, count, digest) in response.get("ranges", []):
+            (lower, upper) = (_key(lower), _key(upper))
+            if index.fingerprint(lower, upper) != (count, digest):
+                queue.append((lower, upper))
+
+        for (lower, upper, keys) in response.get("keys", []):
+            theirs = set(_key(key) for key in keys)
+            ours = set(index.keys_in(_key(lower), _key(upper)))
+            missing.extend(sorted(theirs - ours))
+            surplus.extend(sorted(ours - theirs))
+
+    return (missing, surplus)
+
+
+def batches(keys, size=FETCH_BATCH):
+    """Splits @keys in fetch batches."""
+    return [ keys[i:i + size] for i in range(0, len(keys), size) ]
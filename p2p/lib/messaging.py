@@ -31,6 +31,28 @@
 #
 # When store and forwarding, multiple peers
 # must be specified as destination. 
+#
+# Group messages are encrypted once, the content key is wrapped for every
+# participant (see multirecipient.py and MessageLog.seal()).
+#
+# A log can hold millions of messages, so MessageLog does not keep them as
+# Message objects (several hundred bytes of object overhead per chat line)
+# but in a columnar MessageTable. Indexing the table yields read-only views
+# that behave like a Message with a MessageHeader.
+# The sync index of such a log (see logsync.py) is kept in columns as well,
+# next to the table: the sync keys are derived from its rows.
+
+import os
+import sys
+import uuid
+import array
+import logging
+import datetime
+
+from lib import logsync
+from lib import connections
+from lib import multirecipient
+from lib.network import Reply
 
 class MessageHeader(object):
     """A message header contains meta-data concerning
@@ -39,7 +61,7 @@ class MessageHeader(object):
     __slots__ = [  "identifier", "revision", "datetime", "fields" ]
 
     def __init__(self):
-        self.identifier = uuid.uuid5(uuid.NAMESPACE_DNS, 'jodawg.org')
+        self.identifier = uuid.uuid4()
         self.revision = 0
         self.datetime = datetime.datetime.now()
         self.fields = {}
@@ -54,9 +76,15 @@ class MessageHeader(object):
         assert name is not None and len(name) > 0
         return self.fields[name]
 
+    @property
+    def sync_key(self):
+        """The key identifying this revision of the message during synchronization (see logsync.py)."""
+        return (self.datetime.timestamp(), str(self.identifier), self.revision)
+
 class MessagePart(object):
     """A message part can be added to a message."""
-    pass
+
+    __slots__ = []
 
 class MessagePartText(MessagePart):
     """A specific message part consisting of only text data."""
@@ -75,7 +103,7 @@ class Message(object):
     __slots__ = [ "header", "parts" ]
 
     def __init__(self, _header=None):
-        if header is not None:
+        if _header is not None:
             self.header = _header
         else:
             self.header = MessageHeader()
@@ -84,28 +112,343 @@ class Message(object):
     def add_part(self, message_part):
         self.parts.append(message_part)
 
+    def to_dict(self):
+        """@return A dictionary representation of the message, for the wire."""
+        h = self.header
+        return { "identifier" : str(h.identifier), "revision" : h.revision, "timestamp" : h.datetime.timestamp(),
+                 "fields" : h.fields, "system" : isinstance(self, SystemMessage),
+                 "parts" : [ part.content for part in self.parts ] }
+
+    @staticmethod
+    def from_dict(d):
+        """Rebuilds a message from its dictionary representation (see to_dict())."""
+        header = MessageHeader()
+        header.identifier = uuid.UUID(d["identifier"])
+        header.revision = d["revision"]
+        header.datetime = datetime.datetime.fromtimestamp(d["timestamp"])
+        header.fields = dict(d["fields"])
+        message = SystemMessage(header) if d.get("system") else Message(header)
+        for content in d["parts"]:
+            message.add_part(MessagePartText(content))
+        return message
+
     def clone_revision(self):
         """Clones the entire message to make a new revision
-           of any of its contents."""
-        # deepcopy
-        # self.header.revision += 1
+           of any of its contents.
+
+           @return A new (modifiable) message with the next revision number.
+        """
+        header = MessageHeader()
+        header.identifier = self.header.identifier
+        header.revision = self.header.revision + 1
+        header.fields = dict(self.header.fields)
+        message = SystemMessage(header) if isinstance(self, SystemMessage) else Message(header)
+        for part in self.parts:
+            message.add_part(MessagePartText(part.content))
+        return message
 
 class SystemMessage(Message):
-    pass
+
+    __slots__ = []
+
+def _to_microseconds(dt):
+    return int(round(dt.timestamp() * 1000000))
+
+def _from_microseconds(us):
+    return datetime.datetime.fromtimestamp(us // 1000000).replace(microsecond=us % 1000000)
+
+class MessageTable(object):
+    """Columnar storage for a batch of messages. Identifiers are kept as
+       16 bytes, timestamps as int64 microseconds, texts as utf-8 in a single
+       buffer, and header fields are shared between rows that have the same
+       ones (e.g. the same sender). Rows are immutable, and can be looked up
+       by identifier and revision through a sorted array of row numbers.
+       Appended rows are merged into that array on the next lookup, so
+       appending stays O(1)."""
+
+    __slots__ = [ "identifiers", "revisions", "timestamps", "system", "part_rows", "part_offsets", "text",
+                  "field_rows", "field_sets", "field_set_numbers", "order" ]
+
+    def __init__(self):
+        self.identifiers = bytearray()            # 16 bytes per row
+        self.revisions = array.array('q')
+        self.timestamps = array.array('q')        # microseconds since the epoch
+        self.system = bytearray()                 # 1 for system messages
+        self.part_rows = array.array('Q', [ 0 ])  # row i has parts part_rows[i] up to part_rows[i + 1]
+        self.part_offsets = array.array('Q', [ 0 ]) # part j is text[part_offsets[j]:part_offsets[j + 1]]
+        self.text = bytearray()
+        self.field_rows = array.array('I')        # row -> number of its field set
+        self.field_sets = [ () ]                  # distinct tuples of (name, value), 0 is no fields
+        self.field_set_numbers = { () : 0 }
+        self.order = array.array('I')             # rows sorted by (identifier, revision), up to the last lookup
+
+    def _row_key(self, row):
+        return (bytes(self.identifiers[16 * row:16 * row + 16]), self.revisions[row])
+
+    def _position(self, key):
+        """@return The position in order of the first row with a (identifier, revision) >= @key."""
+        (lo, hi) = (0, len(self.order))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._row_key(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _merge(self):
+        """Merges the rows appended since the last lookup into order: O(k log n)
+           comparisons for k new rows, plus copying order once."""
+        start = len(self.order)
+        if start == len(self.revisions):
+            return
+        order = array.array('I')
+        previous = 0
+        for row in sorted(range(start, len(self.revisions)), key=self._row_key):
+            i = self._position(self._row_key(row))
+            order.extend(self.order[previous:i])
+            order.append(row)
+            previous = i
+        order.extend(self.order[previous:])
+        self.order = order
+
+    def find(self, identifier, revision):
+        """@param identifier The identifier of a message, as 16 bytes.
+           @return The row of the message with the given identifier and revision, or None.
+        """
+        self._merge()
+        i = self._position((identifier, revision))
+        if i < len(self.order) and self._row_key(self.order[i]) == (identifier, revision):
+            return self.order[i]
+        return None
+
+    def append(self, message):
+        """Copies a message into the table.
+
+           @return The row number of the message.
+        """
+        row = len(self.revisions)
+        header = message.header
+        self.identifiers += header.identifier.bytes
+        self.revisions.append(header.revision)
+        self.timestamps.append(_to_microseconds(header.datetime))
+        self.system.append(1 if isinstance(message, SystemMessage) else 0)
+        for part in message.parts:
+            self.text += part.content.encode('utf-8')
+            self.part_offsets.append(len(self.text))
+        self.part_rows.append(len(self.part_offsets) - 1)
+        fields = tuple(sorted((sys.intern(name), value) for (name, value) in header.fields.items()))
+        number = self.field_set_numbers.get(fields)
+        if number is None:
+            number = self.field_set_numbers[fields] = len(self.field_sets)
+            self.field_sets.append(fields)
+        self.field_rows.append(number)
+        return row
+
+    def sync_key(self, row):
+        """@return The sync key of a row (see MessageHeader.sync_key)."""
+        return (_from_microseconds(self.timestamps[row]).timestamp(), str(uuid.UUID(bytes=bytes(self.identifiers[16 * row:16 * row + 16]))),
+                self.revisions[row])
+
+    def __len__(self):
+        return len(self.revisions)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [ self[i] for i in range(*row.indices(len(self))) ]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("message table index out of range")
+        return SystemMessageView(self, row) if self.system[row] else MessageView(self, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def texts(self, row):
+        offsets = self.part_offsets
+        return [ self.text[offsets[j]:offsets[j + 1]].decode('utf-8') for j in range(self.part_rows[row], self.part_rows[row + 1]) ]
+
+def _read_only(self, value):
+    raise AttributeError("Messages in a MessageTable are read-only, use clone_revision()")
+
+class MessageHeaderView(MessageHeader):
+    """A read-only MessageHeader backed by a row of a MessageTable."""
+
+    __slots__ = [ "table", "row" ]
+
+    def __init__(self, _table, _row):
+        self.table = _table
+        self.row = _row
+
+    identifier = property(lambda self: uuid.UUID(bytes=bytes(self.table.identifiers[16 * self.row:16 * self.row + 16])), _read_only)
+    revision = property(lambda self: self.table.revisions[self.row], _read_only)
+    datetime = property(lambda self: _from_microseconds(self.table.timestamps[self.row]), _read_only)
+    fields = property(lambda self: dict(self.table.field_sets[self.table.field_rows[self.row]]), _read_only)
+
+    def set_field(self, name, value):
+        _read_only(self, value)
+
+class MessageView(Message):
+    """A read-only Message backed by a row of a MessageTable."""
+
+    __slots__ = [ "table", "row" ]
+
+    def __init__(self, _table, _row):
+        self.table = _table
+        self.row = _row
+
+    header = property(lambda self: MessageHeaderView(self.table, self.row), _read_only)
+    parts = property(lambda self: [ MessagePartText(content) for content in self.table.texts(self.row) ], _read_only)
+
+    def add_part(self, message_part):
+        _read_only(self, message_part)
+
+class SystemMessageView(MessageView, SystemMessage):
+
+    __slots__ = []
+
+class TableSyncIndex(object):
+    """The sync index (see logsync.SyncIndex) of the messages in a MessageTable,
+       in columns as well: the rows sorted on sync key, their key hashes and
+       the prefix XOR of those. Sync keys are only built for the wire."""
+
+    __slots__ = [ "table", "rows", "hashes", "prefix" ]
+
+    def __init__(self, _table):
+        self.table = _table
+        self.rows = array.array('I')           # rows of the table, sorted on sync key
+        self.hashes = array.array('Q')         # key hashes, in the same order
+        self.prefix = array.array('Q', [ 0 ])  # prefix[i] is the XOR of hashes[:i]
+        self.update(range(len(_table)))
+
+    def _row_order(self, row):
+        table = self.table
+        return (table.timestamps[row], bytes(table.identifiers[16 * row:16 * row + 16]), table.revisions[row])
+
+    @staticmethod
+    def _order(key):
+        """@return A sync key in the form rows are compared in (which sorts the same)."""
+        return (int(round(key[0] * 1000000)), uuid.UUID(key[1]).bytes, key[2])
+
+    def _position(self, order):
+        """@return The position of the first row whose sync key is >= the one of @order."""
+        (rows, timestamps) = (self.rows, self.table.timestamps)
+        if not rows or self._row_order(rows[-1]) < order:
+            return len(rows) # Appending
+        (lo, hi) = (0, len(rows) - 1)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            timestamp = timestamps[rows[mid]] # Most rows differ in it
+            if timestamp < order[0] or (timestamp == order[0] and self._row_order(rows[mid]) < order):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def add(self, row, key=None):
+        """Adds the sync key of a row, appending (the common case) is O(1).
+
+           @param key The sync key of the row, if at hand (saves building it).
+        """
+        if key is not None and self._position(self._row_order(row)) == len(self.rows):
+            self.rows.append(row)
+            self.hashes.append(logsync.key_hash(key))
+            self.prefix.append(self.prefix[-1] ^ self.hashes[-1])
+        else:
+            self.update([ row ])
+
+    def update(self, rows):
+        """Adds the sync keys of a number of rows, rebuilding the fingerprints once."""
+        rows = sorted(rows, key=self._row_order)
+        if not rows:
+            return
+        start = self._position(self._row_order(rows[0]))
+        if start == len(self.rows): # All of them sort after the ones we have
+            for row in rows:
+                self.rows.append(row)
+                self.hashes.append(logsync.key_hash(self.table.sync_key(row)))
+                self.prefix.append(self.prefix[-1] ^ self.hashes[-1])
+            return
+
+        (merged_rows, merged_hashes) = (array.array('I'), array.array('Q'))
+        previous = 0
+        for row in rows:
+            i = self._position(self._row_order(row))
+            merged_rows.extend(self.rows[previous:i])
+            merged_hashes.extend(self.hashes[previous:i])
+            merged_rows.append(row)
+            merged_hashes.append(logsync.key_hash(self.table.sync_key(row)))
+            previous = i
+        merged_rows.extend(self.rows[previous:])
+        merged_hashes.extend(self.hashes[previous:])
+        (self.rows, self.hashes) = (merged_rows, merged_hashes)
+
+        del self.prefix[start + 1:]
+        fingerprint = self.prefix[start]
+        for h in self.hashes[start:]:
+            fingerprint ^= h
+            self.prefix.append(fingerprint)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        try:
+            order = self._order(key)
+        except (TypeError, ValueError):
+            return False
+        i = self._position(order)
+        return i < len(self.rows) and self._row_order(self.rows[i]) == order
+
+    def _bounds(self, lower, upper):
+        lo = 0 if lower is None else self._position(self._order(lower))
+        hi = len(self.rows) if upper is None else self._position(self._order(upper))
+        return (lo, max(lo, hi))
+
+    def fingerprint(self, lower, upper):
+        """@return A tuple (count, hex digest) of the keys in [@lower, @upper)."""
+        (lo, hi) = self._bounds(lower, upper)
+        return (hi - lo, "%016x" % (self.prefix[hi] ^ self.prefix[lo]))
+
+    def keys_in(self, lower, upper):
+        (lo, hi) = self._bounds(lower, upper)
+        return [ self.table.sync_key(row) for row in self.rows[lo:hi] ]
+
+    def split(self, lower, upper, parts=logsync.FANOUT):
+        """Splits [@lower, @upper) in up to @parts subranges with about as many keys each (see SyncIndex.split())."""
+        (lo, hi) = self._bounds(lower, upper)
+        step = max(1, -(-(hi - lo) // parts))
+        bounds = [ lower ] + [ self.table.sync_key(self.rows[i]) for i in range(lo + step, hi, step) ] + [ upper ]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def ranges(self, bounds):
+        """@return The wire ranges for a list of (lower, upper) tuples."""
+        return [ [ lower, upper ] + list(self.fingerprint(lower, upper)) for (lower, upper) in bounds ]
 
 class MessageLog(object):
     """A message log is a collection of messages.
        intended for two or more participants. A message
        log must be synchronized between nodes associated
-       with the specified participants."""
+       with the specified participants.
 
-    __slots__ = [ "revision", "participants", "messages", "message_tracking" ]
+       By default the messages are kept in memory. When a storage (a
+       SegmentedLog, see logstore.py) is given they are kept on disk
+       instead, and so is their sync index."""
 
-    def __init__(self):
+    __slots__ = [ "identifier", "revision", "participants", "messages", "sync_index", "storage" ]
+
+    def __init__(self, _identifier=None, _storage=None):
+        self.identifier = _identifier if _identifier is not None else str(uuid.uuid4())
         self.participants = set([])
-        self.messages = []
-        self.message_tracking = set([])
-        self.revision = 0
+        self.messages = MessageTable()
+        self.storage = _storage
+        if _storage is not None:
+            self.sync_index = _storage.sync_index # Maintained by the storage
+        else:
+            self.sync_index = TableSyncIndex(self.messages)
+        self.revision = len(self.sync_index)
 
     def add_participant(self, user):
         """Adds a participant to the log.
@@ -122,7 +465,7 @@ class MessageLog(object):
         if len(self.participants) > 2:
             message = SystemMessage()
             message.add_part(MessagePartText("User " + str(user) + " was added"))
-            self.add_message(message) # This also increases the revision, forcing everyone to sync
+            self.append_message(message) # This also increases the revision, forcing everyone to sync
         else:
             self.revision += 1
 
@@ -137,7 +480,7 @@ class MessageLog(object):
 
         message = SystemMessage()
         message.add_part(MessagePartText("User " + str(user) + " was removed"))
-        self.add_message(message) # This also increases the revision, forcing everyone to sync
+        self.append_message(message) # This also increases the revision, forcing everyone to sync
 
     def append_message(self, message):
         """Appends a new message to the end of the log.
@@ -152,14 +495,203 @@ class MessageLog(object):
         assert len(self.participants) > 1 
 
         # Can't add the same message, same revision twice
-        assert (message.header.identifier, message.header.revision) not in self.message_tracking
+        assert message.header.sync_key not in self.sync_index
 
-        self.messages.append(message)
-        self.message_tracking.add((message.header.identifier, message.header.revision))
+        if self.storage is not None:
+            self.storage.append(message.to_dict())
+        else:
+            self.sync_index.add(self.messages.append(message), message.header.sync_key)
         self.revision += 1
 
-class MessagingService():
+    def append_messages(self, messages):
+        """Appends a batch of messages (e.g. fetched from a peer) at once: the sync
+           index is updated once. Messages the log holds already, or holds a later
+           revision of, are skipped.
 
-    def __init__(self):
-        pass
+           @return The number of messages appended.
+        """
+        assert len(self.participants) > 1
+
+        new = {} # sync key -> message
+        for message in messages:
+            sync_key = message.header.sync_key
+            if sync_key not in new and sync_key not in self.sync_index and not self.is_superseded(message):
+                new[sync_key] = message
+
+        if self.storage is not None:
+            self.storage.extend([ message.to_dict() for message in new.values() ])
+        else:
+            self.sync_index.update([ self.messages.append(message) for message in new.values() ])
+        self.revision += len(new)
+        return len(new)
+
+    def get_message(self, sync_key):
+        """@return The message with the given sync key, or None."""
+        if self.storage is not None:
+            d = self.storage.get(sync_key[1], sync_key[2])
+            return None if d is None else Message.from_dict(d)
+        row = self.messages.find(uuid.UUID(sync_key[1]).bytes, sync_key[2])
+        return None if row is None else self.messages[row]
+
+    def is_superseded(self, message):
+        """@return True if the log holds a later revision of @message."""
+        if self.storage is not None:
+            latest = self.storage.latest_revision(str(message.header.identifier))
+            return latest is not None and latest > message.header.revision
+        return False
+
+    def compact(self):
+        """Drops the superseded revisions from the storage (if any).
+
+           @return The number of messages dropped.
+        """
+        if self.storage is None:
+            return 0
+        return len(self.storage.compact())
+
+    def seal(self, encryption, plaintext, public_keys_of, pool=None):
+        """Encrypts a (serialized) message once for all participants.
+
+           @param encryption The Encryption object to use.
+           @param plaintext The bytes to encrypt.
+           @param public_keys_of A callable returning the public keys of a
+                                 participant (one per machine the user is on).
+           @param pool A CryptoPool to spread the key wrapping over, or None.
+           @return A tuple (envelope, failed), see multirecipient.seal().
+        """
+        public_keys = []
+        for user in self.participants:
+            public_keys.extend(public_keys_of(user))
+        return multirecipient.seal(encryption, plaintext, public_keys, pool)
+
+def access_statement(node_address, log, nonce):
+    """@return What a user signs to let the node at @node_address read @log (bytes)."""
+    return ("%s reads %s %s" % (node_address, log, nonce)).encode('utf-8')
+
+class MessagingService(object):
+    """Synchronizes message logs between nodes.
+
+       A node pulls the messages it misses from a peer in two steps: it
+       reconciles the sync keys of the log (message-log-synchronize, see
+       logsync.py), then fetches the missing messages in batches
+       (message-log-fetch). Peers must have joined the overlay, and prove
+       they act for a participant of the log: the user signs the node
+       address, the log and a nonce (see access_statement()). Replies are
+       encrypted with the public key the overlay knows the node by.
+    """
+
+    def __init__(self, _configuration, _encryption, _store, _connections=None, _user_keys=None):
+        """@param _store The OverlayStore to look up peers in.
+           @param _connections The ConnectionManager to send requests through (the one of the process by default).
+           @param _user_keys A callable returning the (raw) public keys a user signs with. Without
+                             it, logs are never served: the request handlers are not registered.
+        """
+        self.logger = logging.getLogger("jodawg.messaging")
+        self.configuration = _configuration
+        self.encryption = _encryption
+        self.store = _store
+        self.connections = _connections
+        self.user_keys = _user_keys
+        self.logs = {}
+
+    def add_log(self, log):
+        self.logs[log.identifier] = log
+
+    def request_handlers(self):
+        if self.user_keys is None:
+            return {} # Users' keys are not known yet (see account.py), so no request could prove anything
+        return { "message-log-synchronize" : self._handle_synchronize, "message-log-fetch" : self._handle_fetch }
+
+    def _lookup(self, message, fields):
+        """Checks a request and looks up the peer and log it is about.
+
+           @return A tuple (public key, log), or a Reply denying the request.
+        """
+        denied = message["request"] + "_denied"
+        if any(field not in message for field in [ "node_address", "user", "log", "nonce", "user_signature" ] + fields):
+            return Reply({ "response" : denied, "reason" : "missing mandatory fields!" }) # UNENCRYPTED!
+
+        node = self.store.get_node(message["node_address"])
+        if node is None:
+            return Reply({ "response" : denied, "reason" : "Node is not part of the network" }) # UNENCRYPTED!
+
+        # NOTE: Replies are encrypted for the key the node joined with, so
+        # claiming another node's address (or replaying its request) gets
+        # you nothing readable.
+        log = self.logs.get(message["log"])
+        if log is None or message["user"] not in log.participants or not self._authorized(message):
+            self.logger.warning("Denied %s of log %s to user %s at %s" % (message["request"], message["log"], message["user"], message["node_address"]))
+            return Reply({ "response" : denied, "reason" : "unknown log" }, node.public_key.raw_key) # Don't tell outsiders which logs exist
+        return (node.public_key.raw_key, log)
+
+    def _authorized(self, message):
+        """@return True if the user signed the request of the node for the log."""
+        statement = access_statement(message["node_address"], message["log"], message["nonce"])
+        return any(self.encryption.verify(statement, message["user_signature"], public_key) for public_key in self.user_keys(message["user"]))
+
+    def _handle_synchronize(self, message):
+        r = self._lookup(message, [ "ranges" ])
+        if isinstance(r, Reply):
+            return r
+        (public_key, log) = r
+
+        m = { "response" : "message-log-synchronize_approved" }
+        m.update(logsync.respond(log.sync_index, message["ranges"]))
+        return Reply(m, public_key)
+
+    def _handle_fetch(self, message):
+        r = self._lookup(message, [ "keys" ])
+        if isinstance(r, Reply):
+            return r
+        (public_key, log) = r
+
+        messages = []
+        for key in message["keys"][:logsync.FETCH_BATCH]:
+            m = log.get_message(key)
+            if m is not None:
+                messages.append(m.to_dict())
+        return Reply({ "response" : "message-log-fetch_approved", "messages" : messages }, public_key)
+
+    def synchronize(self, log, request):
+        """Pulls the messages of @log we miss from a peer.
+
+           @param log The MessageLog to complete.
+           @param request A callable that sends a request (dictionary) to the
+                          peer and returns its decoded response.
+           @return A tuple (number of messages fetched, sync keys the peer misses).
+        """
+        node_address = self.configuration.get_node_address()
+        nonce = os.urandom(16).hex()
+        proof = { "node_address" : node_address, "user" : self.configuration.get_user_identifier(), "log" : log.identifier, "nonce" : nonce,
+                  "user_signature" : self.encryption.sign(access_statement(node_address, log.identifier, nonce),
+                                                          self.configuration.get_user_keypair().raw_private_key) }
+
+        def exchange(ranges):
+            r = request(dict(proof, request="message-log-synchronize", ranges=ranges))
+            if r.get("response") != "message-log-synchronize_approved":
+                raise ValueError("synchronization denied: %s" % (r.get("reason")))
+            return r
+
+        (missing, surplus) = logsync.reconcile(log.sync_index, exchange)
+
+        messages = []
+        for batch in logsync.batches(missing):
+            r = request(dict(proof, request="message-log-fetch", keys=batch))
+            messages.extend(Message.from_dict(d) for d in r.get("messages", []))
+        fetched = log.append_messages(messages) # Missing messages are mostly older ones, the index is rebuilt once
+
+        self.logger.debug("Synchronized log %s: fetched %d messages, peer misses %d" % (log.identifier, fetched, len(surplus)))
+        return (fetched, surplus)
+
+    def synchronize_with(self, log, node_address, timeout=5.0):
+        """Pulls the messages of @log we miss from the node at @node_address (see synchronize()).
+
+           @raise RequestError If the node does not answer.
+        """
+        node = self.store.get_node(node_address)
+        if node is None:
+            raise ValueError("unknown node %s" % (node_address))
+        manager = connections.default() if self.connections is None else self.connections
+        coalescer = manager.coalescer(self.encryption, node_address, node.public_key.raw_key, self.configuration.get_node_keypair().raw_private_key)
+        return self.synchronize(log, lambda m: coalescer.request(m, timeout))
 
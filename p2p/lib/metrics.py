@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# metrics.py: counters and histograms, exported in Prometheus text format.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Metrics are meant to be left on, so updating them must be cheap. Every
+# thread accumulates into its own shard (a plain dictionary keyed on the
+# tuple of label values), hence updates take no locks. Shards are only
+# summed, and names and labels only formatted, when the metrics are
+# rendered for a scrape.
+
+import bisect
+import logging
+import threading
+import collections
+import http.server
+
+# Latency buckets (seconds), from sub-millisecond AES up to slow public key operations.
+DEFAULT_BUCKETS = ( 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 )
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=""):
+    labels = [ '%s="%s"' % (name, _escape(value)) for (name, value) in zip(names, values) ]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric(object):
+    """Base class of the sharded metrics."""
+
+    TYPE = None
+
+    __slots__ = [ "name", "help", "labels", "local", "shards", "lock" ]
+
+    def __init__(self, _name, _help, _labels=()):
+        self.name = _name
+        self.help = _help
+        self.labels = tuple(_labels)
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            # First update from this thread
+            shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def _snapshots(self):
+        with self.lock:
+            shards = list(self.shards)
+        return [ shard.copy() for shard in shards ] # copy() is atomic (GIL)
+
+    def render(self):
+        lines = [ "# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.TYPE) ]
+        lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    TYPE = "counter"
+
+    __slots__ = []
+
+    def inc(self, labels=(), amount=1):
+        """Increases the counter.
+
+           @param labels Tuple of label values, in the order of the label names.
+           @param amount The amount to add.
+        """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        """@return A dictionary of label values tuple -> total."""
+        totals = {}
+        for shard in self._snapshots():
+            for (labels, value) in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def _render_samples(self):
+        return [ "%s%s %s" % (self.name, _format_labels(self.labels, labels), value) for (labels, value) in sorted(self.collect().items()) ]
+
+
+class Histogram(Metric):
+    """Counts observations (e.g. latencies) in buckets, and keeps their sum."""
+
+    TYPE = "histogram"
+
+    __slots__ = [ "buckets" ]
+
+    def __init__(self, _name, _help, _labels=(), _buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, _name, _help, _labels)
+        self.buckets = tuple(_buckets)
+
+    def observe(self, value, labels=()):
+        """Records an observation.
+
+           @param value The observed value.
+           @param labels Tuple of label values, in the order of the label names.
+        """
+        shard = self._shard()
+        cells = shard.get(labels)
+        if cells is None:
+            # One count per bucket, one for +Inf, then the sum
+            cells = shard[labels] = [ 0 ] * (len(self.buckets) + 2)
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+    def collect(self):
+        """@return A dictionary of label values tuple -> (bucket counts, sum)."""
+        totals = {}
+        for shard in self._snapshots():
+            for (labels, cells) in shard.items():
+                total = totals.setdefault(labels, [ 0 ] * len(cells))
+                for (i, value) in enumerate(list(cells)):
+                    total[i] += value
+        return dict((labels, (cells[:-1], cells[-1])) for (labels, cells) in totals.items())
+
+    def _render_samples(self):
+        lines = []
+        for (labels, (counts, total)) in sorted(self.collect().items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.labels, labels, 'le="%s"' % (bound)), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(self.labels, labels), total))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.labels, labels), cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    """A value that is computed by a callback when the metrics are rendered.
+       The callback returns a dictionary of label values tuple -> value."""
+
+    TYPE = "gauge"
+
+    __slots__ = [ "callback" ]
+
+    def __init__(self, _name, _help, _labels, _callback):
+        Metric.__init__(self, _name, _help, _labels)
+        self.callback = _callback
+
+    def _render_samples(self):
+        return [ "%s%s %s" % (self.name, _format_labels(self.labels, labels), value) for (labels, value) in sorted(self.callback().items()) ]
+
+
+class Registry(object):
+    """A collection of metrics that are rendered together."""
+
+    __slots__ = [ "metrics", "lock" ]
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Registers a metric, replacing any earlier metric with the same name."""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels, callback):
+        return self.register(Gauge(name, help, labels, callback))
+
+    def render(self):
+        """Renders all metrics in the Prometheus text exposition format.
+
+           @return A string.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# The registry of this process, served by a MetricsServer (see jodawg.py).
+REGISTRY = Registry()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger("jodawg.metrics").debug("%s - %s" % (self.address_string(), format % args))
+
+
+class MetricsServer(threading.Thread):
+    """Serves a registry on /metrics over HTTP, for scrapers, from the process
+       the metrics are kept in. The scrapes are handled on this thread."""
+
+    def __init__(self, port, address="127.0.0.1", registry=REGISTRY):
+        """@param port The port to listen on, 0 picks a free one (see the 'port' attribute).
+           @param address The address to listen on.
+           @param registry The Registry to serve.
+        """
+        threading.Thread.__init__(self, name="metrics", daemon=True)
+        self.server = http.server.HTTPServer((address, port), _MetricsHandler) # Binds right away, so errors surface in the caller
+        self.server.registry = registry
+        self.port = self.server.server_address[1]
+
+    def terminate(self):
+        if self.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+
+    def run(self):
+        self.server.serve_forever()
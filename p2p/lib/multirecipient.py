@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# multirecipient.py: encrypt once, deliver to many.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# A message for a group (a MessageLog with many participants) is encrypted
+# once with a random content key (AES-GCM). Only the content key is
+# encrypted for every recipient, with Encryption.encrypt(), so with
+# sessions that is cheap AES as well for all recipients we already have
+# a session with.
+#
+# Envelope layout (all integers in network byte order):
+#
+#   magic (4 bytes) | recipient count (2 bytes) |
+#   recipient count x [ fingerprint (8 bytes) | wrapped key length (2 bytes) | wrapped key ] |
+#   nonce (12 bytes) | tag (16 bytes) | ciphertext
+#
+# The fingerprint of a recipient is derived from its public key, so each
+# recipient only has to decrypt its own entry. Everything in front of the
+# nonce is authenticated along with the ciphertext.
+
+import os
+import struct
+import hashlib
+
+from Crypto.Cipher import AES # pycryptodome (a dependency of py-seccure)
+
+ENVELOPE_MAGIC = b"JDM\x01"
+CONTENT_KEY_BYTES = 32
+FINGERPRINT_BYTES = 8
+NONCE_BYTES = 12
+TAG_BYTES = 16
+
+_HEADER = struct.Struct("!4sH")
+_ENTRY = struct.Struct("!8sH")
+
+
+def fingerprint(public_key):
+    """@return The short fingerprint that identifies @public_key in an envelope."""
+    return hashlib.sha256(public_key).digest()[:FINGERPRINT_BYTES]
+
+
+def is_envelope(data):
+    return data[:len(ENVELOPE_MAGIC)] == ENVELOPE_MAGIC
+
+
+def seal(encryption, plaintext, public_keys, pool=None):
+    """Encrypts @plaintext for a group of recipients.
+
+       @param encryption The Encryption object to wrap the content key with.
+       @param plaintext The bytes to encrypt.
+       @param public_keys The public keys of the recipients.
+       @param pool A CryptoPool to spread the key wrapping over (see Encryption.encrypt_many()).
+       @return A tuple (envelope, failed), failed lists the public keys the
+               content key could not be wrapped for (they are left out).
+    """
+    assert type(plaintext) is bytes
+    public_keys = list(dict.fromkeys(public_keys)) # unique, in order
+    key = os.urandom(CONTENT_KEY_BYTES)
+
+    entries = []
+    failed = []
+    for (public_key, (ok, wrapped_key)) in zip(public_keys, encryption.encrypt_many([ (key, pk) for pk in public_keys ], pool)):
+        if ok:
+            entries.append(_ENTRY.pack(fingerprint(public_key), len(wrapped_key)) + wrapped_key)
+        else:
+            failed.append(public_key)
+    if len(entries) > 0xffff:
+        raise ValueError("too many recipients")
+
+    header = _HEADER.pack(ENVELOPE_MAGIC, len(entries)) + b"".join(entries)
+    nonce = os.urandom(NONCE_BYTES)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    (ciphertext, tag) = cipher.encrypt_and_digest(plaintext)
+    return (header + nonce + tag + ciphertext, failed)
+
+
+def recipients(data):
+    """Parses the recipient entries of an envelope.
+
+       @param data An envelope.
+       @return A tuple (list of (fingerprint, wrapped key), header length).
+       @raise ValueError If the envelope is malformed.
+    """
+    if len(data) < _HEADER.size or not is_envelope(data):
+        raise ValueError("not a multi-recipient envelope")
+    (magic, count) = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    entries = []
+    for i in range(count):
+        if len(data) < offset + _ENTRY.size:
+            raise ValueError("truncated envelope")
+        (entry_print, length) = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        entries.append((entry_print, bytes(data[offset:offset + length])))
+        offset += length
+    if len(data) < offset + NONCE_BYTES + TAG_BYTES:
+        raise ValueError("truncated envelope")
+    return (entries, offset)
+
+
+def open_for(encryption, data, public_key, private_key):
+    """Decrypts an envelope, only touching the entry of this recipient.
+
+       @param encryption The Encryption object to unwrap the content key with.
+       @param data The envelope.
+       @param public_key Our public key (to find our entry).
+       @param private_key Our private key.
+       @return The plaintext.
+       @raise ValueError If we are not a recipient, or the envelope is invalid.
+    """
+    (entries, header_length) = recipients(data)
+    own = fingerprint(public_key)
+
+    for (entry_print, wrapped_key) in entries:
+        if entry_print != own:
+            continue
+        try:
+            key = encryption.decrypt(wrapped_key, private_key)
+        except Exception:
+            continue # A fingerprint collision, in theory
+        if len(key) != CONTENT_KEY_BYTES:
+            continue
+
+        nonce = data[header_length:header_length + NONCE_BYTES]
+        tag = data[header_length + NONCE_BYTES:header_length + NONCE_BYTES + TAG_BYTES]
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(data[:header_length])
+        return cipher.decrypt_and_verify(data[header_length + NONCE_BYTES + TAG_BYTES:], tag)
+
+    raise ValueError("not a recipient of this envelope")
@@ -35,6 +35,21 @@
 #   down to a reasonable size easily (either using zlib, or python-blosc
 #   as much faster solution). ZMQ also offers easy object serialization
 #   using JSON as carry format. So, it seems a good choice for now.
+# * Base64 encoding keys into JSON (and decoding them again) turned out
+#   to cost nearly as much as the crypto. Hence, nodes now negotiate a
+#   binary codec during node_join, JSON remains the fallback (see codec.py).
+#
+# * A request travels as two frames: a small cleartext header (protocol
+#   version, codec version, service name) and the encrypted payload. The
+#   node rejects requests for unknown services or unsupported versions
+#   before doing any crypto, and receives the payload without copying it
+#   (a memoryview, see handle_frames()). The header does reveal which
+#   service a request is for. Single frame (legacy) requests still work,
+#   replies are always a single frame.
+#
+# * Several requests to one peer can travel in a single batch request, so
+#   they share one encryption and one round-trip (see Coalescer in
+#   connections.py). The batch reply holds the replies in the same order.
 #
 # See http://zeromq.github.io/pyzmq/serialization.html for some
 # more thoughts on this.
@@ -49,59 +64,429 @@
 # request: set_status <user-identifier> <status>
 # request: set_profile <user-identifier> <vcard_data>
 
+# Batches:
+#
+# request: batch <requests>
+#          Replied to with a batch response holding a response per request.
+#          A batch is encrypted for a single key: replies meant for another
+#          key are replaced by a protocol_error (batch_key_mismatch).
+
+# Overlay:
+#
+# request: node_join <node-address> <public_key> <signature> [<codecs>] [<protocol version>] [<incarnation>]
+# request: node_leave <node-address> <signature>
+# request: find_node <node-address> <public_key> <node-id>
+#
+# (find_node returns the closest nodes to an ID that a node knows of, see kademlia.py)
+
+# Gossip:
+#
+# request: gossip_ping <node-address> <public_key> <incarnation> <updates>
+# request: gossip_ping_req <node-address> <public_key> <incarnation> <updates> <target-address>
+#
+# (membership updates ride along on the probes and their acks, see gossip.py)
+
 # Messaging:
 # 
 # request: message-log-join <user-identifier>
 # request: message-log-leave <user-identifier>
-# request: message-log-synchronize <user-identifier>
+# request: message-log-synchronize <log-identifier> <ranges>
+# request: message-log-fetch <log-identifier> <sync keys>
 # request: message-log-append <user-identifier>
 #
+# (synchronize/fetch pull the missing part of a log, see logsync.py)
+#
 
 import threading
 import logging
-import zlib
+import struct
+import time
 
 import zmq
 
+from lib import codec
+from lib import metrics
+
+MESSAGES_RECEIVED = metrics.REGISTRY.counter("jodawg_node_messages_received_total", "Frames received by the node.")
+MESSAGES_HANDLED = metrics.REGISTRY.counter("jodawg_node_messages_handled_total", "Requests handled, per service.", ("service",))
+MESSAGES_REJECTED = metrics.REGISTRY.counter("jodawg_node_messages_rejected_total", "Frames that got a protocol error.", ("reason",))
+HANDLER_SECONDS = metrics.REGISTRY.histogram("jodawg_node_handler_duration_seconds", "Time spent in request handlers, per service.", ("service",))
+
+
+PROTOCOL_VERSION = 1
+
+BATCH = "batch" # The request (and header service) name of batches
+MAX_BATCH_REQUESTS = 64
+
+# Header frame: magic | protocol version | codec version (0: legacy json) | service name length | service name
+#               [ | cookie length | cookie ] (see admission.py)
+_HEADER = struct.Struct("!2sBBB")
+_HEADER_MAGIC = b"JD"
+
+
+def encode_header(service, wire_codec=None, cookie=None):
+    """Builds the cleartext header frame of a request.
+
+       @param service The name of the service the request is for (see Node.add_service()).
+       @param wire_codec The codec of the payload, None for legacy json.
+       @param cookie The admission cookie the node handed out, if any.
+       @return The header (bytes).
+    """
+    name = service.encode('utf-8')
+    header = _HEADER.pack(_HEADER_MAGIC, PROTOCOL_VERSION, 0 if wire_codec is None else wire_codec.version, len(name)) + name
+    if cookie is not None:
+        header += bytes([ len(cookie) ]) + cookie
+    return header
+
+
+def decode_header(data):
+    """Parses a header frame.
+
+       @return A tuple (protocol version, codec version, service name, cookie or None).
+       @raise ValueError If the header is malformed.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("truncated header")
+    (magic, version, codec_version, length) = _HEADER.unpack_from(data)
+    end = _HEADER.size + length
+    if magic != _HEADER_MAGIC or len(data) < end:
+        raise ValueError("malformed header")
+    cookie = None
+    if len(data) > end:
+        cookie = bytes(data[end + 1:])
+        if len(cookie) != data[end]:
+            raise ValueError("malformed header")
+    return (version, codec_version, bytes(data[_HEADER.size:end]).decode('utf-8'), cookie)
+
+
+def split_envelope(frames):
+    """Splits the frames received on a ROUTER socket into the envelope (up to
+       and including the empty delimiter) and the body.
+
+       @return A tuple (envelope frames, body frames).
+    """
+    for (i, frame) in enumerate(frames):
+        if len(frame) == 0:
+            return (frames[:i + 1], frames[i + 1:])
+    return (frames[:-1], frames[-1:])
+
+
+def _buffer(frame):
+    return frame.buffer if isinstance(frame, zmq.Frame) else frame
+
+
+def _peer_address(frame):
+    """@return The address of the peer that sent @frame, or None if zmq does not know it."""
+    if not isinstance(frame, zmq.Frame):
+        return None
+    try:
+        return frame.get("Peer-Address")
+    except zmq.ZMQError:
+        return None
+
+
+class Reply(object):
+    """A reply to a request, as returned by the request handlers of a service.
+
+       The reply is encrypted with @public_key. When that is None (for example
+       because we don't know the other node's public key yet) it is sent as
+       plain (UNENCRYPTED!) json. Encrypted replies use @codec, or the codec
+       of the request if that is None.
+    """
+
+    __slots__ = [ "message", "public_key", "codec" ]
+
+    def __init__(self, _message, _public_key=None, _codec=None):
+        self.message = _message
+        self.public_key = _public_key
+        self.codec = _codec
+
+
+def protocol_error(reason):
+    """Builds the (UNENCRYPTED!) reply for requests we can not handle."""
+    MESSAGES_REJECTED.inc((reason,))
+    return Reply({ "response" : "protocol_error", "reason" : reason })
+
+
+def is_batch(message):
+    return isinstance(message, dict) and message.get("request") == BATCH
+
+
+def batch_requests(message):
+    """@return The requests in a batch, or None if the batch is malformed."""
+    requests = message.get("requests")
+    if not isinstance(requests, list) or not 0 < len(requests) <= MAX_BATCH_REQUESTS:
+        return None
+    return requests
+
+
+def batch_reply(replies):
+    """Combines the replies to the requests in a batch into one Reply,
+       encrypted with the key of the first encrypted reply."""
+    public_key = None
+    reply_codec = None
+    for reply in replies:
+        if reply.public_key is not None:
+            (public_key, reply_codec) = (reply.public_key, reply.codec)
+            break
+    responses = []
+    for reply in replies:
+        if reply.public_key is not None and reply.public_key != public_key:
+            reply = protocol_error("batch_key_mismatch") # Not for the eyes of whoever holds @public_key
+        responses.append(reply.message)
+    return Reply({ "response" : BATCH, "responses" : responses }, public_key, reply_codec)
+
+
+class ServiceRouter(object):
+    """Keeps track of the services registered on a node, and routes requests
+       to them. Services provide their handlers with a request_handlers()
+       method, returning a dictionary that maps request names on callables.
+       A handler receives the decoded message and returns a Reply."""
+
+    def add_service(self, name, handler):
+        for (request, request_handler) in handler.request_handlers().items():
+            assert request not in self.routes, "Request '%s' is already handled by '%s'" % (request, self.routes[request][0])
+            self.routes[request] = (name, request_handler)
+        self.handlers[name] = handler
+        self.logger.debug("Service '%s' was added" % (name))
+
+    def get_service(self, name):
+        return self.handlers[name]
+
+    def check_header(self, header):
+        """Checks the cleartext header of a request, before anything is decrypted.
+
+           @param header The header frame.
+           @return A tuple (service name, None), or (None, Reply) if the request is rejected.
+        """
+        try:
+            (version, codec_version, service, cookie) = decode_header(header)
+        except (ValueError, UnicodeDecodeError):
+            return (None, protocol_error("malformed_header"))
+        if version != PROTOCOL_VERSION:
+            return (None, protocol_error("unsupported_version"))
+        if codec_version != 0 and codec.by_version(codec_version) is None:
+            return (None, protocol_error("unsupported_codec"))
+        if service not in self.handlers and service != BATCH:
+            return (None, protocol_error("unknown_service"))
+        return (service, None)
+
+    def admit(self, frames, identity=None):
+        """Runs a request past the node's Admission (if any), before anything is decrypted.
+
+           @param frames The frames of the request, without envelope.
+           @param identity The routing identity of the sender (ROUTER sockets), if any.
+           @return None if the request is admitted, otherwise the encoded reply to send instead.
+        """
+        if self.admission is None or not frames:
+            return None
+        if self.keypair is None:
+            self.keypair = self.configuration.get_node_keypair()
+        cookie = None
+        if len(frames) == 2:
+            try:
+                cookie = decode_header(_buffer(frames[0]))[3]
+            except (ValueError, UnicodeDecodeError):
+                pass # Rejected by check_header() later on
+        return self.admission.admit(_buffer(frames[-1]), _peer_address(frames[-1]), identity, cookie, self.keypair.raw_private_key)
+
+    def admit_requests(self, message, source):
+        """Charges the requests of a decoded batch to their sender (see Admission.admit_batch()).
+
+           @param source A tuple (address, routing identity) of the sender, or None.
+           @return None if the requests are admitted, otherwise the Reply to send instead.
+        """
+        if self.admission is None or source is None or not is_batch(message):
+            return None
+        if not self.admission.admit_batch(len(batch_requests(message) or ()), *source):
+            return protocol_error("rate_limited")
+        return None
+
+    def call_handler(self, handler, message, source):
+        """Runs a request handler. The public key operations it does are charged
+           to the @source (address, routing identity) of the request (see admission.py)."""
+        if self.admission is None or source is None:
+            return handler(message)
+        self.admission.handling(*source)
+        try:
+            return handler(message)
+        finally:
+            self.admission.finished()
+
+    def route(self, message):
+        """Looks up the handler for a decoded message.
 
-class Node(threading.Thread):
+           @param message The decoded message.
+           @return A tuple (service name, handler) or None if no service handles it.
+        """
+        request = message.get("request") if isinstance(message, dict) else None
+        if not isinstance(request, str):
+            return None
+        return self.routes.get(request)
+
+
+class Node(threading.Thread, ServiceRouter):
     """A Node represents a peer in the network. A peer
        always has a (socket) address and a public_key
        for communication. A node may or may not have
        a user associated with it. Though, each node can
        have AT MOST one user.
+
+       Inbound messages are decrypted and decoded exactly once, and then
+       routed on their "request" field to the handler of the service that
+       registered it (see ServiceRouter).
+
+       By default requests are handled one at a time on a single REP socket.
+       When workers are requested, the node binds a ROUTER socket instead and
+       fans requests out over an inproc DEALER socket to a pool of NodeWorker
+       threads. Replies are routed back to the right peer by identity, so one
+       slow request no longer stalls all other peers.
     """
 
-    __slots__ = [ "logger", "address", "public_key", "user", "context", "handlers", "terminate_event" ]
+    __slots__ = [ "logger", "address", "public_key", "user", "context", "handlers", "routes", "keypair", "workers", "admission", "terminate_event" ]
 
-    def __init__(self, _configuration):
+    def __init__(self, _configuration, _encryption, _workers=0, _admission=None):
+        """Creates a new node.
+
+           @param _configuration The global Configuration object to use.
+           @param _encryption The Encryption object to use.
+           @param _workers Number of worker threads, 0 handles all requests on
+                           the node's own thread.
+           @param _admission The Admission that requests pass before they are
+                             decrypted, None admits everything.
+        """
         threading.Thread.__init__(self)
         self.terminate_event = threading.Event()
 
         self.configuration = _configuration
+        self.encryption = _encryption
+        self.workers = _workers
+        self.admission = _admission
         self.logger = logging.getLogger("jodawg.node")
         self.context = zmq.Context()
         self.user = None
         self.handlers = {}
-
-    def add_service(self, name, handler):
-        self.handlers[name] = handler
-        self.logger.debug("Service '%s' was added" % (name))
-
-    def get_service(self, name):
-        return self.handlers[name]
+        self.routes = {}
+        self.keypair = None
 
     def terminate(self):
         self.terminate_event.set()
 
+    def encode_reply(self, reply, request_codec=None):
+        """Encodes a Reply for the wire.
+
+           @param reply The Reply to encode.
+           @param request_codec The codec the request was encoded with.
+           @return The encoded reply (bytes).
+        """
+        if reply.public_key is None:
+            return codec.JSON.encode(reply.message)
+        return self.encryption.encrypt_compress(reply.message, reply.public_key, reply.codec or request_codec)
+
+    def handle_frames(self, frames, identity=None, address=None):
+        """Handles a request: a header and a payload frame, or a single (legacy) payload frame.
+
+           @param frames The frames of the request (zmq.Frame objects or bytes), without envelope.
+           @param identity The routing identity of the sender (ROUTER sockets), if any.
+           @param address The address of the sender, by default the Peer-Address of the frames.
+           @return The encoded reply (bytes).
+        """
+        if address is None and frames:
+            address = _peer_address(frames[-1])
+        source = (address, identity)
+        if len(frames) == 1:
+            return self.handle_frame(_buffer(frames[0]), None, source)
+        if len(frames) != 2:
+            MESSAGES_RECEIVED.inc()
+            return self.encode_reply(protocol_error("malformed_request"))
+        (service, rejection) = self.check_header(_buffer(frames[0]))
+        if rejection is not None:
+            MESSAGES_RECEIVED.inc()
+            return self.encode_reply(rejection)
+        return self.handle_frame(_buffer(frames[1]), service, source)
+
+    def handle_frame(self, frame, service=None, source=None):
+        """Decrypts and decodes an inbound frame, then dispatches it to the
+           handler registered for its request. Every frame yields exactly one
+           reply, which keeps the REQ/REP state machine happy.
+
+           @param frame The raw (encrypted) frame that was received (bytes or a memoryview).
+           @param service The service named in the header of the request, if any.
+           @param source A tuple (address, routing identity) of the sender, if known.
+           @return The encoded reply (bytes).
+        """
+        if self.keypair is None:
+            self.keypair = self.configuration.get_node_keypair()
+        MESSAGES_RECEIVED.inc()
+
+        try:
+            (message, request_codec) = self.encryption.decrypt_decompress(frame, self.keypair.raw_private_key)
+        except Exception:
+            self.logger.warning("Error decoding message")
+            return self.encode_reply(protocol_error("format_or_encryption_error")) # UNENCRYPTED! (don't know other node's pkey yet!)
+
+        reply = self.admit_requests(message, source)
+        if reply is None and is_batch(message):
+            reply = self.dispatch_batch(message, source) if service in (None, BATCH) else protocol_error("service_mismatch")
+        elif reply is None:
+            reply = self.dispatch(message, service, source)
+        return self.encode_reply(reply, request_codec)
+
+    def dispatch(self, message, service=None, source=None):
+        """Hands a decoded request to the handler of its service.
+
+           @param message The decoded request.
+           @param service The service named in the header of the request, if any.
+           @param source A tuple (address, routing identity) of the sender, if known.
+           @return The Reply.
+        """
+        route = self.route(message)
+        if route is None:
+            self.logger.debug("No service handles the request")
+            return protocol_error("unknown_request")
+
+        (handler_name, handler) = route
+        if service is not None and service != handler_name:
+            return protocol_error("service_mismatch")
+        start = time.perf_counter()
+        try:
+            reply = self.call_handler(handler, message, source)
+        except Exception:
+            self.logger.exception("Service '%s' failed to handle '%s'" % (handler_name, message["request"]))
+            return protocol_error("internal_error")
+
+        HANDLER_SECONDS.observe(time.perf_counter() - start, (handler_name,))
+        MESSAGES_HANDLED.inc((handler_name,))
+        self.logger.debug("Message handled by '%s' service" % (handler_name))
+        return reply
+
+    def dispatch_batch(self, message, source=None):
+        """Handles the requests in a batch, in order.
+
+           @return The batch Reply.
+        """
+        requests = batch_requests(message)
+        if requests is None:
+            return protocol_error("malformed_batch")
+        return batch_reply([ protocol_error("nested_batch") if is_batch(m) else self.dispatch(m, None, source) for m in requests ])
+
     def run(self):
+        self.logger.debug("Starting node services")
+
+        self.keypair = self.configuration.get_node_keypair()
+        self.terminate_event.clear()
+
+        if self.workers > 0:
+            self._run_pool()
+        else:
+            self._run_single()
+
+    def _run_single(self):
         
         # NOTE: I use a poller here to be able to expand
         # easily to a multi-socket implementation later, just
         # using one socket for now.
 
-        self.logger.debug("Starting node services")
-
         poller = zmq.Poller()
         
         # Main Socket
@@ -109,22 +494,92 @@ class Node(threading.Thread):
         main_socket.bind(self.configuration.get_node_address())
         poller.register(main_socket, zmq.POLLIN)
 
-        self.terminate_event.clear()
         while True:
             socks = dict(poller.poll(1000))
 
             if main_socket in socks and socks[main_socket] == zmq.POLLIN:
                 self.logger.debug("Message received")
-                message = main_socket.recv()
-                
-                for (handler_name, handler) in self.handlers.items():
-                    response = handler.handle_message(message)
-                    if response is not False:
-                        main_socket.send(response.encode('utf-8'))
-                        self.logger.debug("Message handled by '%s' service" % (handler_name))
-                        break
+                frames = main_socket.recv_multipart(copy=False)
+                rejection = self.admit(frames)
+                main_socket.send(self.handle_frames(frames) if rejection is None else rejection)
 
             # Terminate request!
             if self.terminate_event.is_set():
                 break
-        
+
+        main_socket.close(linger=0)
+
+    def _run_pool(self):
+        """Runs a ROUTER/DEALER broker in front of a pool of worker threads."""
+
+        worker_address = "inproc://jodawg-workers-%d" % (id(self))
+
+        frontend = self.context.socket(zmq.ROUTER)
+        frontend.bind(self.configuration.get_node_address())
+        backend = self.context.socket(zmq.DEALER)
+        backend.bind(worker_address)
+
+        workers = [ NodeWorker(self, worker_address) for i in range(self.workers) ]
+        for worker in workers:
+            worker.start()
+        self.logger.debug("Started %d node workers" % (len(workers)))
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+
+        # NOTE: Not using zmq.proxy() here, as that can't be interrupted
+        # to honour a terminate request.
+        while True:
+            socks = dict(poller.poll(1000))
+
+            if socks.get(frontend) == zmq.POLLIN:
+                frames = frontend.recv_multipart(copy=False)
+                (envelope, body) = split_envelope(frames)
+                rejection = self.admit(body, envelope[0].bytes)
+                if rejection is None:
+                    # The workers don't see where a request came from, so tell them
+                    address = _peer_address(body[-1]) if body else None
+                    backend.send_multipart(envelope + [ b"" if address is None else address.encode('utf-8'), envelope[0].bytes ] + body)
+                else: # Answered right here, the workers never see it
+                    frontend.send_multipart(envelope + [ rejection ])
+            if socks.get(backend) == zmq.POLLIN:
+                frontend.send_multipart(backend.recv_multipart())
+
+            # Terminate request!
+            if self.terminate_event.is_set():
+                break
+
+        for worker in workers:
+            worker.join()
+        frontend.close(linger=0)
+        backend.close(linger=0)
+
+
+class NodeWorker(threading.Thread):
+    """Handles requests on behalf of a Node running in pool mode. Each worker
+       has its own REP socket connected to the node's inproc DEALER socket,
+       which takes care of fair queueing and routing the replies back."""
+
+    __slots__ = [ "node", "address" ]
+
+    def __init__(self, _node, _address):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.node = _node
+        self.address = _address
+
+    def run(self):
+        socket = self.node.context.socket(zmq.REP)
+        socket.connect(self.address)
+
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+
+        while not self.node.terminate_event.is_set():
+            socks = dict(poller.poll(1000))
+            if socks.get(socket) == zmq.POLLIN:
+                frames = socket.recv_multipart(copy=False) # The sender's address and identity, then the request
+                socket.send(self.node.handle_frames(frames[2:], frames[1].bytes, frames[0].bytes.decode('utf-8') or None))
+
+        socket.close(linger=0)
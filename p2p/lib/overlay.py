@@ -21,10 +21,33 @@
 #
 
 import json
-import zmq
+import time
+import concurrent.futures
+import bisect
+import random
 import logging
 import datetime
+import threading
 from lib.encryption import Key, KeyPair
+from lib.network import Reply, PROTOCOL_VERSION, encode_header
+from lib import codec
+from lib import metrics
+from lib import kademlia
+from lib import connections
+from lib import admission
+from lib.cache import LRUCache
+
+OVERLAY_JOIN_REQUESTS = metrics.REGISTRY.counter("jodawg_overlay_join_requests_total", "node_join requests handled, per outcome.", ("outcome",))
+OVERLAY_LEAVE_REQUESTS = metrics.REGISTRY.counter("jodawg_overlay_leave_requests_total", "node_leave requests handled, per outcome.", ("outcome",))
+OVERLAY_JOINS = metrics.REGISTRY.counter("jodawg_overlay_joins_total", "Attempts of this node to join the network, per outcome.", ("outcome",))
+OVERLAY_LEAVES = metrics.REGISTRY.counter("jodawg_overlay_leaves_total", "Times this node left the network.")
+OVERLAY_LOOKUPS = metrics.REGISTRY.counter("jodawg_overlay_lookups_total", "Iterative lookups started by this node.")
+OVERLAY_LOOKUP_QUERIES = metrics.REGISTRY.counter("jodawg_overlay_lookup_queries_total", "find_node requests sent, per outcome.", ("outcome",))
+
+_APPROVED = ("approved",)
+_DENIED = ("denied",)
+_ANSWERED = ("answered",)
+_FAILED = ("failed",)
 
 
 class OverlayUser:
@@ -55,16 +78,26 @@ class OverlayNode:
         self.address = _address
         self.public_key = _public_key
         if _joined is None:
-            self.joined = datetime.utcnow()
+            self.joined = datetime.datetime.utcnow()
         else:
             self.joined = _joined
         self.status = self.OVERLAY_NODE_STATUS_UNKNOWN
 
 
 class OverlayStore:
+    """Holds the nodes known to this peer.
+
+       Besides the nodes themselves, the store keeps an index per status: a
+       list of (joined, address) pairs sorted on join time. It is kept up to
+       date by update_node() and set_status(), so selecting the nodes that are
+       on-line the longest never requires a scan or sort of all nodes.
+    """
 
     def __init__(self):
         self.nodes = {}
+        self.index = {}
+        self.online = None # Called with the address of every node stored as, or set to, ON-LINE (see liveness.py)
+        self.lock = threading.Lock()
     #     self.users = {}
 
     # def login_user(self, user_id, user_key, node_key):
@@ -74,109 +107,360 @@ class OverlayStore:
     # def authorize_user(self, user_id):
     #     pass
 
+    def _unindex(self, node):
+        entries = self.index[node.status]
+        i = bisect.bisect_left(entries, (node.joined, node.address))
+        assert entries[i] == (node.joined, node.address)
+        del entries[i]
+
+    def _index(self, node):
+        bisect.insort(self.index.setdefault(node.status, []), (node.joined, node.address))
+
     def update_node(self, node):
         # TODO: Overwrites existing object, should be no problem per se. However,
         # we do need to check this better to protect against an "overwriting" attack,
         # which would render nodes useless. Note entirely sure what would be a good approach here,
         # have to think about it - AT.
-        self.nodes[node.address] = node 
-
-    def get_node(self, node_address, node_public_key):
+        with self.lock:
+            existing = self.nodes.get(node.address)
+            if existing is not None:
+                self._unindex(existing)
+            self.nodes[node.address] = node 
+            self._index(node)
+        if self.online is not None and node.status == OverlayNode.OVERLAY_NODE_STATUS_ONLINE:
+            self.online(node.address)
+
+    def set_status(self, node, status):
+        """Changes the status of a node in the store.
+
+           NOTE: Always use this instead of assigning node.status directly, or
+           the index will be out of date.
+        """
+        with self.lock:
+            if self.nodes.get(node.address) is node:
+                self._unindex(node)
+                node.status = status
+                self._index(node)
+            else:
+                node.status = status
+        if self.online is not None and status == OverlayNode.OVERLAY_NODE_STATUS_ONLINE:
+            self.online(node.address)
+
+    def get_node(self, node_address, node_public_key=None):
         if node_address in self.nodes:
             return self.nodes[node_address]
         else:
             return None
 
-    def get_nodes(self, n=100):
-        # This returns a list of 100 nodes which are ON-LINE the longest.
-	# TODO: To prevent the network on converging to a list of 100 completely
-	# static nodes, which are then on-line for the longest amount of time,
-	# there should be some variation in this. Perhaps a 50/50 mix between the longest
-	# on-line nodes and a random set, or picking 100 nodes randomly from maximally 1000 nodes
-	# with the highest uptime. Or 33/33/33 where nodes with long, medium and short uptimes are
-	# equally represented.
-        for node in sorted(filter(lambda x: x.status == self.OVERLAY_STATUS_ONLINE, self.nodes.itervalues()), key=lambda x: x.joined)[:n]:
-            return node
+    def count(self, status):
+        return len(self.index.get(status, ()))
+
+    def get_nodes(self, n=100, stratified=False):
+        """Selects on-line nodes, costs O(n) regardless of the size of the store.
+
+           By default, this returns the @n nodes which are ON-LINE the longest.
+           To prevent the network on converging to a list of 100 completely
+           static nodes, which are then on-line for the longest amount of time,
+           there should be some variation in this. With @stratified set, the
+           on-line nodes are divided into three equal strata of long, medium
+           and short uptime, and a random third of @n is taken from each.
+
+           @param n Maximum number of nodes to return.
+           @param stratified Whether to use stratified random selection.
+           @return A list of OverlayNode objects.
+        """
+        with self.lock:
+            entries = self.index.get(OverlayNode.OVERLAY_NODE_STATUS_ONLINE, [])
+            if not stratified or len(entries) <= n:
+                selected = entries[:n]
+            else:
+                selected = []
+                bounds = [ 0, len(entries) // 3, 2 * len(entries) // 3, len(entries) ]
+                for stratum in range(3):
+                    (lo, hi) = (bounds[stratum], bounds[stratum + 1])
+                    k = min(hi - lo, (n - len(selected)) // (3 - stratum))
+                    selected.extend(entries[i] for i in sorted(random.sample(range(lo, hi), k)))
+            return [ self.nodes[address] for (joined, address) in selected ]
 
 
 class OverlayService:
 
-    def __init__(self, _configuration, _encryption):
+    def __init__(self, _configuration, _encryption, _connections=None):
+        """@param _connections The ConnectionManager to send requests through (the one of the process by default)."""
         self.logger = logging.getLogger("jodawg.overlay")
         self.configuration = _configuration
         self.encryption = _encryption
         self.store = OverlayStore()
         self.neighbours = []
-        self.context = zmq.Context()
+        self.peer_codecs = {} # address -> codec negotiated during node_join
+        self.peer_protocols = {} # address -> protocol version (header frames, see network.py) announced during node_join
+        self.cookies = LRUCache(4096) # address -> admission cookie the node handed out (see admission.py)
+        self.heartbeats = None # HeartbeatService (see liveness.py), if heartbeats are enabled
+        self.gossip = None # GossipService (see gossip.py), if gossip is enabled
+        self.forward = None # StoreAndForwardService (see forward.py), drains our relays after a join
+        self.routing = kademlia.RoutingTable(kademlia.node_id(_configuration.get_node_keypair().raw_public_key))
+        self.connections = connections.default() if _connections is None else _connections
+        metrics.REGISTRY.gauge("jodawg_overlay_nodes", "Nodes in the overlay store, per status.", ("status",), self._node_counts)
+
+    def _node_counts(self):
+        names = { OverlayNode.OVERLAY_NODE_STATUS_UNKNOWN : "unknown", OverlayNode.OVERLAY_NODE_STATUS_ONLINE : "online",
+                  OverlayNode.OVERLAY_NODE_STATUS_DANGLING : "dangling", OverlayNode.OVERLAY_NODE_STATUS_OFFLINE : "offline" }
+        return dict(((name,), self.store.count(status)) for (status, name) in names.items())
+
+    def request_handlers(self):
+        return { "node_join" : self._handle_node_join, "node_leave" : self._handle_node_leave, "find_node" : self._handle_find_node }
+
+    def codec_for(self, address):
+        """@return The codec to send messages to the node at @address with
+                   (None, legacy json, if none was negotiated)."""
+        return self.peer_codecs.get(address)
+
+    def frames_for(self, address, service, frame):
+        """Prepends a header frame to an encrypted request for the node at
+           @address, if it announced support for them.
+
+           @return A list of frames, or @frame itself for older nodes.
+        """
+        if self.peer_protocols.get(address) is None:
+            return frame
+        return self.header_frames(address, service, frame)
+
+    def header_frames(self, address, service, frame):
+        """@return A header frame (with the node's admission cookie, if we have one) and @frame."""
+        return [ encode_header(service, self.codec_for(address), self.cookies.get(address)), frame ]
+
+    def requested_cookie(self, address, response):
+        """Remembers the admission cookie a node asks for (see admission.py).
+
+           @param response The raw reply of the node.
+           @return True if the node dropped the request and asked for a cookie.
+        """
+        if not response or response[0] != ord('{'): # Not an (UNENCRYPTED!) json error
+            return False
+        try:
+            cookie = admission.requested_cookie(codec.JSON.decode(response))
+        except ValueError:
+            return False
+        if cookie is None:
+            return False
+        self.cookies.put(address, cookie)
+        return True
+
+    def coalescer(self, address, public_key):
+        """@return The Coalescer (see connections.py) for requests to the node at @address."""
+        coalescer = self.connections.coalescer(self.encryption, address, public_key, self.configuration.get_node_keypair().raw_private_key,
+                                               self.codec_for(address), self.peer_protocols.get(address) is not None)
+        if coalescer.cookie is None:
+            coalescer.cookie = self.cookies.get(address) # Handed out during node_join
+        return coalescer
+
+    def send(self, address, public_key, m, service, timeout=5.0, header=False):
+        """Sends an encrypted request to a node. When the node is under load and
+           asks for an admission cookie, the request is sent once more with it.
+
+           @param public_key The raw public key of the node.
+           @param header Whether to send a header frame even if the node did not announce support for them.
+           @return A concurrent.futures.Future, resolving to the raw reply.
+        """
+        frame = self.encryption.encrypt_compress(m, public_key, self.codec_for(address))
+        frames = lambda: self.header_frames(address, service, frame) if header else self.frames_for(address, service, frame)
+        result = concurrent.futures.Future()
+
+        def done(future, retry):
+            try:
+                response = future.result()
+            except Exception as e:
+                result.set_exception(e)
+                return
+            if retry and self.requested_cookie(address, response):
+                self.connections.request(address, frames(), timeout).add_done_callback(lambda f: done(f, False))
+            else:
+                result.set_result(response)
+
+        self.connections.request(address, frames(), timeout).add_done_callback(lambda f: done(f, True))
+        return result
 
     def _handle_node_join(self, message):
 
         # Check fields
         if (not "node_address" in message) or (not "node_public_key" in message) or (not "signature" in message):
             m = { "response" : "node_join_denied", "reason" : "missing mandatory fields!" } # Don't know node's pkey, so can't do this
-            return json.dumps(m, sort_keys=True) # UNENCRYPTED! (don't know other node's pkey yet!)
+            OVERLAY_JOIN_REQUESTS.inc(_DENIED)
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey yet!)
+
+        node_public_key = Key.from_wire(message["node_public_key"])
 
         # Verify signature
-        if not self.encryption.verify(Key(message["node_public_key"]).raw_key, message["signature"], Key(message["node_public_key"]).raw_key):
+        if not self.encryption.verify(node_public_key.raw_key, message["signature"], node_public_key.raw_key):
             m = { "response" : "node_join_denied", "reason" : "invalid signature!" }
-            return self.encryption.encrypt_compress_json(m, Key(message["node_public_key"]).raw_key)
+            OVERLAY_JOIN_REQUESTS.inc(_DENIED)
+            return Reply(m, node_public_key.raw_key)
             
         # Build response + send.
-        # Response includes at most 100 known nodes.
+        # Response includes the (at most K) on-line nodes closest to the new node we know
+        # of, with those it can fill its routing table (see kademlia.py).
+        # The reply (and later traffic) uses the first codec in the requester's
+        # list we support. Older nodes don't send a list, they get legacy json.
         m = { "response" : "node_join_approved" }
-        for no in self.overlay.get_nodes():
-            m[n.address] = (n.public_key.b64_key, n.status)
+        for n in self._online(self.routing.closest(kademlia.node_id(node_public_key.raw_key))):
+            if n.address != message["node_address"]:
+                m[n.address] = (n.public_key, OverlayNode.OVERLAY_NODE_STATUS_ONLINE)
+        wire_codec = codec.negotiate(message.get("codecs"))
+        if wire_codec is not None:
+            m["codec"] = wire_codec.name
+        if "protocol" in message:
+            m["protocol"] = PROTOCOL_VERSION
 
         # Register that we've seen this peer for bootstrapping purposes later on
-        self.configuration_add_known_node(message["node_address"], Key(message["node_public_key"]))
+        self.configuration.add_known_node(message["node_address"], node_public_key)
 
         # Register node in the overlay (as active)
         # TODO: Ideally, we would also include a signature, so that
         # others can verify that the addition to the "overlaystore" is
         # a genuine one ...
-        node = OverlayNode(node_address, Key(node_public_key))
+        node = OverlayNode(message["node_address"], node_public_key)
         node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
-        self.overlay.update_node(node)
-
-        return self.encryption.encrypt_compress_json(m, Key(message["node_public_key"]).raw_key)
+        self.store.update_node(node) # Tracked by the heartbeats (if any), OFF-LINE if it never sends one
+        if self.gossip is not None:
+            incarnation = message.get("incarnation")
+            self.gossip.membership.joined(node.address, node_public_key, incarnation if isinstance(incarnation, int) else 0,
+                                          message.get("gossip_signature")) # Gossiped to the others
+        self._learn(kademlia.Contact(node.address, node_public_key))
+
+        self.peer_codecs[message["node_address"]] = wire_codec
+        self.peer_protocols[message["node_address"]] = message.get("protocol")
+        OVERLAY_JOIN_REQUESTS.inc(_APPROVED)
+        return Reply(m, node_public_key.raw_key, wire_codec)
 
     def _handle_node_leave(self, message):
 
         # Check fields
         if (not "node_address" in message) or (not "signature" in message):
             m = { "response" : "node_leave_denied", "reason" : "missing mandatory fields!" }
-            return json.dumps(m, sort_keys=True) # UNENCRYPTED! (don't know other node's pkey yet!)
+            OVERLAY_LEAVE_REQUESTS.inc(_DENIED)
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey yet!)
 
-        node = self.overlay.get_node(message["node_address"])
+        node = self.store.get_node(message["node_address"])
 
         # Is the node joined?
-        if node is None or node.status == OVERLAY_NODE_STATUS_OFFLINE:
+        if node is None or node.status == OverlayNode.OVERLAY_NODE_STATUS_OFFLINE:
             m = { "response" : "node_leave_denied", "reason" : "Node is not part of the network or off-line" }
-            return self.encryption.encrypt_compress_json(m, node.raw_public_key)
+            OVERLAY_LEAVE_REQUESTS.inc(_DENIED)
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey)
 
         # Verify signature
-        if not self.encryption.verify(message["node_address"], message["signature"], message["node_address"]):
+        if not self.encryption.verify(message["node_address"].encode('utf-8'), message["signature"], node.public_key.raw_key):
             m = { "response" : "node_leave_denied", "reason" : "invalid signature!" }
-            node.status = OVERLAY_NODE_STATUS_DANGLING
-            return self.encryption.encrypt_compress_json(m, node.raw_public_key)
+            self.store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_DANGLING)
+            OVERLAY_LEAVE_REQUESTS.inc(_DENIED)
+            return Reply(m, node.public_key.raw_key)
         
+        if self.gossip is not None:
+            self.gossip.membership.dead(node.address) # Gossiped to the others
+        self.store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_OFFLINE)
         m = { "response" : "node_leave_approved" }
-        return self.encryption.encrypt_compress_json(m, node.raw_public_key)
+        OVERLAY_LEAVE_REQUESTS.inc(_APPROVED)
+        return Reply(m, node.public_key.raw_key)
+
+    def _online(self, contacts):
+        """@return The @contacts that are not known to be DANGLING or OFF-LINE."""
+        online = []
+        for contact in contacts:
+            node = self.store.get_node(contact.address)
+            if node is None or node.status in (OverlayNode.OVERLAY_NODE_STATUS_UNKNOWN, OverlayNode.OVERLAY_NODE_STATUS_ONLINE):
+                online.append(contact)
+        return online
+
+    def _learn(self, contact):
+        """Adds a contact to the routing table. A full bucket only makes room
+           if its least recently seen contact is no longer on-line."""
+        stale = self.routing.update(contact)
+        if stale is not None and not self._online([ stale ]):
+            self.routing.remove(stale.id) # Promotes @contact from the replacement cache
+
+    def _handle_find_node(self, message):
 
-    def handle_message(self, message):
-        try:
-            m = self.encryption.decrypt_decompress_json(message, self.configuration.get_node_keypair().raw_private_key)
-        except:
-            self.logger.warning('Error decoding message')
-            raise
-            return json.dumps({ "response" : "protocol_error", "reason" : "format_or_encryption_error" }, sort_keys=True) # UNENCRYPTED! (don't know other node's pkey yet!)
-
-        if m['request'] == "node_join":
-            return self._handle_node_join(m)
-        elif m['request'] == "node_leave":
-            return self._handle_node_leave(m)
+        # Check fields
+        if (not "node_address" in message) or (not "node_public_key" in message) or (not "target" in message):
+            m = { "response" : "find_node_denied", "reason" : "missing mandatory fields!" }
+            return Reply(m) # UNENCRYPTED! (don't know other node's pkey yet!)
 
-        return False # Someone else should handle this
+        node_public_key = Key.from_wire(message["node_public_key"])
+        try:
+            target = kademlia.from_wire(message["target"])
+        except (TypeError, ValueError):
+            m = { "response" : "find_node_denied", "reason" : "invalid target!" }
+            return Reply(m, node_public_key.raw_key)
+
+        # Only nodes that joined (with a valid signature) are added to the routing table
+        node = self.store.get_node(message["node_address"])
+        if node is not None and node.public_key.raw_key == node_public_key.raw_key:
+            self._learn(kademlia.Contact(node.address, node.public_key))
+
+        m = { "response" : "find_node_approved",
+              "nodes" : [ [ c.address, c.public_key ] for c in self._online(self.routing.closest(target)) ] }
+        return Reply(m, node_public_key.raw_key, self.codec_for(message["node_address"]))
+
+    def _query(self, contacts, target, timeout=2.0):
+        """Sends find_node to @contacts concurrently (see kademlia.lookup()).
+
+           @return A list of (contact, list of contacts or None if it failed).
+        """
+        node_keypair = self.configuration.get_node_keypair()
+        m = { "request" : "find_node", "node_address" : self.configuration.get_node_address(),
+              "node_public_key" : node_keypair.public_key, "target" : kademlia.to_wire(target) }
+
+        # Concurrent lookups that ask the same node share a batch
+        futures = [ (contact, self.coalescer(contact.address, contact.public_key.raw_key).submit(m, timeout)) for contact in contacts ]
+
+        results = []
+        for (contact, future) in futures:
+            try:
+                r = future.result()
+                found = [ kademlia.Contact(address, Key.from_wire(key)) for (address, key) in r["nodes"] ]
+            except connections.RequestError as e:
+                self.logger.debug("find_node to %s failed: %s" % (contact.address, e))
+                found = None
+            except Exception:
+                self.logger.debug("Invalid find_node reply from %s" % (contact.address))
+                found = None
+            results.append((contact, found))
+
+        for (contact, found) in results:
+            OVERLAY_LOOKUP_QUERIES.inc(_FAILED if found is None else _ANSWERED)
+        return results
+
+    def lookup(self, target):
+        """Finds the nodes closest to an ID in O(log n) hops.
+
+           @param target The node ID (an integer, see kademlia.node_id()).
+           @return A list of (up to K) kademlia.Contact objects, closest first.
+        """
+        OVERLAY_LOOKUPS.inc()
+        return kademlia.lookup(self.routing, target, self._query)
+
+    def find_node(self, identifier):
+        """Resolves a node ID to a node, asking the network if it is not in our routing table.
+
+           @param identifier The node ID (an integer, see kademlia.node_id()).
+           @return An OverlayNode, or None if the node could not be found.
+        """
+        contact = self.routing.get(identifier)
+        if contact is None:
+            closest = self.lookup(identifier)
+            if not closest or closest[0].id != identifier:
+                return None
+            contact = closest[0]
+        node = self.store.get_node(contact.address)
+        if node is None or node.public_key.raw_key != contact.public_key.raw_key:
+            node = OverlayNode(contact.address, contact.public_key)
+            node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+        return node
+
+    def refresh(self):
+        """Refreshes the buckets of the routing table that saw no lookups for a while."""
+        for target in self.routing.refresh_targets():
+            self.lookup(target)
 
     # def authorize_user(self, user_id, user_public_key):
     #     signature = self.encryption.sign(user_public_key, self.configuration.get_user_keypair().private_key)
@@ -184,67 +468,133 @@ class OverlayService:
     #     user.add_signature(signature)
     #     self.store.users[m.user_id] = user
 
-    def join(self):
+    def _parse_join_response(self, bootstrap_node_address, response, private_key):
+        """Decodes a reply to node_join.
+
+           @return The decoded reply if the join was approved, None otherwise.
+        """
+        try:
+            r = self.encryption.decrypt_decompress_json(response, private_key)
+        except:
+            try:
+                # Assume the response is not encrypted. This is ALWAYS an error
+                r = json.loads(response.decode('utf-8'))
+                self.logger.debug("Failed to bootstrap via %s: %s - %s" % (bootstrap_node_address, r["response"], r["reason"]))
+            except:
+                self.logger.debug("Failed to bootstrap via %s: unknown data returned" % (bootstrap_node_address))
+            return None
+
+        if r.get("response") != "node_join_approved":
+            self.logger.debug("Failed to bootstrap via %s: %s - %s" % (bootstrap_node_address, r.get("response"), r.get("reason")))
+            return None
+        return r
+
+    def join(self, parallelism=3, timeout=5.0):
+        """Joins the network through one of the known (bootstrap) nodes.
+
+           Up to @parallelism bootstrap nodes are contacted at the same time,
+           the best ranked ones (by past success rate and latency) first. The
+           first node to approve the join wins, the other attempts are
+           abandoned. Whenever an attempt fails or times out, the next node
+           in line is tried.
+
+           @param parallelism Number of bootstrap nodes contacted concurrently.
+           @param timeout Seconds to wait for each bootstrap node.
+           @return True if the join succeeded (or there is no one to join).
+        """
         self.logger.debug("Joining the Network")
 
         bootstrap_peer_addresses = self.configuration.get_known_nodes()
         if len(bootstrap_peer_addresses) == 0:
             self.logger.debug("No known bootstrap peers, assuming disjunct operation")
             self.configuration.get_node_keypair() # but DO generate a keypair for interactions with new peers ...
+            OVERLAY_JOINS.inc(("standalone",))
             return True
 
-        for (bootstrap_node_address, bootstrap_node_public_key) in bootstrap_peer_addresses:
-            self.logger.debug("Trying %s for bootstrap" % (bootstrap_node_address))
-
-            socket = self.context.socket(zmq.REQ)
-            socket.connect(bootstrap_node_address)
-
-            node_address = self.configuration.get_node_address()
-            node_keypair = self.configuration.get_node_keypair()
-            signature = self.encryption.sign(node_keypair.raw_public_key, node_keypair.raw_private_key)
-
-            m = { "request" : "node_join", "node_address" : node_address, "node_public_key" : node_keypair.b64_public_key, "signature" : signature }
-            socket.send(self.encryption.encrypt_compress_json(m, bootstrap_node_public_key.raw_key))
-
-            response = socket.recv()
-            try:
-                r = self.encryption.decrypt_decompress_json(response, node_keypair.raw_private_key)
-            except:
+        rank = { address : i for (i, address) in enumerate(self.configuration.get_bootstrap_ranking()) }
+        candidates = sorted(bootstrap_peer_addresses, key=lambda peer: rank.get(peer[0], len(rank)))
+        candidates.reverse() # pop() from the end
+
+        node_address = self.configuration.get_node_address()
+        node_keypair = self.configuration.get_node_keypair()
+        signature = self.encryption.sign(node_keypair.raw_public_key, node_keypair.raw_private_key)
+        m = { "request" : "node_join", "node_address" : node_address, "node_public_key" : node_keypair.public_key, "signature" : signature,
+              "codecs" : codec.supported(), "protocol" : PROTOCOL_VERSION }
+        if self.gossip is not None:
+            m["incarnation"] = self.gossip.membership.incarnation
+            m["gossip_signature"] = self.gossip.membership.signature
+
+        attempts = {} # future -> (address, public key, start time)
+        approved = None
+
+        while approved is None and (candidates or attempts):
+            # Keep up to @parallelism attempts in flight
+            while candidates and len(attempts) < parallelism:
+                (bootstrap_node_address, bootstrap_node_public_key) = candidates.pop()
+                self.logger.debug("Trying %s for bootstrap" % (bootstrap_node_address))
+                # With a header, so we can pass the admission of a node under load
+                future = self.send(bootstrap_node_address, bootstrap_node_public_key.raw_key, m, "overlay", timeout, True)
+                attempts[future] = (bootstrap_node_address, bootstrap_node_public_key, time.monotonic())
+
+            (done, waiting) = concurrent.futures.wait(list(attempts), return_when=concurrent.futures.FIRST_COMPLETED)
+            now = time.monotonic()
+
+            for future in done:
+                (bootstrap_node_address, bootstrap_node_public_key, start) = attempts.pop(future)
                 try:
-                    # Assume the response is not encrypted. This is ALWAYS an error
-                    r = json.loads(response) 
-                    self.logger.debug("Failed to bootstrap via %s: %s - %s" % (bootstrap_node_address, r["response"], r["reason"]))
-                    continue # Next node ...
-                except:
-                    self.logger.debug("Failed to bootstrap via %s: unknown data returned")
-                    continue # Give up, next node ...
-
-            if "response" in r and r["response"] == "node_join_denied":
-                self.logger.debug("Failed to bootstrap via %s: %s - %s" % (bootstrap_node_address, r["response"], r["reason"]))
-                continue # Try next node ...
-
-            # Retrieve list of nodes (+ status)
-            for (k, v) in r.iteritems():
-                if k == "response":
-                    assert v == "node_join_approved" # Something fishy going on otherwise ....
-            
-                node = OverlayNode(k, v[0])
-                node.status = v[1]
-                self.store.update_node(node)
-
-            # TODO: Perhaps update the list with bootstrap peers here as well ..
-                
-            return True
-
-        self.logger.error("Could not bootstrap into the network!")
-        return False
+                    response = future.result()
+                except connections.RequestError as e:
+                    self.logger.debug("Failed to bootstrap via %s: %s" % (bootstrap_node_address, e))
+                    self.configuration.update_bootstrap_stats(bootstrap_node_address, False, timeout)
+                    continue
+                r = self._parse_join_response(bootstrap_node_address, response, node_keypair.raw_private_key)
+                self.configuration.update_bootstrap_stats(bootstrap_node_address, r is not None, now - start)
+                if r is not None and approved is None:
+                    approved = r
+                    if self.heartbeats is not None:
+                        self.heartbeats.joined_through(bootstrap_node_address) # It tracks us from now on
+                    self._learn(kademlia.Contact(bootstrap_node_address, bootstrap_node_public_key))
+                    self.peer_codecs[bootstrap_node_address] = codec.by_name(r.get("codec"))
+                    self.peer_protocols[bootstrap_node_address] = r.get("protocol")
+                    self.logger.debug("Bootstrapped via %s in %.3f seconds" % (bootstrap_node_address, now - start))
+
+        # The replies to attempts still in flight are ignored
+
+        if approved is None:
+            self.logger.error("Could not bootstrap into the network!")
+            OVERLAY_JOINS.inc(("failed",))
+            return False
+
+        # Retrieve list of nodes (+ status)
+        for (k, v) in approved.items():
+            if k in ("response", "codec", "protocol"):
+                continue
+            node = OverlayNode(k, Key.from_wire(v[0]))
+            node.status = v[1]
+            self.store.update_node(node)
+            if node.status == OverlayNode.OVERLAY_NODE_STATUS_ONLINE:
+                self._learn(kademlia.Contact(node.address, node.public_key))
+
+        # TODO: Perhaps update the list with bootstrap peers here as well ..
+
+        # Looking up ourselves fills the buckets near us, and makes us known to our neighbours
+        self.lookup(self.routing.id)
+
+        # Pick up what was left for us while we were away
+        if self.forward is not None:
+            self.forward.drain_relays()
+
+        OVERLAY_JOINS.inc(("joined",))
+        return True
 
     # TODO: I am doubting as to whether we want an actual leave protocol for the nodes. On the one hand it's nice
     # as it would allow us to keep better track of which nodes are still alive. On the other hand, there are so many
     # ways in which this can go wrong (nodes failing to send leave messages). Perhaps ONLY a keep-alive is a better
     # idea. This could be done with a separate PUB/SUB socket.
+    # UPDATE: Nodes that fail to leave are now demoted when their heartbeats stop (see liveness.py).
 
     def leave(self):
         self.logger.debug("Leaving the Network")
+        OVERLAY_LEAVES.inc()
         return True
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# Jodawg Peer-to-Peer Communicator
+#
+# session.py: symmetric session keys between peers.
+#
+# Copyright (C) 2013 Almer S. Tigelaar & Windel Bouwman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Public key operations on secp521r1 are expensive. Hence, we only use them
+# to wrap a random session key for a peer, all messages that follow are
+# encrypted with AES-GCM under that session key.
+#
+# Session frame layout (all integers in network byte order):
+#
+#   magic (4 bytes) | session id (16 bytes) | wrapped key length (2 bytes) |
+#   wrapped key | nonce (12 bytes) | tag (16 bytes) | ciphertext
+#
+# The session id is derived from the session key itself, so it can not be
+# bound to a different key by a third party. The wrapped key (the session key
+# encrypted with the recipient's public key) travels with every frame: a
+# recipient that has the session cached skips it, one that doesn't (restart,
+# eviction) can still recover the key. The whole header is authenticated.
+
+import os
+import time
+import struct
+import hashlib
+import threading
+
+from Crypto.Cipher import AES # pycryptodome (a dependency of py-seccure)
+
+from lib.cache import LRUCache
+
+SESSION_MAGIC = b"JDS\x01"
+SESSION_KEY_BYTES = 32
+SESSION_ID_BYTES = 16
+NONCE_BYTES = 12
+TAG_BYTES = 16
+
+_HEADER = struct.Struct("!4s16sH")
+
+
+def session_identifier(key):
+    """Derives the (public) session identifier from a session key."""
+    return hashlib.sha256(b"jodawg-session" + key).digest()[:SESSION_ID_BYTES]
+
+
+def is_session_frame(data):
+    return data[:len(SESSION_MAGIC)] == SESSION_MAGIC
+
+
+def seal(session, plaintext):
+    """Encrypts @plaintext into a session frame.
+
+       @param session The (outbound) Session to use.
+       @param plaintext The bytes to encrypt.
+       @return A session frame (bytes).
+    """
+    header = _HEADER.pack(SESSION_MAGIC, session.identifier, len(session.wrapped_key)) + session.wrapped_key
+    nonce = os.urandom(NONCE_BYTES)
+    cipher = AES.new(session.key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    (ciphertext, tag) = cipher.encrypt_and_digest(plaintext)
+    return header + nonce + tag + ciphertext
+
+
+def parse_frame(data):
+    """Splits a session frame into its parts.
+
+       @param data A session frame.
+       @return A tuple (identifier, wrapped_key, header, body).
+       @raise ValueError If the frame is malformed.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("truncated session frame")
+    (magic, identifier, wrapped_length) = _HEADER.unpack_from(data)
+    if magic != SESSION_MAGIC:
+        raise ValueError("not a session frame")
+    header_length = _HEADER.size + wrapped_length
+    if len(data) < header_length + NONCE_BYTES + TAG_BYTES:
+        raise ValueError("truncated session frame")
+    header = bytes(data[:header_length])
+    return (identifier, header[_HEADER.size:], header, data[header_length:])
+
+
+def open_body(key, header, body):
+    """Decrypts and authenticates the body of a session frame.
+
+       @param key The session key.
+       @param header The frame header, as returned by parse_frame().
+       @param body The frame body, as returned by parse_frame().
+       @return The plaintext.
+       @raise ValueError If authentication fails.
+    """
+    nonce = body[:NONCE_BYTES]
+    tag = body[NONCE_BYTES:NONCE_BYTES + TAG_BYTES]
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    return cipher.decrypt_and_verify(body[NONCE_BYTES + TAG_BYTES:], tag)
+
+
+class Session(object):
+    """An outbound session with a single peer."""
+
+    __slots__ = [ "identifier", "key", "wrapped_key", "created", "messages" ]
+
+    def __init__(self, _key, _wrapped_key):
+        self.key = _key
+        self.identifier = session_identifier(_key)
+        self.wrapped_key = _wrapped_key
+        self.created = time.monotonic()
+        self.messages = 0
+
+    def expired(self, max_age, max_messages):
+        return self.messages >= max_messages or time.monotonic() - self.created >= max_age
+
+
+class SessionCache(object):
+    """Keeps symmetric session keys for the peers we talk to.
+
+       Outbound sessions are keyed by the peer's public key and are renewed
+       (rekeyed) once they get too old or have been used for too many
+       messages. Inbound session keys are keyed by session identifier.
+    """
+
+    __slots__ = [ "max_age", "max_messages", "outbound", "inbound", "lock" ]
+
+    def __init__(self, max_sessions=1024, max_age=3600, max_messages=100000):
+        """Creates a new session cache.
+
+           @param max_sessions Maximum number of sessions kept in each direction.
+           @param max_age Lifetime of a session key in seconds.
+           @param max_messages Number of messages after which an outbound session is rekeyed.
+        """
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.outbound = LRUCache(max_sessions)
+        self.inbound = LRUCache(max_sessions, max_age)
+        self.lock = threading.Lock()
+
+    def outbound_session(self, public_key, wrap):
+        """Retrieves the session to use for a message to @public_key.
+
+           @param public_key The recipient's public key.
+           @param wrap Callable that encrypts a new session key to @public_key,
+                       only invoked when a (new) session has to be set up.
+           @return A Session.
+        """
+        session = self.cached_outbound_session(public_key)
+        if session is None:
+            key = os.urandom(SESSION_KEY_BYTES)
+            session = self.add_outbound_session(public_key, key, wrap(key))
+        return self.use(session)
+
+    def use(self, session):
+        """Counts a message sent with @session (for rekeying)."""
+        with self.lock:
+            session.messages += 1
+        return session
+
+    def cached_outbound_session(self, public_key):
+        """Retrieves the current session to @public_key without setting up a
+           new one. Does not count as a use of the session.
+
+           @return A Session or None if there is no (valid) session.
+        """
+        session = self.outbound.get(public_key)
+        if session is None or session.expired(self.max_age, self.max_messages):
+            return None
+        return session
+
+    def add_outbound_session(self, public_key, key, wrapped_key):
+        session = Session(key, wrapped_key)
+        self.outbound.put(public_key, session)
+        return session
+
+    def inbound_key(self, identifier, private_key):
+        return self.inbound.get((identifier, private_key))
+
+    def add_inbound_key(self, identifier, private_key, key):
+        self.inbound.put((identifier, private_key), key)
+
+    def forget(self, public_key):
+        """Drops the outbound session to @public_key, forcing a rekey."""
+        self.outbound.pop(public_key)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the crypto, codec and node round-trip paths.
+#
+# Run from this directory:
+#
+#   python3 benchmark.py --output results.json
+#   python3 benchmark.py --baseline results.json
+#
+# Every benchmark reports its throughput and p50/p99 latency. With
+# --baseline the results are compared against an earlier run, and the
+# script exits with status 1 if any benchmark got slower than --tolerance.
+
+import sys
+import os
+import time
+import json
+import zlib
+import random
+import string
+import shutil
+import platform
+import tempfile
+import argparse
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+import zmq
+
+from lib import codec
+from lib.encryption import Encryption, KeyPair
+from lib.session import SessionCache
+from lib.configuration import Configuration
+from lib.network import Node
+from lib.overlay import OverlayService
+
+PAYLOAD_SIZES = [ 64, 1024, 16384, 262144 ]
+COMPRESSION_LEVELS = [ 1, 6, 9 ]
+
+
+def payload(size):
+    # Text compresses somewhat, like real messages, random bytes would not.
+    random.seed(size)
+    return ''.join(random.choice(string.ascii_letters + ' ') for i in range(size)).encode('utf-8')
+
+
+def measure(function, iterations):
+    """Runs @function @iterations times.
+
+       @return A dictionary with the throughput (operations per second) and
+               the p50/p99 latencies (milliseconds).
+    """
+    function() # warm up (caches, sessions, connections)
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return { "iterations" : iterations,
+             "ops_per_second" : iterations / sum(latencies),
+             "p50_ms" : 1000 * latencies[len(latencies) // 2],
+             "p99_ms" : 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] }
+
+
+def benchmark_crypto(results, iterations):
+    keypair = KeyPair()
+    for (mode, encryption) in [ ("ecies", Encryption()), ("session", Encryption(SessionCache())) ]:
+        for size in PAYLOAD_SIZES:
+            message = payload(size)
+            cipher = encryption.encrypt(message, keypair.raw_public_key)
+            results["encrypt/%s/%d" % (mode, size)] = measure(lambda: encryption.encrypt(message, keypair.raw_public_key), iterations)
+            results["decrypt/%s/%d" % (mode, size)] = measure(lambda: encryption.decrypt(cipher, keypair.raw_private_key), iterations)
+
+    encryption = Encryption()
+    message = keypair.raw_public_key
+    signature = encryption.sign(message, keypair.raw_private_key)
+    results["sign"] = measure(lambda: encryption.sign(message, keypair.raw_private_key), iterations)
+    results["verify"] = measure(lambda: encryption.verify(message, signature, keypair.raw_public_key), iterations)
+
+
+def benchmark_codec(results, iterations):
+    keypair = KeyPair()
+    encryption = Encryption(SessionCache())
+    for size in PAYLOAD_SIZES:
+        m = { "request" : "message-log-append", "content" : payload(size).decode('utf-8') }
+        for level in COMPRESSION_LEVELS:
+            cipher = encryption.encrypt_compress_json(m, keypair.raw_public_key, level)
+            results["encrypt_compress_json/%d/level%d" % (size, level)] = measure(lambda: encryption.encrypt_compress_json(m, keypair.raw_public_key, level), iterations)
+            results["decrypt_decompress_json/%d/level%d" % (size, level)] = measure(lambda: encryption.decrypt_decompress_json(cipher, keypair.raw_private_key), iterations)
+
+    # The node_join reply: node addresses with their keys
+    nodes = dict(("tcp://10.0.%d.%d:4363" % (i // 256, i % 256), (KeyPair().public_key, 1)) for i in range(20))
+    nodes["response"] = "node_join_approved"
+    for c in codec.CODECS:
+        cipher = encryption.encrypt_compress(nodes, keypair.raw_public_key, c)
+        results["encrypt_compress/%s/node_join_approved" % (c.name)] = measure(lambda: encryption.encrypt_compress(nodes, keypair.raw_public_key, c), iterations)
+        results["decrypt_decompress/%s/node_join_approved" % (c.name)] = measure(lambda: encryption.decrypt_decompress(cipher, keypair.raw_private_key), iterations)
+
+
+def benchmark_node(results, iterations, transport, directory):
+    configuration = Configuration(os.path.join(directory, "node-%s.cfg" % (transport)), flush_delay=60)
+    if transport == "inproc":
+        address = "inproc://jodawg-benchmark"
+    else:
+        address = "tcp://127.0.0.1:%d" % (random.randint(20000, 60000))
+    configuration.config["node"]["address"] = address
+
+    encryption = Encryption(SessionCache())
+    node = Node(configuration, encryption)
+    node.add_service("overlay", OverlayService(configuration, encryption))
+    node_keypair = configuration.get_node_keypair()
+    node.start()
+
+    # inproc only works within one context
+    context = node.context if transport == "inproc" else zmq.Context()
+    socket = context.socket(zmq.REQ)
+    time.sleep(0.1) # inproc requires bind before connect
+    socket.connect(address)
+
+    client = Encryption(SessionCache())
+    client_keypair = KeyPair()
+    signature = client.sign(client_keypair.raw_public_key, client_keypair.raw_private_key)
+    join = { "request" : "node_join", "node_address" : "tcp://127.0.0.1:1", "node_public_key" : client_keypair.b64_public_key, "signature" : signature }
+    leave = { "request" : "node_leave", "node_address" : "tcp://127.0.0.1:2", "signature" : signature } # denied: unknown node
+
+    def round_trip(m):
+        socket.send(client.encrypt_compress_json(m, node_keypair.raw_public_key))
+        socket.recv()
+
+    results["node/%s/node_join" % (transport)] = measure(lambda: round_trip(join), iterations)
+    results["node/%s/node_leave_denied" % (transport)] = measure(lambda: round_trip(leave), iterations)
+
+    socket.close(linger=0)
+    node.terminate()
+    node.join()
+    configuration.close()
+
+
+def compare(results, baseline, tolerance):
+    """Compares the throughput of @results against @baseline.
+
+       @return A list of (benchmark name, relative change) of the regressions.
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = result["ops_per_second"] / baseline[name]["ops_per_second"] - 1.0
+        marker = ""
+        if change < -tolerance:
+            regressions.append((name, change))
+            marker = "  <-- REGRESSION"
+        print("%-50s %+7.1f%%%s" % (name, 100 * change, marker))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Jodawg benchmarks")
+    parser.add_argument("-i", "--iterations", type=int, default=50, help="Iterations per benchmark.")
+    parser.add_argument("-o", "--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("-b", "--baseline", type=str, help="Compare against the results in this JSON file.")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2, help="Allowed relative throughput loss against the baseline.")
+    parser.add_argument("suites", nargs="*", default=[ "crypto", "codec", "node" ], help="Suites to run (crypto, codec, node).")
+    args = parser.parse_args()
+
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        if "crypto" in args.suites:
+            benchmark_crypto(results, args.iterations)
+        if "codec" in args.suites:
+            benchmark_codec(results, args.iterations)
+        if "node" in args.suites:
+            for transport in [ "tcp", "inproc" ]:
+                benchmark_node(results, args.iterations, transport, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    for (name, result) in sorted(results.items()):
+        print("%-50s %10.1f ops/s  p50 %8.3f ms  p99 %8.3f ms" % (name, result["ops_per_second"], result["p50_ms"], result["p99_ms"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({ "python" : platform.python_version(), "machine" : platform.machine(), "time" : time.time(), "results" : results }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print("\nCompared to baseline %s:" % (args.baseline))
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import sys
+import os
+import zmq
+import threading
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import codec
+from lib.admission import Admission, TokenBucket, requested_cookie
+from lib.connections import ConnectionManager, requester
+from lib.encryption import Encryption, KeyPair
+from lib.network import Node, Reply
+from lib.overlay import OverlayService
+from lib.session import SessionCache
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def testRate(self):
+        bucket = TokenBucket(10, 5, 0.0)
+        self.assertTrue(all(bucket.take(0.0) for i in range(5)))
+        self.assertFalse(bucket.take(0.0))
+        self.assertAlmostEqual(0.1, bucket.retry_after())
+        self.assertTrue(bucket.take(0.1))
+        self.assertFalse(bucket.take(0.1))
+        self.assertTrue(bucket.take(10.0))
+        self.assertEqual(4, int(bucket.tokens)) # Never more than the burst
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def testRateLimit(self):
+        admission = Admission(rate=1, burst=2, expensive_rate=100, expensive_burst=100)
+        self.assertIsNone(admission.admit(b"junk", "tcp://10.0.0.1:4363", now=0.0))
+        self.assertIsNone(admission.admit(b"junk", "tcp://10.0.0.1:4363", now=0.0))
+        reply = codec.JSON.decode(admission.admit(b"junk", "tcp://10.0.0.1:4363", now=0.0))
+        self.assertEqual("rate_limited", reply["reason"])
+        self.assertIsNone(admission.admit(b"junk", "tcp://10.0.0.2:4363", now=0.0)) # Per source
+
+        # Behind a ROUTER socket, the routing identity has a bucket as well
+        self.assertIsNone(admission.admit(b"junk", None, b"peer", now=0.0))
+        self.assertIsNone(admission.admit(b"junk", None, b"peer", now=0.0))
+        self.assertIsNotNone(admission.admit(b"junk", None, b"peer", now=0.0))
+
+        # Requests of which nobody knows where they came from share a bucket,
+        # public key decryption included
+        admission = Admission(rate=100, burst=100, expensive_rate=0.001, expensive_burst=2)
+        self.assertIsNone(admission.admit(b"junk", None, now=0.0))
+        self.assertIsNone(admission.admit(b"junk", None, now=0.0))
+        self.assertIsNotNone(admission.admit(b"junk", None, now=0.0))
+
+    def testBatches(self):
+        admission = Admission(rate=0.001, burst=10)
+        self.assertIsNone(admission.admit(b"junk", "tcp://10.0.0.1:4363", now=0.0))
+        self.assertTrue(admission.admit_batch(8, "tcp://10.0.0.1:4363", now=0.0)) # The frame paid for one
+        self.assertFalse(admission.admit_batch(4, "tcp://10.0.0.1:4363", now=0.0))
+        self.assertTrue(admission.admit_batch(3, "tcp://10.0.0.1:4363", now=0.0)) # Nothing was taken
+        self.assertFalse(admission.admit_batch(2, "tcp://10.0.0.1:4363", now=0.0))
+        self.assertTrue(admission.admit_batch(2, "tcp://10.0.0.2:4363", now=0.0))
+
+    def testSignatureChecks(self):
+        admission = Admission(expensive_rate=0.001, expensive_burst=2)
+        self.assertTrue(all(admission.take_public_key(now=0.0) for i in range(5))) # Our own are free
+
+        admission.handling("tcp://10.0.0.1:4363")
+        self.assertTrue(admission.take_public_key(now=0.0))
+        self.assertTrue(admission.take_public_key(now=0.0))
+        self.assertFalse(admission.take_public_key(now=0.0))
+        admission.handling("tcp://10.0.0.2:4363")
+        self.assertTrue(admission.take_public_key(now=0.0))
+        admission.finished()
+        self.assertTrue(admission.take_public_key(now=0.0))
+
+        # Signatures are no longer checked once a source runs out of tokens
+        admission = Admission(expensive_rate=0.0001, expensive_burst=1)
+        keypair = KeyPair()
+        encryption = Encryption()
+        encryption.verify_gate = admission.take_public_key
+        signature = encryption.sign(b"alive", keypair.raw_private_key)
+        self.assertTrue(encryption.verify(b"alive", signature, keypair.raw_public_key))
+        admission.handling("tcp://10.0.0.1:4363")
+        try:
+            self.assertTrue(encryption.verify(b"alive", signature, keypair.raw_public_key))
+            self.assertFalse(encryption.verify(b"alive", signature, keypair.raw_public_key))
+        finally:
+            admission.finished()
+
+    def testCookies(self):
+        admission = Admission(capacity=1, cookie_lifetime=60)
+        cookie = admission.cookie("tcp://10.0.0.1:4363", 1000.0)
+        self.assertTrue(admission.check_cookie("tcp://10.0.0.1:4363", cookie, 1000.0))
+        self.assertTrue(admission.check_cookie("tcp://10.0.0.1:4363", cookie, 1050.0)) # Previous slot
+        self.assertFalse(admission.check_cookie("tcp://10.0.0.1:4363", cookie, 1200.0))
+        self.assertFalse(admission.check_cookie("tcp://10.0.0.2:4363", cookie, 1000.0))
+        self.assertFalse(admission.check_cookie("tcp://10.0.0.1:4363", cookie[:-1] + b"\0", 1000.0))
+
+        # Under pressure, new peers need a cookie
+        self.assertIsNone(admission.admit(b"junk", "tcp://10.0.0.1:4363", now=0.0))
+        reply = codec.JSON.decode(admission.admit(b"junk", "tcp://10.0.0.1:4363", now=0.0))
+        cookie = requested_cookie(reply)
+        self.assertIsNotNone(cookie)
+        self.assertIsNone(admission.admit(b"junk", "tcp://10.0.0.1:4363", cookie=cookie, now=0.0))
+        self.assertIsNotNone(admission.admit(b"junk", "tcp://10.0.0.2:4363", cookie=cookie, now=0.0))
+
+    def testSessions(self):
+        keypair = KeyPair()
+        client = Encryption(SessionCache())
+        server = Encryption(SessionCache())
+        admission = Admission(server.sessions, capacity=1, expensive_rate=0.001, expensive_burst=1)
+
+        frame = client.encrypt_compress({ "request" : "ping" }, keypair.raw_public_key)
+        self.assertIsNone(admission.admit(frame, "tcp://10.0.0.1:4363", private_key=keypair.raw_private_key, now=0.0))
+        server.decrypt_decompress(frame, keypair.raw_private_key) # Establishes the session
+
+        # Known sessions only cost AES, they don't count against the public key rates
+        for i in range(5):
+            frame = client.encrypt_compress({ "request" : "ping" }, keypair.raw_public_key)
+            self.assertIsNone(admission.admit(frame, "tcp://10.0.0.1:4363", private_key=keypair.raw_private_key, now=0.0))
+        self.assertIsNotNone(admission.admit(b"junk", "tcp://10.0.0.1:4363", private_key=keypair.raw_private_key, now=0.0))
+
+
+class NodeServer(threading.Thread):
+    """Handles requests with a (not started) Node, on a REP socket, after admission."""
+
+    def __init__(self, context, address, node):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = context.socket(zmq.REP)
+        self.socket.bind(address)
+        self.node = node
+        self.decrypted = 0
+
+    def run(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart(copy=False)
+            except zmq.ContextTerminated:
+                break
+            rejection = self.node.admit(frames)
+            if rejection is None:
+                self.decrypted += 1
+            self.socket.send(self.node.handle_frames(frames) if rejection is None else rejection)
+        self.socket.close()
+
+
+class NodeAdmissionTestCase(unittest.TestCase):
+    def testCookieRetry(self):
+        keypair = KeyPair()
+        client = KeyPair()
+        configuration = type("Configuration", (object,), { "get_node_keypair" : lambda self: keypair })()
+        node = Node(configuration, Encryption(), _admission=Admission(capacity=1))
+        service = type("Echo", (object,), { "request_handlers" : lambda self: {
+            "echo" : lambda m: Reply({ "response" : "echo", "text" : m["text"] }, client.raw_public_key) } })()
+        node.add_service("echo", service)
+
+        context = zmq.Context()
+        server = NodeServer(context, "tcp://127.0.0.1:*", node)
+        address = server.socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        server.start()
+        manager = ConnectionManager(context)
+        manager.start()
+
+        legacy = requester(manager, Encryption(), address, keypair.raw_public_key, client.raw_private_key)
+        self.assertEqual("a", legacy({ "request" : "echo", "text" : "a" })["text"])
+        self.assertEqual("cookie_required", legacy({ "request" : "echo", "text" : "b" })["reason"])
+        self.assertEqual(1, server.decrypted) # The second one was dropped before decryption
+
+        request = requester(manager, Encryption(), address, keypair.raw_public_key, client.raw_private_key, service="echo")
+        self.assertEqual("c", request({ "request" : "echo", "text" : "c" })["text"]) # Retried with the cookie
+        self.assertEqual("d", request({ "request" : "echo", "text" : "d" })["text"]) # Cookie is remembered
+        self.assertEqual(3, server.decrypted)
+
+        manager.close()
+        context.term()
+        node.context.term()
+
+    def testJoinUnderLoad(self):
+        context = zmq.Context()
+        manager = ConnectionManager(context)
+        manager.start()
+
+        bootstrap = FakeConfiguration(KeyPair(), "tcp://127.0.0.1:*")
+        node = Node(bootstrap, Encryption(), _admission=Admission(capacity=1))
+        node.add_service("overlay", OverlayService(bootstrap, Encryption(), manager))
+        server = NodeServer(context, bootstrap.address, node)
+        bootstrap.address = server.socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        server.start()
+        node.admission.pressure.tokens = 0 # Under load, new peers need a cookie
+
+        joiner = FakeConfiguration(KeyPair(), "tcp://127.0.0.1:1", [ (bootstrap.address, bootstrap.keypair.public_key) ])
+        overlay = OverlayService(joiner, Encryption(), manager)
+        self.assertTrue(overlay.join())
+        self.assertIsNotNone(overlay.cookies.get(bootstrap.address))
+        self.assertIsNotNone(node.get_service("overlay").store.get_node(joiner.address))
+
+        manager.close()
+        context.term()
+        node.context.term()
+
+
+class FakeConfiguration(object):
+    def __init__(self, keypair, address, known_nodes=()):
+        self.keypair = keypair
+        self.address = address
+        self.known_nodes = list(known_nodes)
+
+    def get_node_keypair(self):
+        return self.keypair
+
+    def get_node_address(self):
+        return self.address
+
+    def get_known_nodes(self):
+        return self.known_nodes
+
+    def add_known_node(self, address, public_key):
+        pass
+
+    def get_bootstrap_ranking(self):
+        return []
+
+    def update_bootstrap_stats(self, address, success, seconds):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import sys
+import os
+import zmq
+import asyncio
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.aionetwork import AsyncNode, AsyncEncryption, PooledEncryption
+from lib.cache import VerificationCache
+from lib.connections import ConnectionManager, requester
+from lib.cryptopool import CryptoPool
+from lib.encryption import Encryption, KeyPair, CRYPTO_OPERATIONS, VERIFY_CACHE_LOOKUPS
+from lib.session import SessionCache
+from lib.overlay import OverlayService
+
+
+class FakeConfiguration(object):
+    def __init__(self, keypair, address):
+        self.keypair = keypair
+        self.address = address
+
+    def get_node_keypair(self):
+        return self.keypair
+
+    def get_node_address(self):
+        return self.address
+
+    def add_known_node(self, address, public_key):
+        pass
+
+
+class CountingPool(CryptoPool):
+    """Counts the jobs submitted to the workers."""
+
+    __slots__ = [ "jobs" ]
+
+    def __init__(self):
+        CryptoPool.__init__(self, 1)
+        self.jobs = []
+        submit = self.executor.submit
+        def counting(job, *args):
+            self.jobs.append(job.__name__)
+            return submit(job, *args)
+        self.executor.submit = counting
+
+
+def free_address():
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.bind("tcp://127.0.0.1:*")
+    address = socket.getsockopt_string(zmq.LAST_ENDPOINT)
+    socket.close()
+    context.term()
+    return address
+
+
+class AsyncEncryptionTestCase(unittest.TestCase):
+    def testSharesEncryption(self):
+        pool = CountingPool()
+        keypair = KeyPair()
+        encryption = Encryption(SessionCache(), VerificationCache())
+        crypto = AsyncEncryption(encryption, pool)
+        operations = CRYPTO_OPERATIONS.collect()
+        lookups = VERIFY_CACHE_LOOKUPS.collect()
+
+        async def run():
+            cipher = await crypto.encrypt_compress({ "value" : 42 }, keypair.raw_public_key)
+            await crypto.encrypt(b'again', keypair.raw_public_key) # Same session
+            signature = await crypto.sign(b'message', keypair.raw_private_key)
+            verified = [ await crypto.verify(b'message', signature, keypair.raw_public_key) for i in range(2) ]
+            return (cipher, signature, verified)
+        loop = asyncio.new_event_loop()
+        (cipher, signature, verified) = loop.run_until_complete(run())
+        loop.close()
+
+        self.assertEqual({ "value" : 42 }, Encryption().decrypt_decompress_json(cipher, keypair.raw_private_key))
+        self.assertTrue(Encryption().verify(b'message', signature, keypair.raw_public_key))
+        self.assertEqual([ True, True ], verified)
+        self.assertEqual([ "_encrypt", "_sign", "_verify" ], pool.jobs)
+        self.assertEqual(2, CRYPTO_OPERATIONS.collect().get(("encrypt",), 0) - operations.get(("encrypt",), 0))
+        self.assertEqual(1, VERIFY_CACHE_LOOKUPS.collect().get(("hit",), 0) - lookups.get(("hit",), 0))
+        pool.shutdown()
+
+
+class AsyncNodeTestCase(unittest.TestCase):
+    def testJoinRoundTrip(self):
+        pool = CountingPool()
+        configuration = FakeConfiguration(KeyPair(), free_address())
+        encryption = PooledEncryption(Encryption(), pool)
+        node = AsyncNode(configuration, encryption, pool)
+        overlay = OverlayService(configuration, encryption, ConnectionManager())
+        node.add_service("overlay", overlay)
+        node.start()
+
+        manager = ConnectionManager()
+        manager.start()
+        joiner = KeyPair()
+        client = Encryption()
+        request = requester(manager, client, configuration.address, configuration.keypair.raw_public_key, joiner.raw_private_key)
+        r = request({ "request" : "node_join", "node_address" : "tcp://127.0.0.1:1", "node_public_key" : joiner.public_key,
+                      "signature" : client.sign(joiner.raw_public_key, joiner.raw_private_key) })
+        self.assertEqual("node_join_approved", r["response"])
+        self.assertIsNotNone(overlay.store.get_node("tcp://127.0.0.1:1"))
+        self.assertIn("_verify", pool.jobs) # Not on the handler thread
+        self.assertIn("_decrypt", pool.jobs)
+
+        manager.close()
+        overlay.connections.close()
+        node.terminate()
+        node.join()
+        self.assertRaises(RuntimeError, pool.executor.submit, len, ()) # Shut down with the node
+        node.context.term()
+
+
+if __name__ == '__main__':
+    unittest.main()
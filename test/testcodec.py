@@ -0,0 +1,63 @@
+import sys
+import os
+import json
+import zlib
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import codec
+from lib.encryption import Key
+
+
+class CodecTestCase(unittest.TestCase):
+    def setUp(self):
+        self.key = Key(b"\x00\x01public\xff", True)
+        self.message = { "request" : "node_join", "node_public_key" : self.key, "nodes" : [ 1, -2**70, 2.5, None, True, False ],
+                         "data" : b"\x00\xff", "text" : "héllo" }
+
+    def testBinaryRoundTrip(self):
+        decoded = codec.BINARY.decode(codec.BINARY.encode(self.message))
+        self.assertEqual(self.key.raw_key, decoded["node_public_key"])
+        self.assertEqual([ 1, -2**70, 2.5, None, True, False ], decoded["nodes"])
+        self.assertEqual(b"\x00\xff", decoded["data"])
+        self.assertEqual("héllo", decoded["text"])
+
+    def testKeysFromWire(self):
+        for c in [ codec.JSON, codec.BINARY ]:
+            decoded = c.decode(c.encode(self.message))
+            self.assertEqual(self.key.raw_key, Key.from_wire(decoded["node_public_key"]).raw_key)
+
+    def testEnvelopeVersion(self):
+        (message, used) = codec.decode_envelope(codec.encode_envelope({ "a" : 1 }, codec.BINARY))
+        self.assertEqual({ "a" : 1 }, message)
+        self.assertIs(codec.BINARY, used)
+
+    def testLegacyEnvelope(self):
+        legacy = zlib.compress(json.dumps({ "request" : "node_leave" }).encode('utf-8'), 9)
+        self.assertEqual(({ "request" : "node_leave" }, None), codec.decode_envelope(legacy))
+
+    def testMalformed(self):
+        self.assertRaises(codec.CodecError, codec.decode_envelope, b"\x7fgarbage")
+        self.assertRaises(codec.CodecError, codec.BINARY.decode, b"s\x00\x00\x00\x09abc")
+        self.assertRaises(codec.CodecError, codec.BINARY.decode, b"NN")
+
+    def testHostile(self):
+        # Counts larger than the data are rejected before anything is allocated
+        self.assertRaises(codec.CodecError, codec.BINARY.decode, b"l\x10\x00\x00\x00")
+        self.assertRaises(codec.CodecError, codec.BINARY.decode, b"m\x10\x00\x00\x00NN")
+        self.assertRaises(codec.CodecError, codec.BINARY.decode, b"l\x00\x00\x00\x01" * 1000 + b"N")
+        self.assertEqual([ [ None ] ], codec.BINARY.decode(b"l\x00\x00\x00\x01l\x00\x00\x00\x01N"))
+
+        bomb = bytes((codec.BINARY.version,)) + zlib.compress(b"s" + b"\x00" * (codec.MAX_MESSAGE_BYTES + 1))
+        self.assertRaises(codec.CodecError, codec.decode_envelope, bomb)
+        self.assertRaises(codec.CodecError, codec.decode_envelope, zlib.compress(b"[" * 100000 + b"]" * 100000))
+
+    def testNegotiate(self):
+        self.assertIsNone(codec.negotiate(None))
+        self.assertIs(codec.JSON, codec.negotiate([ "unknown" ]))
+        self.assertIs(codec.BINARY, codec.negotiate([ "unknown", "binary", "json" ]))
+        self.assertIs(codec.JSON, codec.negotiate([ "json", "binary" ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.configuration import Configuration
+from lib.encryption import Key
+
+
+class ConfigurationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, "jodawg.cfg")
+        self.key = Key(b"public key", True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testWriteBehind(self):
+        configuration = Configuration(self.location, flush_delay=60)
+        for i in range(100):
+            configuration.add_known_node("tcp://10.0.0.%d:4363" % (i), self.key)
+        self.assertTrue(configuration.has_known_node("tcp://10.0.0.42:4363"))
+        with open(self.location) as f:
+            self.assertFalse("10.0.0.42" in f.read()) # not written yet
+        configuration.close()
+        with open(self.location) as f:
+            self.assertTrue("10.0.0.42" in f.read())
+        self.assertEqual(0, os.path.getsize(self.location + ".journal"))
+
+    def testJournalReplay(self):
+        configuration = Configuration(self.location, flush_delay=60)
+        configuration.add_known_node("tcp://10.0.0.1:4363", self.key)
+        configuration.add_known_node("tcp://10.0.0.2:4363", self.key)
+        configuration.remove_known_node("tcp://10.0.0.1:4363")
+        # No close(): as if the process crashed
+        recovered = Configuration(self.location)
+        self.assertEqual([ ("tcp://10.0.0.2:4363", self.key.b64_key) ], [ (a, k.b64_key) for (a, k) in recovered.get_known_nodes() ])
+
+    def testTornJournal(self):
+        configuration = Configuration(self.location, flush_delay=60)
+        configuration.add_known_node("tcp://10.0.0.1:4363", self.key)
+        with open(self.location + ".journal", "a") as f:
+            f.write('["set", "known_nodes", "tcp://10.0.0')
+        recovered = Configuration(self.location)
+        self.assertEqual([ "tcp://10.0.0.1:4363" ], [ a for (a, k) in recovered.get_known_nodes() ])
+
+    def testBootstrapRanking(self):
+        configuration = Configuration(self.location, flush_delay=60)
+        for i in range(3):
+            configuration.add_known_node("tcp://10.0.0.%d:4363" % (i), self.key)
+        configuration.update_bootstrap_stats("tcp://10.0.0.0:4363", False, 1.0)
+        configuration.update_bootstrap_stats("tcp://10.0.0.1:4363", True, 2.0)
+        configuration.update_bootstrap_stats("tcp://10.0.0.2:4363", True, 0.5)
+        self.assertEqual([ "tcp://10.0.0.2:4363", "tcp://10.0.0.1:4363", "tcp://10.0.0.0:4363" ], configuration.get_bootstrap_ranking())
+
+        configuration.remove_known_node("tcp://10.0.0.2:4363")
+        self.assertFalse(configuration.config.has_option("bootstrap_stats", "tcp://10.0.0.2:4363"))
+        configuration._remove("known_nodes", "tcp://10.0.0.1:4363") # As if removed by an older version
+        self.assertEqual([ "tcp://10.0.0.0:4363" ], configuration.get_bootstrap_ranking())
+        self.assertEqual([ "tcp://10.0.0.0:4363" ], configuration.config.options("bootstrap_stats"))
+        configuration.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import sys
+import os
+import zmq
+import threading
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.connections import ConnectionManager, Coalescer, RequestError
+from lib.encryption import Encryption, KeyPair
+from lib.network import Node, Reply
+
+
+class RecordingEncryption(Encryption):
+    """Records the threads that decrypt replies."""
+
+    def __init__(self):
+        Encryption.__init__(self)
+        self.threads = set()
+
+    def decrypt_decompress(self, cipher, private_key):
+        self.threads.add(threading.current_thread())
+        return Encryption.decrypt_decompress(self, cipher, private_key)
+
+
+class EchoServer(threading.Thread):
+    """Answers every request with its payload in upper case, on a REP socket."""
+
+    def __init__(self, context, address, requests):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = context.socket(zmq.REP)
+        self.socket.bind(address)
+        self.requests = requests
+
+    def run(self):
+        for i in range(self.requests):
+            self.socket.send(self.socket.recv().upper())
+        self.socket.close()
+
+
+class NodeServer(threading.Thread):
+    """Handles requests with a (not started) Node, on a REP socket."""
+
+    def __init__(self, context, address, node):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = context.socket(zmq.REP)
+        self.socket.bind(address)
+        self.node = node
+        self.frames = 0
+
+    def run(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart(copy=False)
+            except zmq.ContextTerminated:
+                break
+            self.frames += 1
+            self.socket.send(self.node.handle_frames(frames))
+        self.socket.close()
+
+
+class ConnectionManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.manager = ConnectionManager(self.context, max_connections=2)
+        self.manager.start()
+
+    def tearDown(self):
+        self.manager.close()
+        self.context.term()
+
+    def testRequests(self):
+        server = EchoServer(self.context, "inproc://echo", 50)
+        server.start()
+        futures = [ self.manager.request("inproc://echo", b"message %d" % (i)) for i in range(50) ]
+        self.assertEqual([ b"MESSAGE %d" % (i) for i in range(50) ], [ future.result() for future in futures ])
+        self.assertEqual(1, len(self.manager.peers)) # One connection, reused
+        server.join()
+
+    def testTimeoutAndLimit(self):
+        silent = self.context.socket(zmq.ROUTER)
+        silent.bind("inproc://silent")
+        self.assertRaises(RequestError, self.manager.call, "inproc://silent", b"hello", 0.2)
+
+        slow = [ self.manager.request("inproc://silent-%d" % (i), b"hello", 1.0) for i in range(2) ]
+        self.assertRaises(RequestError, self.manager.call, "inproc://silent-2", b"hello", 1.0) # Too many connections
+        self.assertRaises(RequestError, slow[0].result)
+        silent.close()
+
+    def testClose(self):
+        self.manager.close()
+        self.manager.close() # Twice is harmless
+        self.assertRaises(RequestError, self.manager.call, "inproc://echo", b"hello")
+
+        unstarted = ConnectionManager(self.context)
+        future = unstarted.request("inproc://echo", b"hello")
+        unstarted.close()
+        self.assertRaises(RequestError, future.result)
+        self.assertIsNone(unstarted.wakeup_write) # The pipe is closed without a thread
+        unstarted.close()
+
+    def testCoalescer(self):
+        keypair = KeyPair()
+        client = KeyPair()
+        configuration = type("Configuration", (object,), { "get_node_keypair" : lambda self: keypair })()
+        node = Node(configuration, Encryption())
+        service = type("Echo", (object,), { "request_handlers" : lambda self: {
+            "echo" : lambda m: Reply({ "response" : "echo", "text" : m["text"] }, client.raw_public_key) } })()
+        node.add_service("echo", service)
+        server = NodeServer(self.context, "inproc://node", node)
+        server.start()
+
+        encryption = RecordingEncryption()
+        coalescer = Coalescer(self.manager, encryption, "inproc://node", keypair.raw_public_key, client.raw_private_key,
+                              headers=True, window=0.05, max_requests=10)
+        futures = [ coalescer.submit({ "request" : "echo", "text" : "%d" % (i) }) for i in range(25) ]
+        self.assertEqual([ "%d" % (i) for i in range(25) ], [ future.result()["text"] for future in futures ])
+        self.assertEqual(3, server.frames) # 10 + 10 + 5
+        self.assertNotIn(self.manager, encryption.threads) # Not decrypted on the I/O thread
+
+        # Everyone sending to a node shares its coalescer
+        shared = self.manager.coalescer(Encryption(), "inproc://node", keypair.raw_public_key, client.raw_private_key)
+        self.assertIs(shared, self.manager.coalescer(Encryption(), "inproc://node", keypair.raw_public_key, client.raw_private_key))
+        self.assertEqual("shared", shared.request({ "request" : "echo", "text" : "shared" })["text"])
+        self.assertIsNot(shared, self.manager.coalescer(Encryption(), "inproc://node", client.raw_public_key, client.raw_private_key)) # Rejoined with a new key
+        node.context.term()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,20 +4,133 @@ import unittest
 sys.path.insert(0, os.path.join('..', 'p2p'))
 
 from lib.encryption import Encryption, KeyPair
+from lib.session import SessionCache, is_session_frame
+from lib.cache import VerificationCache
+from lib.cryptopool import CryptoPool
+from lib import multirecipient
 
 
 class EncryptionTestCase(unittest.TestCase):
     def testEncrypt(self):
         kp = KeyPair()
         e = Encryption()
-        msg = 'hello world'
-        cipher = e.encrypt(msg, kp.public_key)
-        msg2 = e.decrypt(cipher, kp.private_key)
+        msg = b'hello world'
+        cipher = e.encrypt(msg, kp.raw_public_key)
+        msg2 = e.decrypt(cipher, kp.raw_private_key)
         self.assertEqual(msg, msg2)
 
 
+class SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kp = KeyPair()
+        self.sender = Encryption(SessionCache())
+        self.receiver = Encryption(SessionCache())
+
+    def testRoundTrip(self):
+        for msg in [b'hello world', b'', b'x' * 10000]:
+            cipher = self.sender.encrypt(msg, self.kp.raw_public_key)
+            self.assertTrue(is_session_frame(cipher))
+            self.assertEqual(msg, self.receiver.decrypt(cipher, self.kp.raw_private_key))
+
+    def testSessionReused(self):
+        c1 = self.sender.encrypt(b'one', self.kp.raw_public_key)
+        c2 = self.sender.encrypt(b'two', self.kp.raw_public_key)
+        self.assertEqual(c1[:20], c2[:20]) # same session identifier
+        self.receiver.decrypt(c1, self.kp.raw_private_key)
+        self.receiver.decrypt(c2, self.kp.raw_private_key)
+        self.assertEqual(1, self.receiver.sessions.inbound.hits)
+
+    def testRekey(self):
+        self.sender.sessions.max_messages = 1
+        c1 = self.sender.encrypt(b'one', self.kp.raw_public_key)
+        c2 = self.sender.encrypt(b'two', self.kp.raw_public_key)
+        self.assertNotEqual(c1[:20], c2[:20])
+        self.assertEqual(b'two', self.receiver.decrypt(c2, self.kp.raw_private_key))
+
+    def testStatelessReceiver(self):
+        cipher = self.sender.encrypt(b'hello', self.kp.raw_public_key)
+        self.assertEqual(b'hello', Encryption().decrypt(cipher, self.kp.raw_private_key))
+
+    def testTampered(self):
+        cipher = bytearray(self.sender.encrypt(b'hello', self.kp.raw_public_key))
+        cipher[-1] ^= 1
+        self.assertRaises(Exception, self.receiver.decrypt, bytes(cipher), self.kp.raw_private_key)
+
+    def testCompressJson(self):
+        m = { "request" : "node_join", "value" : 42 }
+        cipher = self.sender.encrypt_compress_json(m, self.kp.raw_public_key)
+        self.assertEqual(m, self.receiver.decrypt_decompress_json(cipher, self.kp.raw_private_key))
+
+
+class VerificationCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kp = KeyPair()
+        self.cache = VerificationCache(max_entries=2, negative_ttl=0)
+        self.encryption = Encryption(verify_cache=self.cache)
+        self.signature = self.encryption.sign(self.kp.raw_public_key, self.kp.raw_private_key)
+
+    def testPositiveCached(self):
+        for i in range(3):
+            self.assertTrue(self.encryption.verify(self.kp.raw_public_key, self.signature, self.kp.raw_public_key))
+        self.assertEqual((2, 1), (self.cache.hits, self.cache.misses))
+        self.assertAlmostEqual(2.0 / 3, self.cache.hit_ratio)
+
+    def testNegativeNotCached(self):
+        for i in range(2):
+            self.assertFalse(self.encryption.verify(b'other', self.signature, self.kp.raw_public_key))
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
 
-if __name__ == '__main__':
-    unittest.main()
 
+class BatchTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = CryptoPool(2)
+        cls.keypairs = [ KeyPair() for i in range(3) ]
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+
+    def testEncryptMany(self):
+        e = Encryption(SessionCache())
+        jobs = [ (b'message %d' % (i), kp.raw_public_key) for (i, kp) in enumerate(self.keypairs) ] + [ (b'lost', b'not a key') ]
+        results = e.encrypt_many(jobs, self.pool)
+        self.assertEqual([ True, True, True, False ], [ ok for (ok, result) in results ])
+        for (i, kp) in enumerate(self.keypairs):
+            self.assertEqual(b'message %d' % (i), Encryption().decrypt(results[i][1], kp.raw_private_key))
+
+    def testEncryptManySerial(self):
+        e = Encryption(SessionCache())
+        jobs = [ (b'message %d' % (i), kp.raw_public_key) for (i, kp) in enumerate(self.keypairs) ]
+        results = e.encrypt_many(jobs, pool=None) # Wraps the session keys on this thread
+        self.assertTrue(all(ok for (ok, result) in results))
+        for (i, kp) in enumerate(self.keypairs):
+            self.assertEqual(b'message %d' % (i), Encryption(SessionCache()).decrypt(results[i][1], kp.raw_private_key))
+
+    def testVerifyMany(self):
+        e = Encryption()
+        kp = self.keypairs[0]
+        signature = e.sign(b'join', kp.raw_private_key)
+        results = e.verify_many([ (b'join', signature, kp.raw_public_key), (b'forged', signature, kp.raw_public_key) ], self.pool)
+        self.assertEqual([ (True, True), (True, False) ], results)
+
+
+class MultiRecipientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keypairs = [ KeyPair() for i in range(3) ]
+        self.encryption = Encryption(SessionCache())
+
+    def testEveryRecipientOpens(self):
+        (envelope, failed) = multirecipient.seal(self.encryption, b'hello group', [ kp.raw_public_key for kp in self.keypairs ] + [ b'not a key' ])
+        self.assertEqual([ b'not a key' ], failed)
+        for kp in self.keypairs:
+            self.assertEqual(b'hello group', multirecipient.open_for(Encryption(), envelope, kp.raw_public_key, kp.raw_private_key))
+
+    def testOutsider(self):
+        (envelope, failed) = multirecipient.seal(self.encryption, b'hello group', [ kp.raw_public_key for kp in self.keypairs[:2] ])
+        outsider = self.keypairs[2]
+        self.assertRaises(ValueError, multirecipient.open_for, Encryption(), envelope, outsider.raw_public_key, outsider.raw_private_key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import sys
+import os
+import time
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import codec
+from lib.connections import RequestError
+from lib.forward import ForwardStore, QueueFull, StoreAndForwardService
+from lib.overlay import OverlayNode, OverlayStore
+from lib.encryption import Key
+
+
+class FakeConfiguration(object):
+    def __init__(self, address="tcp://10.0.0.2:4363", private_key=b"bob", known_nodes=()):
+        self.address = address
+        self.keypair = type("KeyPair", (object,), { "raw_private_key" : private_key })()
+        self.known_nodes = list(known_nodes)
+
+    def get_node_address(self):
+        return self.address
+
+    def get_node_keypair(self):
+        return self.keypair
+
+    def get_known_nodes(self):
+        return self.known_nodes
+
+    def get_bootstrap_ranking(self):
+        return []
+
+
+class FakeEncryption(object):
+    """Encodes, without encrypting: private and public keys are the same."""
+
+    def encrypt_compress(self, m, public_key):
+        return codec.BINARY.encode({ "key" : public_key, "m" : m })
+
+    def decrypt_decompress(self, frame, private_key):
+        d = codec.BINARY.decode(frame)
+        if d["key"] != private_key:
+            raise ValueError("not for us")
+        return (d["m"], codec.BINARY)
+
+
+class FakeConnections(object):
+    """Hands requests to the handlers of the nodes that are up (through the binary codec)."""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def coalescer(self, encryption, address, public_key, private_key):
+        nodes = self.nodes
+        class Requester(object):
+            def request(self, m, timeout=None):
+                if address not in nodes:
+                    raise RequestError("no reply from %s" % (address))
+                m = codec.BINARY.decode(codec.BINARY.encode(m))
+                return nodes[address][m["request"]](m).message
+        return Requester()
+
+
+class FakeRouter(object):
+    def __init__(self):
+        self.handled = []
+
+    def route(self, message):
+        return ("echo", self.handled.append)
+
+
+class ForwardStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testStoreFetchAck(self):
+        store = ForwardStore(self.directory)
+        for i in range(10):
+            store.store(b"bob", ("message %d" % (i)).encode(), 60)
+        (batch, more) = store.fetch(b"bob", 4)
+        self.assertEqual([ 1, 2, 3, 4 ], [ sequence for (sequence, payload) in batch ])
+        self.assertTrue(more)
+        store.ack(b"bob", 4)
+        self.assertEqual(6, store.pending(b"bob"))
+        store.close()
+
+        # Survives a restart
+        store = ForwardStore(self.directory)
+        (batch, more) = store.fetch(b"bob")
+        self.assertEqual((b"message 4", False), (batch[0][1], more))
+        store.ack(b"bob", 10)
+        self.assertEqual(([], False), store.fetch(b"bob"))
+        self.assertEqual(11, store.store(b"bob", b"later", 60))
+        store.close()
+
+    def testOverflow(self):
+        store = ForwardStore(self.directory, max_queue_messages=3)
+        store.store(b"bob", b"expired", 0)
+        for i in range(3):
+            store.store(b"bob", b"x", 60) # The expired message makes room
+        self.assertRaises(QueueFull, store.store, b"bob", b"y", 60)
+
+        # Nothing expired, so a rejected store leaves the queue file alone
+        path = store._path(store.fingerprint(b"bob"))
+        inode = os.stat(path).st_ino
+        self.assertRaises(QueueFull, store.store, b"bob", b"y", 60)
+        self.assertEqual(inode, os.stat(path).st_ino)
+        store.close()
+
+        store = ForwardStore(self.directory, max_queue_messages=3, drop_oldest=True)
+        store.store(b"bob", b"y", 60)
+        self.assertEqual([ 3, 4, 5 ], [ sequence for (sequence, payload) in store.fetch(b"bob")[0] ])
+        store.close()
+
+
+class StoreAndForwardServiceTestCase(unittest.TestCase):
+    def testDrain(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = OverlayStore()
+            store.update_node(OverlayNode("tcp://10.0.0.1:4363", Key(b"alice", True)))
+            store.update_node(OverlayNode("tcp://10.0.0.2:4363", Key(b"bob", True)))
+            service = StoreAndForwardService(FakeConfiguration(), None, store, directory)
+            handlers = service.request_handlers()
+
+            for i in range(200):
+                m = { "request" : "forward-store", "node_address" : "tcp://10.0.0.1:4363",
+                      "recipient" : b"bob", "payload" : b"%d" % (i), "ttl" : 60 }
+                self.assertEqual("forward-store_approved", handlers["forward-store"](m).message["response"])
+
+            received = []
+            request = lambda m: handlers[m["request"]](m).message
+            self.assertEqual(200, service.drain(request, received.append))
+            self.assertEqual(b"199", received[-1])
+            self.assertEqual(0, service.forward_store.pending(b"bob"))
+
+            # An ack needs the token of the previous reply, which only the recipient can read
+            handlers["forward-store"]({ "request" : "forward-store", "node_address" : "tcp://10.0.0.1:4363",
+                                        "recipient" : b"bob", "payload" : b"secret", "ttl" : 60 })
+            forged = { "request" : "forward-fetch", "node_address" : "tcp://10.0.0.2:4363", "ack" : 2**62 }
+            self.assertEqual("forward-fetch_denied", request(forged)["response"])
+            forged["ack_token"] = b"\x00" * 16
+            self.assertEqual("forward-fetch_denied", request(forged)["response"])
+            self.assertEqual(1, service.forward_store.pending(b"bob"))
+
+            # Fetches and forged acks in the recipient's name don't lock it out
+            spoofed = request({ "request" : "forward-fetch", "node_address" : "tcp://10.0.0.2:4363" })
+            self.assertEqual("forward-fetch_denied", request(forged)["response"])
+            self.assertEqual(1, service.drain(request, received.append))
+            self.assertEqual(0, service.forward_store.pending(b"bob"))
+            self.assertEqual("forward-fetch_denied", request(dict(forged, ack=1, ack_token=spoofed["ack_token"]))["response"]) # Used up
+
+            m = { "request" : "forward-fetch", "node_address" : "tcp://10.0.0.2:4363", "max" : "64" }
+            self.assertEqual("forward-fetch_denied", request(m)["response"])
+            m = { "request" : "forward-store", "node_address" : "tcp://10.0.0.1:4363", "recipient" : b"bob", "payload" : b"x", "ttl" : "60" }
+            self.assertEqual("forward-store_denied", handlers["forward-store"](m).message["response"])
+            service.forward_store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def testRelay(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = OverlayStore()
+            store.update_node(OverlayNode("tcp://10.0.0.1:4363", Key(b"alice", True)))
+            store.update_node(OverlayNode("tcp://10.0.0.2:4363", Key(b"bob", True)))
+            relay = StoreAndForwardService(FakeConfiguration("tcp://10.0.0.3:4363", b"relay"), FakeEncryption(), store, directory)
+            nodes = { "tcp://10.0.0.3:4363" : relay.request_handlers() }
+            known = [ ("tcp://10.0.0.3:4363", Key(b"relay", True)) ]
+
+            alice = StoreAndForwardService(FakeConfiguration("tcp://10.0.0.1:4363", b"alice", known), FakeEncryption(), OverlayStore(),
+                                           _connections=FakeConnections(nodes))
+            self.assertEqual({}, alice.request_handlers()) # Relays nothing for others
+            self.assertIsNone(alice.send("tcp://10.0.0.2:4363", b"bob", { "request" : "echo", "text" : "hi" })) # Bob is off-line
+            self.assertEqual(1, relay.forward_store.pending(b"bob"))
+
+            router = FakeRouter()
+            bob = StoreAndForwardService(FakeConfiguration("tcp://10.0.0.2:4363", b"bob", known), FakeEncryption(), OverlayStore(),
+                                         _connections=FakeConnections(nodes), _router=router)
+            self.assertEqual(1, bob.drain_relays()) # After his join
+            self.assertEqual([ { "request" : "echo", "text" : "hi" } ], router.handled)
+            self.assertEqual(0, relay.forward_store.pending(b"bob"))
+
+            del nodes["tcp://10.0.0.3:4363"]
+            self.assertRaises(RequestError, alice.send, "tcp://10.0.0.2:4363", b"bob", { "request" : "echo", "text" : "hi" })
+            self.assertEqual(0, bob.drain_relays())
+            relay.forward_store.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import sys
+import os
+import math
+import time
+import hashlib
+import random
+import threading
+import unittest
+import concurrent.futures
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import codec
+from lib import gossip
+from lib.gossip import Membership, GossipService, ALIVE, SUSPECT, DEAD, alive_statement
+from lib.connections import RequestError
+from lib.encryption import Key
+from lib.overlay import OverlayStore, OverlayNode
+
+
+def address(i):
+    return "tcp://10.0.%d.%d:4363" % (i >> 8, i & 255)
+
+
+def key(i):
+    return Key(b"key %d" % (i), True)
+
+
+class FakeEncryption(object):
+    """Signatures without the public key cryptography: private and public keys are the same."""
+
+    def sign(self, message, private_key):
+        return hashlib.sha256(private_key + message).hexdigest()
+
+    def verify(self, message, signature, public_key):
+        return signature == self.sign(message, public_key)
+
+    def decrypt_decompress_json(self, frame, private_key):
+        return frame
+
+
+ENCRYPTION = FakeEncryption()
+
+
+class FakeConfiguration(object):
+    def __init__(self, i):
+        self.address = address(i)
+        self.public_key = key(i)
+        self.raw_private_key = key(i).raw_key
+
+    def get_node_address(self):
+        return self.address
+
+    def get_node_keypair(self):
+        return self
+
+
+def signed(i, incarnation):
+    """@return The signature of the node at address(@i) that it is ALIVE at @incarnation."""
+    return ENCRYPTION.sign(alive_statement(address(i), incarnation), key(i).raw_key)
+
+
+class MembershipTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = OverlayStore()
+        self.membership = Membership(self.store, address(0), FakeConfiguration(0), ENCRYPTION, suspicion=1.0, incarnation=5)
+
+    def testPrecedence(self):
+        m = self.membership
+        self.assertTrue(m.apply(address(1), key(1), ALIVE, 3, signed(1, 3)))
+        self.assertEqual(OverlayNode.OVERLAY_NODE_STATUS_ONLINE, self.store.get_node(address(1)).status)
+        self.assertFalse(m.apply(address(1), None, ALIVE, 3, signed(1, 3))) # Old news
+        self.assertFalse(m.apply(address(1), None, ALIVE, 2, signed(1, 2)))
+        self.assertTrue(m.apply(address(1), None, SUSPECT, 3))
+        self.assertEqual(OverlayNode.OVERLAY_NODE_STATUS_DANGLING, self.store.get_node(address(1)).status)
+        self.assertFalse(m.apply(address(1), None, ALIVE, 3, signed(1, 3))) # Suspicion beats alive at the same incarnation
+        self.assertFalse(m.apply(address(1), None, ALIVE, 4))  # Only the node itself can refute
+        self.assertTrue(m.apply(address(1), None, ALIVE, 4, signed(1, 4)))
+        self.assertFalse(m.apply(address(1), None, DEAD, 9)) # Not an incarnation it signed
+        self.assertTrue(m.apply(address(1), None, DEAD, 4))
+        self.assertFalse(m.apply(address(1), None, SUSPECT, 4))
+        self.assertEqual(OverlayNode.OVERLAY_NODE_STATUS_OFFLINE, self.store.get_node(address(1)).status)
+
+        self.assertFalse(m.apply(address(2), None, ALIVE, 1, signed(2, 1))) # Unknown and no key
+        self.assertFalse(m.apply(address(2), key(2), ALIVE, 1)) # Unsigned
+        self.assertFalse(m.apply(address(2), key(2), ALIVE, 1, signed(3, 1))) # Signed by someone else
+        self.assertFalse(m.apply(address(2), key(2), SUSPECT, 1))
+        self.assertIsNone(self.store.get_node(address(2)))
+        self.assertTrue(m.apply(address(2), key(2), ALIVE, 1, signed(2, 1)))
+        self.assertFalse(m.apply(address(2), key(3), ALIVE, 2, signed(2, 2))) # Someone else's key
+
+    def testJoined(self):
+        m = self.membership
+        node = OverlayNode(address(1), key(1)) # The overlay adds it to the store
+        node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+        self.store.update_node(node)
+        m.joined(address(1), key(1), 7)
+        self.assertEqual(ALIVE, m.members[address(1)].status)
+        self.assertNotIn(address(1), [ u[0] for u in m.piggyback(100) ]) # Not signed, not gossiped
+        m.joined(address(1), key(1), 7, signed(1, 7))
+        self.assertIn((address(1), ALIVE, 7, signed(1, 7)), [ (u[0], u[2], u[3], u[4]) for u in m.piggyback(100) ])
+
+    def testRefute(self):
+        m = self.membership
+        self.assertFalse(m.apply(address(0), key(0), SUSPECT, 5))
+        self.assertEqual(6, m.incarnation)
+        updates = [ u for u in m.piggyback() if u[0] == address(0) ]
+        self.assertEqual([ (ALIVE, 6, signed(0, 6)) ], [ (u[2], u[3], u[4]) for u in updates ])
+
+    def testSuspicion(self):
+        m = self.membership
+        m.apply(address(1), key(1), ALIVE, 0, signed(1, 0))
+        m.suspect(address(1), now=100.0)
+        self.assertEqual([], m.expire(now=100.5))
+        self.assertEqual([ address(1) ], m.expire(now=110.0))
+        self.assertEqual(OverlayNode.OVERLAY_NODE_STATUS_OFFLINE, self.store.get_node(address(1)).status)
+        self.assertIsNone(m.next_target()) # Dead members are not probed
+
+    def testProbeOrder(self):
+        m = self.membership
+        for i in range(1, 11):
+            node = OverlayNode(address(i), key(i)) # Learned some other way, e.g. a join reply
+            node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+            self.store.update_node(node)
+        self.assertEqual(set(address(i) for i in range(1, 11)), set(m.next_target() for i in range(10)))
+
+    def testPiggyback(self):
+        m = self.membership
+        for i in range(1, 21):
+            m.apply(address(i), key(i), ALIVE, 0, signed(i, 0))
+        sent = {}
+        for i in range(200):
+            for update in m.piggyback():
+                sent[update[0]] = sent.get(update[0], 0) + 1
+        limit = int(math.ceil(gossip.RETRANSMIT * math.log2(22)))
+        self.assertEqual(21, len(sent))
+        self.assertTrue(all(count == limit for count in sent.values()))
+        self.assertEqual([], m.piggyback())
+
+
+class DisseminationTestCase(unittest.TestCase):
+    def testRounds(self):
+        """Simulates protocol periods: every node pings a random member,
+           and both sides merge the updates piggybacked on ping and ack."""
+        random.seed(7)
+        n = 128
+        stores = [ OverlayStore() for i in range(n) ]
+        members = [ Membership(stores[i], address(i), FakeConfiguration(i), ENCRYPTION, incarnation=1) for i in range(n) ]
+        for i in range(n): # Everyone knows everyone, and had nothing to gossip
+            for j in range(n):
+                if i != j:
+                    members[i].apply(address(j), key(j), ALIVE, 1, signed(j, 1))
+            members[i].updates.clear()
+
+        members[0].suspect(address(1), now=0.0)
+        rounds = 0
+        while not all(stores[i].get_node(address(1)).status == OverlayNode.OVERLAY_NODE_STATUS_DANGLING for i in range(2, n)):
+            rounds += 1
+            for i in range(n):
+                if i == 1:
+                    continue # Down, it can't refute
+                j = random.choice([ j for j in range(n) if j not in (i, 1) ])
+                members[j].merge(members[i].piggyback(), now=0.0)
+                members[i].merge(members[j].piggyback(), now=0.0)
+            self.assertLess(rounds, 4 * math.log2(n))
+
+
+class FakeOverlay(object):
+    """Records the requests sent, the test answers them by completing their future."""
+
+    def __init__(self):
+        self.store = OverlayStore()
+        self.sent = []
+        self.threads = [] # The thread each request was sent from
+
+    def send(self, address, public_key, m, service, timeout=5.0, header=False):
+        future = concurrent.futures.Future()
+        self.threads.append(threading.current_thread())
+        self.sent.append((address, codec.BINARY.decode(codec.BINARY.encode(m)), future))
+        return future
+
+    def codec_for(self, address):
+        return None
+
+    def wait(self, count):
+        deadline = time.monotonic() + 5.0
+        while len(self.sent) < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return self.sent[count - 1]
+
+
+class GossipServiceTestCase(unittest.TestCase):
+    def service(self, i, members):
+        service = GossipService(FakeConfiguration(i), ENCRYPTION, FakeOverlay(), interval=3.0)
+        for j in members:
+            service.membership.apply(address(j), key(j), ALIVE, 1, signed(j, 1))
+        return service
+
+    def testIndirectProbe(self):
+        prober = self.service(0, [ 1, 2 ])
+        helper = self.service(1, [ 0, 2 ])
+        outcome = []
+        probe = threading.Thread(target=lambda: outcome.append(prober.probe(address(2))))
+        probe.start()
+        prober.overlay.wait(1)[2].set_exception(RequestError("timeout")) # No direct ack
+        (to, request, future) = prober.overlay.wait(2)
+        self.assertEqual((address(1), "gossip_ping_req"), (to, request["request"]))
+
+        # The helper does not wait for the target before it answers
+        reply = helper.request_handlers()["gossip_ping_req"](request)
+        self.assertEqual("gossip_ping_req_accepted", reply.message["response"])
+        future.set_result(reply.message)
+        (to, ping, future) = helper.overlay.sent[-1]
+        self.assertEqual((address(2), "gossip_ping"), (to, ping["request"]))
+        future.set_result({ "response" : "gossip_ack", "incarnation" : 4, "signature" : signed(2, 4), "updates" : [] })
+        (to, ack, future) = helper.overlay.wait(2)
+        self.assertEqual((address(0), "gossip_indirect_ack", 4), (to, ack["request"], ack["target_incarnation"]))
+        self.assertIsNot(threading.current_thread(), helper.overlay.threads[1]) # Not on the thread that got the ack
+
+        # Only the members asked may ack
+        forged = dict(ack, node_address=address(3), node_public_key=key(3).raw_key, incarnation=1, signature=signed(3, 1))
+        prober.request_handlers()["gossip_indirect_ack"](forged)
+        self.assertTrue(probe.is_alive())
+        prober.request_handlers()["gossip_indirect_ack"](ack)
+        probe.join(5.0)
+        self.assertEqual([ True ], outcome)
+        self.assertEqual((ALIVE, 4), (prober.membership.members[address(2)].status, prober.membership.members[address(2)].incarnation))
+        self.assertEqual({}, prober.probes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import sys
+import os
+import math
+import random
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import kademlia
+from lib.encryption import Key
+
+
+def contact(i):
+    return kademlia.Contact("tcp://10.%d.%d.%d:4363" % (i >> 16, (i >> 8) & 255, i & 255), Key(b"key %d" % (i), True))
+
+
+class RoutingTableTestCase(unittest.TestCase):
+    def testBuckets(self):
+        table = kademlia.RoutingTable(0, k=2)
+        near = kademlia.Contact("tcp://10.0.0.1:4363", Key(b"a", True), 1)
+        self.assertIsNone(table.update(near))
+        a = kademlia.Contact("tcp://10.0.0.2:4363", Key(b"a", True), 1 << 100)
+        b = kademlia.Contact("tcp://10.0.0.3:4363", Key(b"b", True), (1 << 100) + 1)
+        c = kademlia.Contact("tcp://10.0.0.4:4363", Key(b"c", True), (1 << 100) + 2)
+        table.update(a)
+        table.update(b)
+        self.assertIs(a, table.update(c)) # Full, the oldest should be pinged
+        self.assertNotIn(c.id, table)
+        table.remove(a.id)
+        self.assertIn(c.id, table) # From the replacement cache
+        self.assertEqual([ near, b, c ], table.closest(0, 3))
+
+
+class LookupTestCase(unittest.TestCase):
+    def testLookup(self):
+        random.seed(3)
+        contacts = [ contact(i) for i in range(2000) ]
+        tables = {}
+        for c in contacts:
+            tables[c.id] = kademlia.RoutingTable(c.id)
+        for c in contacts: # Everyone knows a few random nodes
+            for other in random.sample(contacts, 30):
+                tables[c.id].update(other)
+        offline = set(c.id for c in contacts[:100])
+        queries = []
+        failed = set()
+
+        def query(candidates, target):
+            queries.append(len(candidates))
+            failed.update(c.id for c in candidates if c.id in offline)
+            return [ (c, None if c.id in offline else tables[c.id].closest(target)) for c in candidates ]
+
+        start = tables[contacts[-1].id]
+        target = contacts[1000].id
+        closest = kademlia.lookup(start, target, query)
+        self.assertEqual(target, closest[0].id)
+        self.assertLess(len(queries), 4 * math.log2(len(contacts)))
+        self.assertFalse(offline & set(c.id for c in closest))
+
+        # Nodes that did not answer are dropped from the routing table
+        self.assertTrue(all(identifier not in start for identifier in failed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import sys
+import time
+import os
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.keypool import KeyPairPool
+from lib.encryption import Encryption, KeyPair
+
+
+def wait_ready(pool, count):
+    deadline = time.monotonic() + 10.0
+    while pool.stats()["ready"] < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return pool.stats()["ready"]
+
+
+class KeyPairPoolTestCase(unittest.TestCase):
+    def assertUsable(self, keypair):
+        e = Encryption()
+        self.assertIsInstance(keypair, KeyPair)
+        self.assertTrue(e.verify(b'message', e.sign(b'message', keypair.raw_private_key), keypair.raw_public_key))
+
+    def testMiss(self):
+        pool = KeyPairPool(2) # Not started, so never refilled
+        self.assertUsable(pool.take())
+        self.assertEqual({ "hits" : 0, "misses" : 1, "generated" : 0, "ready" : 0 }, pool.stats())
+        pool.stop()
+
+    def testRefill(self):
+        pool = KeyPairPool(4, low_watermark=2)
+        pool.start()
+        self.assertEqual(4, wait_ready(pool, 4))
+        self.assertUsable(pool.take())
+        pool.take()
+        self.assertEqual({ "hits" : 2, "misses" : 0, "generated" : 4, "ready" : 2 }, pool.stats()) # Not below the watermark yet
+
+        pool.take() # Drops below the watermark
+        self.assertEqual(4, wait_ready(pool, 4))
+        self.assertEqual(7, pool.stats()["generated"]) # Refilled up to the size
+        pool.stop()
+
+    def testProcesses(self):
+        pool = KeyPairPool(2, processes=2)
+        pool.start()
+        self.assertEqual(2, wait_ready(pool, 2))
+        self.assertUsable(pool.take())
+        self.assertEqual(1, pool.stats()["hits"])
+        pool.stop()
+        self.assertRaises(RuntimeError, pool.executor.submit, len, ()) # Shut down with the pool
+
+    def testStop(self):
+        pool = KeyPairPool(2)
+        pool.start()
+        pool.stop()
+        self.assertFalse(pool.thread.is_alive())
+        ready = pool.stats()["ready"]
+        pool.take()
+        pool.take()
+        time.sleep(0.1)
+        self.assertEqual(0, pool.stats()["ready"]) # No more refills
+        self.assertEqual(max(0, 2 - ready), pool.stats()["misses"])
+
+
+if __name__ == '__main__':
+    unittest.main()
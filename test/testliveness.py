@@ -0,0 +1,128 @@
+import sys
+import time
+import os
+import random
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.liveness import TimingWheel, LivenessMonitor, HeartbeatService, heartbeat_address
+from lib.overlay import OverlayNode, OverlayStore
+from lib.encryption import Key
+
+
+class TimingWheelTestCase(unittest.TestCase):
+    def testExpiry(self):
+        wheel = TimingWheel(1.0, 8, 3, now=0)
+        random.seed(7)
+        delays = [ random.randint(1, 700) for i in range(500) ] # Up to the clamped top level
+        timers = [ wheel.schedule(delay, (delay, i)) for (i, delay) in enumerate(delays) ]
+        wheel.cancel(timers[0])
+
+        expired = []
+        for now in range(0, 800, 5):
+            for (delay, i) in wheel.advance(now):
+                self.assertTrue(now - 5 < delay <= now)
+                expired.append(i)
+        self.assertEqual(list(range(1, 500)), sorted(expired))
+        self.assertEqual(0, len(wheel))
+
+
+class LivenessMonitorTestCase(unittest.TestCase):
+    def testTransitions(self):
+        store = OverlayStore()
+        for i in range(1000):
+            node = OverlayNode("tcp://10.0.%d.%d:4363" % (i // 256, i % 256), Key(b"key", True))
+            node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+            store.update_node(node)
+        monitor = LivenessMonitor(store, 30, 120, TimingWheel(now=0))
+        addresses = list(store.nodes)
+        monitor.heartbeat(addresses, 0)
+
+        for now in range(10, 200, 10):
+            monitor.heartbeat(addresses[:900], now) # The rest crashed
+            monitor.tick(now)
+            if now == 60:
+                self.assertEqual(100, store.count(OverlayNode.OVERLAY_NODE_STATUS_DANGLING))
+        self.assertEqual(100, store.count(OverlayNode.OVERLAY_NODE_STATUS_OFFLINE))
+        self.assertEqual(900, len(store.get_nodes(1000)))
+
+        # Back again
+        monitor.heartbeat(addresses[900:901], 200)
+        self.assertEqual(901, len(store.get_nodes(1000)))
+
+    def testLearnedNodes(self):
+        store = OverlayStore()
+        start = time.monotonic()
+        monitor = LivenessMonitor(store, 30, 120, TimingWheel(now=start))
+        node = OverlayNode("tcp://10.0.0.1:4363", Key(b"key", True))
+        node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+        store.update_node(node) # Learned of in a join reply, say: it never sent a heartbeat
+        self.assertIn(node.address, monitor.timers)
+        for now in range(10, 200, 10):
+            monitor.tick(start + now)
+        self.assertEqual(OverlayNode.OVERLAY_NODE_STATUS_OFFLINE, node.status)
+
+        store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_ONLINE) # Heard of again
+        self.assertIn(node.address, monitor.timers)
+
+    def testHeartbeatAddress(self):
+        self.assertEqual("tcp://127.0.0.1:4364", heartbeat_address("tcp://127.0.0.1:4363"))
+
+
+class FakeConfiguration(object):
+    def __init__(self, ranking):
+        self.ranking = ranking
+
+    def get_node_address(self):
+        return "tcp://10.0.0.0:4363"
+
+    def get_bootstrap_ranking(self):
+        return self.ranking
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.endpoints = set()
+
+    def connect(self, endpoint):
+        self.endpoints.add(endpoint)
+
+    def disconnect(self, endpoint):
+        self.endpoints.remove(endpoint)
+
+
+class HeartbeatServiceTestCase(unittest.TestCase):
+    def testTargets(self):
+        store = OverlayStore()
+        addresses = [ "tcp://10.0.%d.%d:4363" % (i >> 8, i & 255) for i in range(1, 1001) ]
+        for address in addresses:
+            node = OverlayNode(address, Key(address.encode("utf-8"), True))
+            node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+            store.update_node(node)
+        configuration = FakeConfiguration([ "tcp://10.1.0.%d:4363" % (i) for i in range(10) ] + [ "tcp://10.0.0.0:4363" ])
+        service = HeartbeatService(configuration, store, fanout=8, bootstrap=3)
+
+        socket = FakeSocket()
+        connected = set()
+        service._connect(socket, connected)
+        self.assertEqual(11, len(connected)) # Not a socket per known node
+        self.assertEqual(set(heartbeat_address(address) for address in connected), socket.endpoints)
+
+        for node in store.get_nodes(4):
+            gone = OverlayNode(node.address, node.public_key)
+            gone.status = OverlayNode.OVERLAY_NODE_STATUS_OFFLINE
+            store.update_node(gone)
+        configuration.ranking = [ "tcp://10.0.0.0:4363" ] # Never ourselves
+        service._connect(socket, connected)
+        self.assertEqual(set(node.address for node in store.get_nodes(8)), connected)
+        self.assertEqual(set(heartbeat_address(address) for address in connected), socket.endpoints)
+
+        # The node we joined through tracks us, whatever its rank
+        service.joined_through("tcp://10.2.0.1:4363")
+        self.assertTrue(service.reconnect)
+        service._connect(socket, connected)
+        self.assertIn("tcp://10.2.0.1:4363", connected)
+
+
+if __name__ == '__main__':
+    unittest.main()
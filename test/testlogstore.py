@@ -0,0 +1,160 @@
+import sys
+import os
+import uuid
+import random
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import logsync
+from lib.logstore import SegmentedLog, StoredSyncIndex
+from lib.messaging import Message, MessageLog, MessagePartText
+
+
+def message(identifier, revision, timestamp, text):
+    return { "identifier" : identifier, "revision" : revision, "timestamp" : timestamp, "fields" : {}, "system" : False, "parts" : [ text ] }
+
+
+class SegmentedLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.identifiers = [ str(uuid.uuid4()) for i in range(200) ]
+        self.log = SegmentedLog(self.directory, segment_bytes=2048, hot_window=4)
+        for (i, identifier) in enumerate(self.identifiers):
+            self.log.append(message(identifier, 0, 1000.0 + i, "message %d" % (i)))
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def testRollover(self):
+        self.assertGreater(len(self.log.segments), 1)
+        self.assertEqual("message 7", self.log.get(self.identifiers[7], 0)["parts"][0])
+        self.assertIsNone(self.log.get(self.identifiers[7], 1))
+
+    def testReadRange(self):
+        self.assertEqual([ "message %d" % (i) for i in range(100, 110) ], [ m["parts"][0] for m in self.log.read_range(1100.0, 1110.0) ])
+
+    def testCompaction(self):
+        for identifier in self.identifiers[:50]:
+            self.log.append(message(identifier, 1, 2000.0, "revised"))
+        self.assertEqual(50, len(self.log.compact()))
+        self.assertIsNone(self.log.get(self.identifiers[0], 0))
+        self.assertEqual("revised", self.log.get(self.identifiers[0], 1)["parts"][0])
+        self.assertEqual("message 60", self.log.get(self.identifiers[60], 0)["parts"][0])
+
+    def testRecovery(self):
+        self.log.close()
+        active = self.log.segments[-1].path
+        with open(active, "ab") as f:
+            f.write(b"\x00\x00\x10\x00torn")
+        self.log = SegmentedLog(self.directory, segment_bytes=2048)
+        self.assertEqual(200, len(self.log))
+        self.assertEqual("message 199", self.log.get(self.identifiers[199], 0)["parts"][0])
+
+
+class SmallSyncIndex(StoredSyncIndex):
+    BLOCK = 4
+    MAX_PENDING = 8
+
+    __slots__ = []
+
+
+class StoredSyncIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "sync.idx")
+        self.keys = [ (1000.0 + i, str(uuid.uuid4()), 0) for i in range(100) ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSame(self, memory, stored):
+        self.assertEqual(len(memory), len(stored))
+        bounds = [ None ] + sorted(random.sample(memory.keys, 10)) + [ (1050.5, "", 0), None ]
+        for (lower, upper) in zip(bounds[:-1], bounds[1:]):
+            self.assertEqual(memory.fingerprint(lower, upper), stored.fingerprint(lower, upper))
+            self.assertEqual(memory.keys_in(lower, upper), stored.keys_in(lower, upper))
+
+    def testOrder(self):
+        index = SmallSyncIndex(self.path)
+        late = self.keys[::7]
+        for key in self.keys:
+            if key not in late:
+                index.add(key)
+        for key in late: # Arrived while offline, merged into the file every 8
+            index.add(key)
+        index.add(self.keys[3])
+        self.assertIn(self.keys[7], index)
+        self.assertSame(logsync.SyncIndex(self.keys), index)
+
+        index.remove(self.keys[10:20])
+        self.assertSame(logsync.SyncIndex(self.keys[:10] + self.keys[20:]), index)
+        index.close()
+
+        index = SmallSyncIndex(self.path)
+        self.assertSame(logsync.SyncIndex(self.keys[:10] + self.keys[20:]), index)
+        bounds = index.split(None, None, 4)
+        self.assertEqual(4, len(bounds))
+        self.assertEqual(90, sum(index.fingerprint(lower, upper)[0] for (lower, upper) in bounds))
+        index.close()
+
+    def testUpdate(self):
+        index = SmallSyncIndex(self.path)
+        index.update(self.keys[50:])
+        index.update(self.keys[:50:2]) # Late, merged into the file once
+        index.update(self.keys[1:50:2] + self.keys[60:62])
+        self.assertSame(logsync.SyncIndex(self.keys), index)
+        index.close()
+
+        log = SegmentedLog(self.directory, segment_bytes=2048)
+        log.extend([ message(identifier, revision, timestamp, "text") for (timestamp, identifier, revision) in self.keys ])
+        self.assertSame(logsync.SyncIndex(self.keys), log.sync_index)
+        self.assertEqual("text", log.get(self.keys[42][1], 0)["parts"][0])
+        log.close()
+
+    def testReconcile(self):
+        index = SmallSyncIndex(self.path)
+        for key in self.keys[:90]:
+            index.add(key)
+        remote = logsync.SyncIndex(self.keys[5:])
+        (missing, surplus) = logsync.reconcile(index, lambda ranges: logsync.respond(remote, ranges))
+        self.assertEqual(self.keys[90:], missing)
+        self.assertEqual(self.keys[:5], surplus)
+        index.close()
+
+    def testRebuild(self):
+        log = SegmentedLog(self.directory)
+        for (timestamp, identifier, revision) in self.keys:
+            log.append(message(identifier, revision, timestamp, "text"))
+        log.close()
+        os.remove(os.path.join(self.directory, "sync.idx"))
+
+        log = SegmentedLog(self.directory)
+        self.assertSame(logsync.SyncIndex(self.keys), log.sync_index)
+        log.close()
+
+
+class PersistentMessageLogTestCase(unittest.TestCase):
+    def testReopen(self):
+        directory = tempfile.mkdtemp()
+        try:
+            log = MessageLog("log", SegmentedLog(directory))
+            log.add_participant("alice")
+            log.add_participant("bob")
+            m = Message()
+            m.add_part(MessagePartText("hello"))
+            log.append_message(m)
+            log.storage.close()
+
+            log = MessageLog("log", SegmentedLog(directory))
+            self.assertEqual(1, len(log.sync_index))
+            self.assertEqual("hello", log.get_message(m.header.sync_key).parts[0].content)
+            log.storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
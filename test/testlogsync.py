@@ -0,0 +1,144 @@
+import sys
+import os
+import hashlib
+import datetime
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import logsync
+from lib.messaging import Message, MessageLog, MessagePartText, MessagingService
+from lib.overlay import OverlayNode, OverlayStore
+from lib.encryption import Key
+
+
+class FakeEncryption(object):
+    """Signatures without the public key cryptography: private and public keys are the same."""
+
+    def sign(self, message, private_key):
+        return hashlib.sha256(private_key + message).hexdigest()
+
+    def verify(self, message, signature, public_key):
+        return signature == self.sign(message, public_key)
+
+
+USER_KEYS = { "alice" : [ b"alice key" ], "bob" : [ b"bob key" ], "mallory" : [ b"mallory key" ] }
+
+
+class FakeConfiguration(object):
+    def __init__(self, user="bob", key=None):
+        self.user = user
+        self.keypair = type("KeyPair", (object,), { "raw_private_key" : key or USER_KEYS[user][0] })()
+
+    def get_node_address(self):
+        return "tcp://10.0.0.1:4363"
+
+    def get_user_identifier(self):
+        return self.user
+
+    def get_user_keypair(self):
+        return self.keypair
+
+
+def make_service(store, configuration=None):
+    return MessagingService(configuration or FakeConfiguration(), FakeEncryption(), store, _user_keys=lambda user: USER_KEYS.get(user, []))
+
+
+def make_log(identifier, count, start=datetime.datetime(2013, 1, 1)):
+    log = MessageLog(identifier)
+    log.add_participant("alice")
+    log.add_participant("bob")
+    for i in range(count):
+        message = Message()
+        message.header.datetime = start + datetime.timedelta(seconds=i)
+        message.add_part(MessagePartText("message %d" % (i)))
+        log.append_message(message)
+    return log
+
+
+class SyncIndexTestCase(unittest.TestCase):
+    def testFingerprintIndependentOfOrder(self):
+        keys = [ (float(i), "id%d" % (i), 0) for i in range(100) ]
+        a = logsync.SyncIndex(keys)
+        b = logsync.SyncIndex()
+        for key in reversed(keys):
+            b.add(key)
+        self.assertEqual(a.fingerprint(None, None), b.fingerprint(None, None))
+        self.assertEqual(a.fingerprint(keys[10], keys[20]), (10, b.fingerprint(keys[10], keys[20])[1]))
+
+        c = logsync.SyncIndex(keys[::2])
+        c.update(keys[1::2] + keys[:3]) # Rebuilt once, duplicates are ignored
+        self.assertEqual((a.keys, a.prefix), (c.keys, c.prefix))
+
+    def testReconcile(self):
+        keys = [ (float(i), "id%d" % (i), 0) for i in range(5000) ]
+        local = logsync.SyncIndex(keys[:4900] + [ (0.5, "local", 0) ])
+        remote = logsync.SyncIndex(keys)
+        exchanged = []
+
+        def exchange(ranges):
+            exchanged.append(len(ranges))
+            return logsync.respond(remote, ranges)
+
+        (missing, surplus) = logsync.reconcile(local, exchange)
+        self.assertEqual(keys[4900:], missing)
+        self.assertEqual([ (0.5, "local", 0) ], surplus)
+        self.assertLess(sum(exchanged), 100) # Not the whole log
+
+
+class MessagingSyncTestCase(unittest.TestCase):
+    def testSynchronize(self):
+        remote = make_log("log", 300)
+        local = MessageLog("log")
+        local.add_participant("alice")
+        local.add_participant("bob")
+        for message in remote.messages[:250]:
+            local.append_message(Message.from_dict(message.to_dict()))
+
+        store = OverlayStore()
+        store.update_node(OverlayNode("tcp://10.0.0.1:4363", Key(b"key", True)))
+        service = make_service(store)
+        service.add_log(remote)
+
+        def request(m):
+            return service.request_handlers()[m["request"]](m).message
+
+        (fetched, surplus) = service.synchronize(local, request)
+        self.assertEqual((50, []), (fetched, surplus))
+        self.assertEqual(remote.sync_index.fingerprint(None, None), local.sync_index.fingerprint(None, None))
+        self.assertEqual("message 299", local.messages[-1].parts[0].content)
+
+    def testParticipantsOnly(self):
+        remote = make_log("log", 10)
+        store = OverlayStore()
+        store.update_node(OverlayNode("tcp://10.0.0.1:4363", Key(b"key", True)))
+        service = make_service(store)
+        service.add_log(remote)
+        handlers = service.request_handlers()
+        local = MessageLog("log")
+        local.add_participant("alice")
+        local.add_participant("bob")
+
+        def request(m):
+            requests.append(m)
+            return handlers[m["request"]](m).message
+
+        for configuration in (FakeConfiguration("mallory"), FakeConfiguration("alice", b"mallory key")): # Not a participant, not alice
+            requests = []
+            self.assertRaises(ValueError, make_service(store, configuration).synchronize, local, request)
+            fetch = dict(requests[0], request="message-log-fetch", keys=[ m.header.sync_key for m in remote.messages ])
+            reply = handlers["message-log-fetch"](fetch)
+            self.assertEqual("message-log-fetch_denied", reply.message["response"])
+            self.assertEqual(b"key", reply.public_key) # Encrypted, only the node can tell why
+            self.assertNotIn("messages", reply.message)
+
+        requests = []
+        make_service(store, FakeConfiguration("alice")).synchronize(local, request)
+        self.assertEqual(10, len(local.sync_index))
+        fetch = dict(requests[0], request="message-log-fetch", keys=[ m.header.sync_key for m in remote.messages ], log="other")
+        self.assertEqual("message-log-fetch_denied", handlers["message-log-fetch"](fetch).message["response"]) # Signed for "log" only
+
+        self.assertEqual({}, MessagingService(FakeConfiguration(), FakeEncryption(), store).request_handlers()) # Users' keys unknown
+
+
+if __name__ == '__main__':
+    unittest.main()
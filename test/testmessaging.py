@@ -0,0 +1,83 @@
+import sys
+import os
+import random
+import datetime
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import logsync
+from lib.messaging import Message, MessagePartText, MessageTable, SystemMessage, TableSyncIndex
+
+
+class MessageTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.message = Message()
+        self.message.header.set_field("from", "alice")
+        self.message.add_part(MessagePartText("héllo"))
+        self.message.add_part(MessagePartText("world"))
+        self.table = MessageTable()
+        self.table.append(SystemMessage())
+        self.table.append(self.message)
+
+    def testView(self):
+        view = self.table[-1]
+        self.assertEqual(self.message.to_dict(), view.to_dict())
+        self.assertEqual(self.message.header.sync_key, view.header.sync_key)
+        self.assertIsInstance(self.table[0], SystemMessage)
+        self.assertEqual([], self.table[0].parts)
+
+    def testReadOnly(self):
+        view = self.table[1]
+        self.assertRaises(AttributeError, setattr, view.header, "revision", 5)
+        self.assertRaises(AttributeError, view.add_part, MessagePartText("more"))
+
+    def testCloneRevision(self):
+        clone = self.table[1].clone_revision()
+        self.assertEqual(self.message.header.identifier, clone.header.identifier)
+        self.assertEqual(1, clone.header.revision)
+        clone.add_part(MessagePartText("edited"))
+        self.assertEqual(3, len(clone.parts))
+
+    def testFind(self):
+        clones = [ self.table[1].clone_revision() ]
+        for i in range(20):
+            clones.append(Message())
+        for clone in reversed(clones):
+            self.table.append(clone)
+        self.assertEqual(1, self.table.find(self.message.header.identifier.bytes, 0))
+        self.assertEqual(len(self.table) - 1, self.table.find(self.message.header.identifier.bytes, 1))
+        for clone in clones[1:]:
+            self.assertEqual(clone.header.sync_key, self.table[self.table.find(clone.header.identifier.bytes, 0)].header.sync_key)
+        self.assertIsNone(self.table.find(self.message.header.identifier.bytes, 2))
+
+        # Appended after a lookup
+        self.table.append(clones[0].clone_revision())
+        self.assertEqual(len(self.table) - 1, self.table.find(self.message.header.identifier.bytes, 2))
+
+
+class TableSyncIndexTestCase(unittest.TestCase):
+    def testFingerprints(self):
+        messages = []
+        for i in range(300):
+            message = Message()
+            message.header.datetime = datetime.datetime.fromtimestamp(1400000000 + i * 60 + random.randint(0, 59)).replace(microsecond=i)
+            messages.append(message)
+        table = MessageTable()
+        index = TableSyncIndex(table)
+        for message in messages[:200]: # In order, then late arrivals one by one and in bulk
+            index.add(table.append(message), message.header.sync_key)
+        for message in messages[250:260]:
+            index.add(table.append(message))
+        index.update([ table.append(message) for message in messages[200:250] + messages[260:] ])
+
+        keys = logsync.SyncIndex(message.header.sync_key for message in messages)
+        self.assertEqual(keys.keys, index.keys_in(None, None))
+        for (lower, upper) in keys.split(None, None) + [ (keys.keys[10], keys.keys[280]) ]:
+            self.assertEqual(keys.fingerprint(lower, upper), index.fingerprint(lower, upper))
+        self.assertEqual(keys.split(keys.keys[5], None), index.split(keys.keys[5], None))
+        self.assertIn(messages[42].header.sync_key, index)
+        self.assertNotIn(Message().header.sync_key, index)
+
+
+if __name__ == '__main__':
+    unittest.main()
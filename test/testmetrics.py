@@ -0,0 +1,34 @@
+import sys
+import os
+import unittest
+import urllib.request
+import urllib.error
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.metrics import Registry, MetricsServer
+
+
+class MetricsServerTestCase(unittest.TestCase):
+    def testScrape(self):
+        registry = Registry()
+        counter = registry.counter("jodawg_test_total", "Test counter.", ("outcome",))
+        counter.inc(("hit",), 3)
+        server = MetricsServer(0, registry=registry)
+        server.start()
+
+        url = "http://127.0.0.1:%d" % (server.port)
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+            self.assertEqual("text/plain; version=0.0.4", response.headers["Content-Type"])
+            self.assertIn('jodawg_test_total{outcome="hit"} 3', response.read().decode("utf-8"))
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(url + "/other", timeout=5)
+        self.assertEqual(404, context.exception.code)
+        context.exception.close()
+
+        server.terminate()
+        server.join(5)
+        self.assertFalse(server.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import sys
+import os
+import json
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib import codec
+from lib.encryption import Encryption, KeyPair
+from lib.network import Node, Reply, encode_header, decode_header
+
+
+class FakeConfiguration(object):
+    def __init__(self):
+        self.keypair = KeyPair()
+
+    def get_node_keypair(self):
+        return self.keypair
+
+
+class EchoService(object):
+    def request_handlers(self):
+        return { "echo" : lambda message: Reply({ "response" : "echo", "text" : message["text"] }) }
+
+
+class CountingEncryption(Encryption):
+    def __init__(self):
+        Encryption.__init__(self)
+        self.decrypted = 0
+
+    def decrypt(self, cipher, private_key):
+        self.decrypted += 1
+        return Encryption.decrypt(self, cipher, private_key)
+
+
+class NodeFramesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.configuration = FakeConfiguration()
+        self.encryption = CountingEncryption()
+        self.node = Node(self.configuration, self.encryption)
+        self.node.add_service("echo", EchoService())
+        self.payload = self.encryption.encrypt_compress({ "request" : "echo", "text" : "hello" },
+                                                        self.configuration.keypair.raw_public_key, codec.BINARY)
+
+    def tearDown(self):
+        self.node.context.term()
+
+    def testHeader(self):
+        self.assertEqual((1, codec.BINARY.version, "echo", None), decode_header(encode_header("echo", codec.BINARY)))
+        self.assertEqual((1, 0, "echo", b"c" * 20), decode_header(encode_header("echo", cookie=b"c" * 20)))
+        self.assertRaises(ValueError, decode_header, b"JD\x01")
+
+    def testMultipart(self):
+        reply = self.node.handle_frames([ encode_header("echo", codec.BINARY), memoryview(self.payload) ])
+        self.assertEqual({ "response" : "echo", "text" : "hello" }, json.loads(reply.decode('utf-8')))
+        reply = self.node.handle_frames([ self.payload ]) # Legacy
+        self.assertEqual("echo", json.loads(reply.decode('utf-8'))["response"])
+
+    def testRejectedBeforeDecryption(self):
+        for (header, reason) in [ (encode_header("presence"), "unknown_service"), (b"JD\x02\x00\x04echo", "unsupported_version"),
+                                  (b"garbage", "malformed_header") ]:
+            reply = json.loads(self.node.handle_frames([ header, self.payload ]).decode('utf-8'))
+            self.assertEqual(reason, reply["reason"])
+        self.assertEqual(0, self.encryption.decrypted)
+
+    def testBatch(self):
+        requests = [ { "request" : "echo", "text" : "%d" % (i) } for i in range(3) ] + [ { "request" : "nope" } ]
+        payload = self.encryption.encrypt_compress({ "request" : "batch", "requests" : requests }, self.configuration.keypair.raw_public_key)
+        reply = json.loads(self.node.handle_frames([ encode_header("batch"), payload ]).decode('utf-8'))
+        self.assertEqual([ "0", "1", "2" ], [ r["text"] for r in reply["responses"][:3] ])
+        self.assertEqual("unknown_request", reply["responses"][3]["reason"])
+        self.assertEqual(1, self.encryption.decrypted)
+
+    def testServiceMismatch(self):
+        self.node.add_service("other", type("Other", (object,), { "request_handlers" : lambda self: {} })())
+        reply = json.loads(self.node.handle_frames([ encode_header("other"), self.payload ]).decode('utf-8'))
+        self.assertEqual("service_mismatch", reply["reason"])
+
+
+if __name__ == '__main__':
+    unittest.main()
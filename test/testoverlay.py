@@ -0,0 +1,46 @@
+import sys
+import os
+import datetime
+import unittest
+sys.path.insert(0, os.path.join('..', 'p2p'))
+
+from lib.overlay import OverlayNode, OverlayStore
+
+
+class OverlayStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = OverlayStore()
+        start = datetime.datetime(2013, 1, 1)
+        for i in range(30):
+            node = OverlayNode("tcp://10.0.0.%d:4363" % (i), None, start + datetime.timedelta(minutes=i))
+            node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+            self.store.update_node(node)
+
+    def testLongestOnline(self):
+        nodes = self.store.get_nodes(5)
+        self.assertEqual([ "tcp://10.0.0.%d:4363" % (i) for i in range(5) ], [ n.address for n in nodes ])
+
+    def testStatusChange(self):
+        node = self.store.get_node("tcp://10.0.0.0:4363")
+        self.store.set_status(node, OverlayNode.OVERLAY_NODE_STATUS_OFFLINE)
+        self.assertEqual("tcp://10.0.0.1:4363", self.store.get_nodes(1)[0].address)
+        self.assertEqual(29, self.store.count(OverlayNode.OVERLAY_NODE_STATUS_ONLINE))
+        self.assertEqual(1, self.store.count(OverlayNode.OVERLAY_NODE_STATUS_OFFLINE))
+
+    def testUpdateReplaces(self):
+        node = OverlayNode("tcp://10.0.0.0:4363", None, datetime.datetime(2014, 1, 1))
+        node.status = OverlayNode.OVERLAY_NODE_STATUS_ONLINE
+        self.store.update_node(node)
+        self.assertEqual(30, self.store.count(OverlayNode.OVERLAY_NODE_STATUS_ONLINE))
+        self.assertEqual("tcp://10.0.0.0:4363", self.store.get_nodes(30)[-1].address)
+
+    def testStratified(self):
+        nodes = self.store.get_nodes(9, stratified=True)
+        self.assertEqual(9, len(set(n.address for n in nodes)))
+        # Three nodes from each of the long, medium and short uptime strata
+        positions = [ int(n.address.split('.')[-1].split(':')[0]) for n in nodes ]
+        self.assertEqual([ 3, 3, 3 ], [ len([ p for p in positions if lo <= p < lo + 10 ]) for lo in (0, 10, 20) ])
+
+
+if __name__ == '__main__':
+    unittest.main()